@@ -0,0 +1,260 @@
+"""Benchmark every async driver through the same scenarios
+
+Each `AsyncManager` is run through:
+
+    * spawn         spawning tasks and waiting for them all to run
+    * spawn_later   cost of scheduling timers and how late they fire
+    * queue         round trips between two tasks over a pair of queues
+    * event         time from an event being set to its waiter waking
+    * lock          tasks contending for one lock, yielding while holding it
+    * stop          stopping a manager with many tasks that have just finished
+
+along with starting and stopping a deep and a wide tree of services using
+the driver. Drivers that can't be imported are skipped. The multiprocessing
+driver uses the threading primitives, so it isn't run by default.
+
+Results are printed as a table, and can be written as JSON with `-o` to be
+compared against later with `--baseline`, which shows the change in each
+metric and marks regressions past `--threshold` percent:
+
+    PYTHONPATH=. python benchmarks/bench_async.py -o bench.json
+    PYTHONPATH=. python benchmarks/bench_async.py --baseline bench.json
+
+Metric names end in their unit. Rates (`_per_s`) are better higher, and
+everything else is a time that's better lower.
+
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+
+import ginkgo
+from ginkgo.async import load_driver
+from ginkgo.core import Service
+from ginkgo.util import monotonic
+
+DRIVERS = ["ginkgo.async.gevent", "ginkgo.async.eventlet",
+           "ginkgo.async.threading"]
+
+def percentiles(samples, scale):
+    samples = sorted(samples)
+    return [samples[min(int(len(samples) * p), len(samples) - 1)] * scale
+            for p in (0.5, 0.99)]
+
+@contextlib.contextmanager
+def quiet():
+    # the threading manager prints a warning every time one is created
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def manager(driver):
+    with quiet():
+        manager = load_driver(driver)()
+    manager.start()
+    return manager
+
+def bench_spawn(async, n):
+    done = async.queue()
+    started = monotonic()
+    for _ in xrange(n):
+        async.spawn(done.put, None)
+    spawned = monotonic() - started
+    for _ in xrange(n):
+        done.get()
+    elapsed = monotonic() - started
+    return dict(spawn_us=spawned / n * 1e6, tasks_per_s=n / elapsed)
+
+def bench_spawn_later(async, n, delay=0.05):
+    fired = async.queue()
+    def fire(due):
+        fired.put(monotonic() - due)
+    started = monotonic()
+    for _ in xrange(n):
+        async.spawn_later(delay, fire, monotonic() + delay)
+    scheduled = monotonic() - started
+    p50, p99 = percentiles([fired.get() for _ in xrange(n)], 1e3)
+    return dict(schedule_us=scheduled / n * 1e6, late_p50_ms=p50,
+                late_p99_ms=p99)
+
+def bench_queue(async, n):
+    ping, pong = async.queue(), async.queue()
+    def ponger():
+        for _ in xrange(n):
+            pong.put(ping.get())
+    async.spawn(ponger)
+    samples = []
+    for i in xrange(n):
+        started = monotonic()
+        ping.put(i)
+        pong.get()
+        samples.append(monotonic() - started)
+    p50, p99 = percentiles(samples, 1e6)
+    return dict(round_trip_p50_us=p50, round_trip_p99_us=p99)
+
+def bench_event(async, n):
+    woken = async.queue()
+    samples = []
+    for _ in xrange(n):
+        event = async.event()
+        def waiter():
+            event.wait()
+            woken.put(monotonic())
+        async.spawn(waiter)
+        async.sleep(0.001)
+        set_at = monotonic()
+        event.set()
+        samples.append(woken.get() - set_at)
+    p50, p99 = percentiles(samples, 1e6)
+    return dict(wake_p50_us=p50, wake_p99_us=p99)
+
+def bench_lock(async, n, tasks=8):
+    lock = async.lock()
+    done = async.queue()
+    def contend():
+        for _ in xrange(n // tasks):
+            with lock:
+                async.sleep(0)
+        done.put(None)
+    started = monotonic()
+    for _ in xrange(tasks):
+        async.spawn(contend)
+    for _ in xrange(tasks):
+        done.get()
+    elapsed = monotonic() - started
+    return dict(acquires_per_s=n // tasks * tasks / elapsed)
+
+def bench_stop(async, n):
+    release = async.event()
+    for _ in xrange(n):
+        async.spawn(release.wait)
+    async.sleep(0.1)
+    started = monotonic()
+    release.set()
+    async.stop()
+    return dict(stop_ms=(monotonic() - started) * 1e3)
+
+def tree(depth, width):
+    root = Service()
+    parent = root
+    for _ in xrange(depth - 1):
+        child = Service()
+        parent.add_service(child)
+        parent = child
+    for _ in xrange(width):
+        root.add_service(Service())
+    return root
+
+def bench_tree(driver, depth, width):
+    ginkgo.settings.set("async", driver)
+    started = monotonic()
+    with quiet():
+        root = tree(depth, width)
+    built = monotonic()
+    root.start()
+    ready = monotonic()
+    root.stop()
+    stopped = monotonic()
+    return dict(build_ms=(built - started) * 1e3,
+                start_ms=(ready - built) * 1e3,
+                stop_ms=(stopped - ready) * 1e3)
+
+SCENARIOS = [
+    ("spawn", bench_spawn, 10000),
+    ("spawn_later", bench_spawn_later, 1000),
+    ("queue", bench_queue, 10000),
+    ("event", bench_event, 200),
+    ("lock", bench_lock, 10000),
+    ("stop", bench_stop, 1000),
+]
+
+def run(driver, scale):
+    results = []
+    for name, bench, n in SCENARIOS:
+        n = max(int(n * scale), 1)
+        async = manager(driver)
+        metrics = bench(async, n)
+        if async.state.current in ["starting", "ready"]:
+            async.stop()
+        results.append(dict(driver=driver, scenario=name, n=n, **metrics))
+    for name, depth, width in (("deep_tree", 100, 1), ("wide_tree", 1, 1000)):
+        n = max(int(max(depth, width) * scale), 1)
+        depth, width = min(depth, n), min(width, n)
+        metrics = bench_tree(driver, depth, width)
+        results.append(dict(driver=driver, scenario=name, n=n, **metrics))
+    return results
+
+def metrics(result):
+    return sorted(k for k in result if k not in ("driver", "scenario", "n"))
+
+def change(metric, value, baseline):
+    """Percent change from the baseline, positive when it got worse"""
+    if not baseline:
+        return 0.0
+    percent = (value - baseline) / float(baseline) * 100
+    return -percent if metric.endswith("_per_s") else percent
+
+def report(results, baseline=None, threshold=10):
+    previous = {}
+    for result in (baseline or {}).get("results", []):
+        previous[result["driver"], result["scenario"]] = result
+    regressions = 0
+    for result in results:
+        before = previous.get((result["driver"], result["scenario"]), {})
+        line = ["%-22s %-12s" % (result["driver"], result["scenario"])]
+        for metric in metrics(result):
+            column = "%s %.2f" % (metric, result[metric])
+            if metric in before:
+                worse = change(metric, result[metric], before[metric])
+                regressions += worse > threshold
+                column += " (%+.0f%%%s)" % (
+                    worse, "!" if worse > threshold else "")
+            line.append(column)
+        print "  ".join(line)
+    if baseline is not None:
+        print "%d metrics regressed by more than %d%%" % (
+            regressions, threshold)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark async drivers")
+    parser.add_argument("drivers", nargs="*", default=DRIVERS,
+                        help="async driver modules to benchmark")
+    parser.add_argument("-o", "--output",
+                        help="write results as JSON to this file")
+    parser.add_argument("--baseline",
+                        help="JSON results to compare against")
+    parser.add_argument("--threshold", type=float, default=10,
+                        help="percent change counted as a regression")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="multiplier for the number of iterations")
+    args = parser.parse_args(argv)
+    results = []
+    for driver in args.drivers:
+        try:
+            load_driver(driver)
+        except ImportError, e:
+            print >> sys.stderr, "skipping {}: {}".format(driver, e)
+            continue
+        results.extend(run(driver, args.scale))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    report(results, baseline, args.threshold)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(dict(ginkgo=ginkgo.__version__,
+                           python=platform.python_version(),
+                           platform=platform.platform(),
+                           time=time.time(), results=results),
+                      f, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Benchmark Group access on a large configuration
+
+Loads a configuration of `groups` x `subgroups` x `keys` settings, 10,000
+by default, and times looking up a subgroup, looking up a missing name,
+iterating a group and walking the whole tree. `Group` finds subgroups in
+the config's prefix index. The old approach of scanning every key is
+included as a baseline, with fewer repetitions since it's much slower.
+
+    PYTHONPATH=. python benchmarks/bench_groups.py [groups] [subgroups] [keys]
+
+"""
+import sys
+import time
+
+from ginkgo.config import Config, Group
+
+class ScanningGroup(Group):
+    """Group that scans every key, as groups did before the index"""
+
+    def __getattr__(self, name):
+        path = self._config._normalize_path(".".join((self._name, name)))
+        try:
+            return self._config._settings[path]
+        except KeyError:
+            group_path = path + "."
+            keys = self._config._settings.keys()
+            if any(1 for k in keys if k.startswith(group_path)):
+                return ScanningGroup(self._config, path)
+            return None
+
+    def _dict(self):
+        d = dict()
+        group_path = self._name + "."
+        for key in self._config._settings.keys():
+            if not self._name or key.startswith(group_path):
+                if self._name:
+                    key = key.split(group_path, 1)[-1]
+                name = key.split('.', 1)[0]
+                if name not in d:
+                    d[name] = getattr(self, name)
+        return d
+
+    def __iter__(self):
+        return iter(self._dict())
+
+    def __len__(self):
+        return len(self._dict())
+
+def walk(group):
+    count = 0
+    for name in group:
+        value = group[name]
+        count += walk(value) if isinstance(value, Group) else 1
+    return count
+
+def timed(fn, repeat):
+    started = time.time()
+    for _ in xrange(repeat):
+        fn()
+    return (time.time() - started) / repeat
+
+def bench(root, repeat):
+    return [
+        ("subgroup lookup", timed(lambda: root.g0.s0, repeat * 100)),
+        ("missing lookup", timed(lambda: root.g0.nothing, repeat * 100)),
+        ("iterate group", timed(lambda: list(root.g0.s0), repeat * 100)),
+        ("walk tree", timed(lambda: walk(root), repeat)),
+    ]
+
+def main(groups=100, subgroups=10, keys=10):
+    config = Config()
+    config.load(dict(("bench.g%d.s%d.k%d" % (g, s, k), k)
+                     for g in xrange(groups)
+                     for s in xrange(subgroups)
+                     for k in xrange(keys)))
+    print "%d settings" % len(config._settings)
+    results = [("prefix index", bench(config.group("bench"), 10)),
+               ("key scan", bench(ScanningGroup(config, "bench"), 1))]
+    for name, timings in results:
+        for operation, elapsed in timings:
+            print "%- 13s %- 16s %12.1fus" % (name, operation, elapsed * 1e6)
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
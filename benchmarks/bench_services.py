@@ -0,0 +1,49 @@
+"""Benchmark building large numbers of services
+
+Compares constructing services with a separate `AsyncManager` each against
+sharing one root manager per driver with `async_shared`. The old behavior of
+re-running the driver module for every service is included as a baseline.
+
+    PYTHONPATH=. python benchmarks/bench_services.py [count] [async module]
+
+"""
+import runpy
+import sys
+import time
+
+import ginkgo
+from ginkgo import Service
+from ginkgo.core import BasicService
+
+def build(count):
+    return [Service() for _ in xrange(count)]
+
+def build_with_runpy(count):
+    services = []
+    for _ in xrange(count):
+        s = BasicService()
+        mod = runpy.run_module(ginkgo.settings.get("async"))
+        s.async = mod['AsyncManager']()
+        s.add_service(s.async)
+        services.append(s)
+    return services
+
+def timed(fn, count):
+    started = time.time()
+    fn(count)
+    return time.time() - started
+
+def main(count=10000, async="ginkgo.async.gevent"):
+    ginkgo.settings.set("async", async)
+    results = []
+    results.append(("runpy per service", timed(build_with_runpy, count)))
+    ginkgo.settings.set("async_shared", False)
+    results.append(("cached driver", timed(build, count)))
+    ginkgo.settings.set("async_shared", True)
+    results.append(("shared root manager", timed(build, count)))
+    print "building {} services with {}".format(count, async)
+    for name, elapsed in results:
+        print "  %- 22s %8.3fs" % (name, elapsed)
+
+if __name__ == "__main__":
+    main(*[int(a) if a.isdigit() else a for a in sys.argv[1:]])
@@ -0,0 +1,74 @@
+"""Benchmark reading settings through Setting descriptors
+
+Compares reading a setting through its descriptor, which caches the value
+until the configuration changes, against looking it up with `Config.get` on
+every read as descriptors used to, with a plain attribute as the floor. A
+run where the configuration changes every 100 reads shows the cost of
+refreshing the cache. Writes are timed setting new settings one at a
+time, each publishing a copy of the settings, against setting them in a
+`Config.batch`.
+
+    PYTHONPATH=. python benchmarks/bench_settings.py [reads]
+
+"""
+import sys
+import time
+
+from ginkgo.config import Config
+
+config = Config()
+config.set("bench.delay", 1)
+
+class Component(object):
+    delay = config.setting("bench.delay", default=0)
+    plain = 1
+
+    def uncached(self):
+        return config.get("bench.delay", 0)
+
+def bench_attribute(component, reads):
+    for _ in xrange(reads):
+        component.plain
+
+def bench_uncached(component, reads):
+    for _ in xrange(reads):
+        component.uncached()
+
+def bench_descriptor(component, reads):
+    for _ in xrange(reads):
+        component.delay
+
+def bench_churn(component, reads):
+    for i in xrange(reads):
+        if i % 100 == 0:
+            config.set("bench.delay", i)
+        component.delay
+
+def bench_writes(writes, batched):
+    started = time.time()
+    if batched:
+        with config.batch():
+            for i in xrange(writes):
+                config.set("bench.batched.k%d" % i, i)
+    else:
+        for i in xrange(writes):
+            config.set("bench.single.k%d" % i, i)
+    return time.time() - started
+
+def main(reads=1000000, writes=5000):
+    component = Component()
+    for name, bench in (("plain attribute", bench_attribute),
+                        ("Config.get per read", bench_uncached),
+                        ("cached descriptor", bench_descriptor),
+                        ("set every 100 reads", bench_churn)):
+        started = time.time()
+        bench(component, reads)
+        elapsed = time.time() - started
+        print "%- 20s %7.1fns per read" % (name, elapsed / reads * 1e9)
+    for name, batched in (("set one at a time", False),
+                          ("set in a batch", True)):
+        elapsed = bench_writes(writes, batched)
+        print "%- 20s %7.1fus per write" % (name, elapsed / writes * 1e6)
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,61 @@
+"""Benchmark pending timers in the threading AsyncManager
+
+Schedules a large number of far-off `spawn_later` timers, then cancels them
+all, reporting the cost of each step and the number of threads alive while
+they're pending. A thread-per-timer baseline with `threading.Timer` is run
+with fewer timers for comparison.
+
+    PYTHONPATH=. python benchmarks/bench_timers.py [count] [baseline count]
+
+"""
+import sys
+import threading
+import time
+
+from ginkgo.async.threading import AsyncManager
+
+def noop():
+    pass
+
+def bench_scheduler(count):
+    manager = AsyncManager()
+    started = time.time()
+    tasks = [manager.spawn_later(3600, noop) for _ in xrange(count)]
+    scheduled = time.time() - started
+    threads = threading.active_count()
+    started = time.time()
+    for task in tasks:
+        task.cancel()
+    cancelled = time.time() - started
+    manager.start()
+    manager.stop()
+    return scheduled, cancelled, threads
+
+def bench_timer_threads(count):
+    started = time.time()
+    timers = [threading.Timer(3600, noop) for _ in xrange(count)]
+    for timer in timers:
+        timer.daemon = True
+        timer.start()
+    scheduled = time.time() - started
+    threads = threading.active_count()
+    started = time.time()
+    for timer in timers:
+        timer.cancel()
+    for timer in timers:
+        timer.join()
+    cancelled = time.time() - started
+    return scheduled, cancelled, threads
+
+def main(count=100000, baseline_count=1000):
+    results = [
+        ("scheduler heap", count, bench_scheduler(count)),
+        ("thread per timer", baseline_count,
+         bench_timer_threads(baseline_count)),
+    ]
+    for name, n, (scheduled, cancelled, threads) in results:
+        print "%- 18s %7d timers  schedule %6.2fus  cancel %6.2fus  %d threads" % (
+            name, n, scheduled / n * 1e6, cancelled / n * 1e6, threads)
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
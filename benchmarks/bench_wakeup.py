@@ -0,0 +1,86 @@
+"""Benchmark wakeup latency of the threading AsyncManager
+
+Measures how long after the fact a blocked thread notices each of:
+
+    * an event set by another thread
+    * a service becoming ready while `start` blocks on it
+    * SIGTERM stopping a service the main thread is serving forever
+
+    PYTHONPATH=. python benchmarks/bench_wakeup.py [iterations]
+
+"""
+import os
+import signal
+import sys
+import threading
+import time
+
+from ginkgo.core import Service
+from ginkgo.util import monotonic
+
+class ThreadingService(Service):
+    async = "ginkgo.async.threading"
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return [samples[int(len(samples) * p)] * 1000 for p in (0.5, 0.99)]
+
+def bench_event(iterations):
+    samples = []
+    manager = ThreadingService().async
+    for _ in xrange(iterations):
+        event = manager.event()
+        stamp = []
+        def setter():
+            time.sleep(0.001)
+            stamp.append(monotonic())
+            event.set()
+        manager.spawn(setter)
+        event.wait()
+        samples.append(monotonic() - stamp[0])
+    return samples
+
+class SlowStart(ThreadingService):
+    def do_start(self):
+        self.spawn(self.warmup)
+        return True
+
+    def warmup(self):
+        time.sleep(0.001)
+        self.became_ready = monotonic()
+        self.state("ready")
+
+def bench_ready(iterations):
+    samples = []
+    for _ in xrange(iterations):
+        service = SlowStart()
+        service.start()
+        samples.append(monotonic() - service.became_ready)
+        service.stop()
+    return samples
+
+def bench_sigterm(iterations):
+    samples = []
+    for _ in xrange(iterations):
+        service = ThreadingService()
+        service.async.signal(signal.SIGTERM, service.stop)
+        stamp = []
+        def killer():
+            time.sleep(0.005)
+            stamp.append(monotonic())
+            os.kill(os.getpid(), signal.SIGTERM)
+        threading.Thread(target=killer).start()
+        service.serve_forever()
+        samples.append(monotonic() - stamp[0])
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    return samples
+
+def main(iterations=200):
+    for name, bench in (("event set/wait", bench_event),
+                        ("state ready", bench_ready),
+                        ("SIGTERM stop", bench_sigterm)):
+        p50, p99 = percentiles(bench(iterations))
+        print "%- 16s p50 %7.3fms  p99 %7.3fms" % (name, p50, p99)
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -27,13 +27,14 @@ from .config import Config
 process = None
 settings = Config()
 Setting = lambda *args, **kwargs: settings.setting(*args, **kwargs)
+Binding = lambda *args, **kwargs: settings.binding(*args, **kwargs)
 
 # Set the singleton location for Config global context
 Config.singleton_attr = (sys.modules[__name__], 'settings')
 
 from .core import Service
 
-__all__ = ["Service", "Setting", "process", "settings"]
+__all__ = ["Service", "Setting", "Binding", "process", "settings"]
 __author__ = "Jeff Lindsay <jeff.lindsay@twilio.com>"
 __license__ = "MIT"
 __version__ = ".".join(map(str, (0, 6, 0)))
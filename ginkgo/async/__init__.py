@@ -14,11 +14,200 @@ class definition::
     class NonGeventService(Service):
         async = "path.to.different.module"
 
+Driver modules are imported once and cached by `load_driver`. Services can
+also opt into sharing a single root `AsyncManager` per driver by setting
+`async_shared`, in which case each service gets a lightweight task group from
+`shared_manager` instead of a full manager of its own. The root is started
+with the first of its task groups to start, and stopped with the last to
+stop.
+
+Every `AsyncManager` can also hand out named `SpawnPool` objects with
+`spawn_pool`, which bound how many tasks spawned through them run at once.
+Use them for fan-out work so a burst can't spawn without limit.
+
+Timeouts work the same way across drivers with the `timeout` context manager,
+which yields a `Deadline`. The current deadline is kept per task and tasks
+spawned by a `Service` inherit it, so nested work can check how much of the
+budget is left and give up early. Drivers that can interrupt blocking calls
+raise `DeadlineExceeded` when the deadline passes; the threading driver
+relies on code checking the deadline itself.
+
+CPU-bound calls can be offloaded to a warm pool of worker processes with
+`run_in_process`, which is provided by the `multiprocessing` module.
+
+For tests, the `simulated` module runs tasks on a virtual clock, so sleeps
+and timers take no real time and runs can be replayed exactly.
+
 """
+from __future__ import absolute_import
+
+import contextlib
+import functools
+import Queue
+import select
 import signal
+import sys
+# imported by name since the threading driver module shadows threading here
+from threading import Lock
+
 from ..core import BasicService
+from ..util import monotonic
+
+_drivers = {}
+_shared_managers = {}
+_process_pool_lock = Lock()
+_task_groups_lock = Lock()
+
+def load_driver(module_path):
+    """Returns the `AsyncManager` class of a driver module, importing it once"""
+    try:
+        return _drivers[module_path]
+    except KeyError:
+        __import__(module_path)
+        manager_class = getattr(sys.modules[module_path], 'AsyncManager')
+        _drivers[module_path] = manager_class
+        return manager_class
+
+def shared_manager(module_path):
+    """Returns the root `AsyncManager` shared by services using a driver"""
+    try:
+        return _shared_managers[module_path]
+    except KeyError:
+        manager = load_driver(module_path)()
+        _shared_managers[module_path] = manager
+        return manager
+
+class DeadlineExceeded(RuntimeError):
+    """Raised when work runs past its `Deadline`"""
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        super(DeadlineExceeded, self).__init__(
+            "Deadline of {}s exceeded".format(deadline.seconds))
+
+
+class Deadline(object):
+    """Point in time by which some work has to finish"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.expires = monotonic() + seconds
+
+    def remaining(self):
+        """Seconds left before the deadline, never less than zero"""
+        return max(self.expires - monotonic(), 0)
+
+    @property
+    def expired(self):
+        return monotonic() >= self.expires
+
+    def check(self):
+        """Raises `DeadlineExceeded` if the deadline has passed"""
+        if self.expired:
+            raise DeadlineExceeded(self)
+
+
+class PoolFull(RuntimeError):
+    """Raised when a pool, such as a `SpawnPool`, has no free slot in time"""
+
+
+class SpawnPool(object):
+    """Bounded set of tasks spawned through an `AsyncManager`
+
+    At most `size` tasks spawned through the pool run at once. `spawn`
+    blocks until a slot is free, `spawn_nowait` raises `PoolFull` if none
+    is, and `spawn_timeout` waits up to a number of seconds before raising
+    `PoolFull`. Slots are held in a queue from the manager, so waiting
+    works the same way under every driver. Tasks run under the spawning
+    task's deadline, and give their slot back however they finish, even
+    if they're killed before they start.
+    """
+
+    def __init__(self, manager, name, size):
+        self.manager = manager
+        self.name = name
+        self.size = size
+        self.in_flight = 0
+        self.spawned = 0
+        self.completed = 0
+        self.rejected = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self._slots = manager.queue(size)
+        self._lock = Lock()
+
+    @property
+    def counters(self):
+        """Live counts of in-flight, spawned, completed and rejected tasks,
+        and the total and longest time spent waiting for a slot"""
+        return dict(in_flight=self.in_flight, spawned=self.spawned,
+                    completed=self.completed, rejected=self.rejected,
+                    wait_time=self.wait_time, max_wait=self.max_wait)
+
+    def spawn(self, func, *args, **kwargs):
+        """Spawns once a slot is free, blocking until then"""
+        return self._spawn(True, None, func, args, kwargs)
+
+    def spawn_nowait(self, func, *args, **kwargs):
+        """Spawns if a slot is free, otherwise raises `PoolFull`"""
+        return self._spawn(False, None, func, args, kwargs)
+
+    def spawn_timeout(self, seconds, func, *args, **kwargs):
+        """Spawns once a slot is free, raising `PoolFull` after `seconds`"""
+        return self._spawn(True, seconds, func, args, kwargs)
+
+    def _spawn(self, block, timeout, func, args, kwargs):
+        started = monotonic()
+        try:
+            self._slots.put(None, block, timeout)
+        except Queue.Full:
+            with self._lock:
+                self.rejected += 1
+            raise PoolFull("Spawn pool '{}' is full ({} tasks)".format(
+                self.name, self.size))
+        waited = monotonic() - started
+        with self._lock:
+            self.in_flight += 1
+            self.spawned += 1
+            self.wait_time += waited
+            self.max_wait = max(self.max_wait, waited)
+        released = []
+        def release(*args):
+            with self._lock:
+                if released:
+                    return
+                released.append(True)
+                self.in_flight -= 1
+                self.completed += 1
+            self._slots.get_nowait()
+
+        func = self.manager.inherit_deadline(func)
+        try:
+            task = self.manager.spawn(self._run, release, func, args, kwargs)
+        except:
+            release()
+            raise
+        link = getattr(task, "link", None)
+        if link is not None:
+            # a task killed before it starts never runs _run
+            link(release)
+        return task
+
+    def _run(self, release, func, args, kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            release()
+
 
 class AbstractAsyncManager(BasicService):
+    # task-local storage for the current deadline, set by each driver
+    _context = None
+    # task groups of this manager that are running, and whether the first
+    # of them started it, in which case the last of them stops it
+    _running_groups = 0
+    _started_by_groups = False
+
     def spawn(self, func, *args, **kwargs):
         raise NotImplementedError()
 
@@ -42,3 +231,141 @@ class AbstractAsyncManager(BasicService):
 
     def init(self):
         pass
+
+    def pre_start(self):
+        root = getattr(self, "root", None)
+        if root is not None:
+            root._task_group_started()
+
+    def post_stop(self):
+        root = getattr(self, "root", None)
+        if root is not None:
+            root._task_group_stopped()
+
+    def _task_group_started(self):
+        """Starts this manager for its first running task group"""
+        with _task_groups_lock:
+            self._running_groups += 1
+            start = self.state.current in ["init", "stopped"]
+            if start:
+                self._started_by_groups = True
+        if start:
+            self.start()
+
+    def _task_group_stopped(self):
+        """Stops this manager once its last running task group stops, if
+        they started it"""
+        with _task_groups_lock:
+            self._running_groups -= 1
+            stop = self._running_groups == 0 and self._started_by_groups
+            if stop:
+                self._started_by_groups = False
+        if stop:
+            self.stop()
+
+    @property
+    def deadline(self):
+        """The `Deadline` the current task is running under, if any"""
+        return getattr(self._context, "deadline", None)
+
+    def timeout(self, seconds):
+        """Context manager running its block under a deadline of `seconds`
+
+        The deadline is never later than one already in effect.
+        """
+        return self.within(Deadline(seconds))
+
+    @contextlib.contextmanager
+    def within(self, deadline):
+        """Context manager running its block under an existing `Deadline`"""
+        previous = self.deadline
+        if previous is not None and previous.expires <= deadline.expires:
+            yield previous
+            return
+        self._context.deadline = deadline
+        cancel = self._interrupt_after(deadline.remaining(),
+                                       DeadlineExceeded(deadline))
+        try:
+            yield deadline
+        finally:
+            if cancel is not None:
+                cancel()
+            self._context.deadline = previous
+
+    def _interrupt_after(self, seconds, exception):
+        """Arranges for `exception` to be raised in the current task after
+        `seconds` if the driver can, returning a function cancelling it"""
+        return None
+
+    def inherit_deadline(self, func):
+        """Wraps `func` to run under the current task's deadline, if any"""
+        deadline = self.deadline
+        if deadline is None:
+            return func
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            with self.within(deadline):
+                return func(*args, **kwargs)
+        return wrapped
+
+    @property
+    def process_pool(self):
+        """The `ProcessPool` used by `run_in_process`, created on first use
+
+        It's a child of this manager so it's stopped along with it. Task
+        groups share their root manager's pool, so it's stopped along with
+        the root, which a shared root is once its last task group stops.
+        """
+        root = getattr(self, "root", None)
+        if root is not None:
+            return root.process_pool
+        with _process_pool_lock:
+            pool = self.__dict__.get("_process_pool")
+            if pool is None:
+                from .multiprocessing import ProcessPool
+                pool = self._process_pool = ProcessPool()
+                self.add_service(pool)
+        return pool
+
+    def run_in_process(self, func, *args, **kwargs):
+        """Calls `func` in a worker process and returns its result
+
+        The pool is started on the first call if it isn't already.
+        """
+        pool = self.process_pool
+        if pool.state.current not in ["ready", "starting"]:
+            pool.start()
+        return self._wait_result(pool.apply(func, args, kwargs))
+
+    def _wait_result(self, result):
+        """Blocks the current task until a multiprocessing result is ready"""
+        return result.get()
+
+    def _wait_readable(self, fd, timeout=None):
+        """Blocks the current task until `fd` is readable or `timeout` passes
+
+        Returns whether it's readable.
+        """
+        return bool(select.select([fd], [], [], timeout)[0])
+
+    def spawn_pool(self, name, size=None):
+        """Returns the named `SpawnPool`, creating it with `size` slots
+
+        The size is only used the first time a name is asked for.
+        """
+        pools = self.__dict__.setdefault("_spawn_pools", {})
+        if name not in pools:
+            if size is None:
+                raise RuntimeError(
+                    "Spawn pool '{}' needs a size to be created".format(name))
+            pools[name] = SpawnPool(self, name, size)
+        return pools[name]
+
+    def task_group(self):
+        """Returns a lightweight manager that spawns under this one
+
+        The task group shares this manager's primitives but tracks its own
+        tasks, so stopping it only stops what was spawned through it.
+
+        """
+        raise NotImplementedError()
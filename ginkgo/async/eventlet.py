@@ -1,26 +1,32 @@
 from __future__ import absolute_import
 
 import eventlet
+import eventlet.corolocal
 import eventlet.greenpool
 import eventlet.greenthread
 import eventlet.event
+import eventlet.green.select
 import eventlet.queue
 import eventlet.timeout
+import eventlet.tpool
 import eventlet.semaphore
 
-from ..core import BasicService, Service
 from ..util import defaultproperty
+from ..async import AbstractAsyncManager
 
-class AsyncManager(BasicService):
+class AsyncManager(AbstractAsyncManager):
     """Async primitives from eventlet"""
     stop_timeout = defaultproperty(int, 1)
+    _context = eventlet.corolocal.local()
 
     def __init__(self):
         self._greenlets = eventlet.greenpool.GreenPool()
+        self._timers = set()
 
     def do_stop(self):
         if eventlet.greenthread.getcurrent() in self._greenlets.coroutines_running:
             return eventlet.spawn(self.do_stop).join()
+        self._cancel_timers()
         if self._greenlets.running():
             with eventlet.timeout.Timeout(self.stop_timeout, False):
                 self._greenlets.waitall() # put in timeout for stop_timeout
@@ -34,9 +40,19 @@ class AsyncManager(BasicService):
 
     def spawn_later(self, seconds, func, *args, **kwargs):
         """Spawn a greenlet in the future under this service"""
-        def spawner():
-            self.spawn(func, *args, **kwargs)
-        return eventlet.spawn_after(seconds, spawner)
+        return self._spawn_after(seconds, self.spawn, func, *args, **kwargs)
+
+    def _spawn_after(self, seconds, spawn, *args, **kwargs):
+        # timers are tracked until they fire, so stopping can cancel them
+        timer = eventlet.spawn_after(seconds, spawn, *args, **kwargs)
+        self._timers.add(timer)
+        timer.link(lambda gt: self._timers.discard(gt))
+        return timer
+
+    def _cancel_timers(self):
+        for timer in list(self._timers):
+            timer.cancel()
+        self._timers.clear()
 
     def sleep(self, seconds):
         return eventlet.sleep(seconds)
@@ -50,6 +66,66 @@ class AsyncManager(BasicService):
     def lock(self, *args, **kwargs):
         return eventlet.semaphore.Semaphore(*args, **kwargs)
 
+    def _wait_result(self, result):
+        return eventlet.tpool.execute(result.get)
+
+    def _wait_readable(self, fd, timeout=None):
+        return bool(eventlet.green.select.select([fd], [], [], timeout)[0])
+
+    def _interrupt_after(self, seconds, exception):
+        return eventlet.timeout.Timeout(seconds, exception).cancel
+
+    def task_group(self):
+        return TaskGroup(self)
+
+class TaskGroup(AsyncManager):
+    """Green thread group for a service sharing a root `AsyncManager`
+
+    Green threads are spawned in the root manager's pool and tracked here, so
+    stopping either one stops them.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._threads = set()
+        self._timers = set()
+
+    def do_stop(self):
+        if eventlet.greenthread.getcurrent() in self._threads:
+            return eventlet.spawn(self.do_stop).wait()
+        self._cancel_timers()
+        if self._threads:
+            with eventlet.timeout.Timeout(self.stop_timeout, False):
+                for gt in list(self._threads):
+                    try:
+                        gt.wait()
+                    except Exception:
+                        pass
+            for gt in list(self._threads):
+                with eventlet.timeout.Timeout(1, False):
+                    gt.kill()
+
+    def spawn(self, func, *args, **kwargs):
+        return self._track(self.root.spawn(func, *args, **kwargs))
+
+    def _spawn_after(self, seconds, spawn, *args, **kwargs):
+        # tracked by the root too, so stopping either one cancels it
+        timer = self.root._spawn_after(seconds, spawn, *args, **kwargs)
+        self._timers.add(timer)
+        timer.link(lambda gt: self._timers.discard(gt))
+        return timer
+
+    def _track(self, gt):
+        self._threads.add(gt)
+        gt.link(lambda gt: self._threads.discard(gt))
+        return gt
+
+    def init(self):
+        self.root.init()
+
+    def task_group(self):
+        return self.root.task_group()
+
 class Event(eventlet.event.Event):
     def clear(self):
         if not self.ready():
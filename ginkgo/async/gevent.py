@@ -9,17 +9,43 @@ that should be used instead of the gevent classes. These wrapped classes adapt
 gevent servers to be Ginkgo services. They currently include:
 
     * StreamServer
+    * DatagramServer
     * WSGIServer (based on the pywsgi.WSGIServer)
     * BackdoorServer
 
+Each of them takes a listening socket from a `ginkgo.Binding` setting in
+place of an address. They can also be given an `fd_name` to use the socket
+of that name passed in by socket activation, such as from systemd, falling
+back to the listener given when there isn't one:
+
+    WSGIServer(("0.0.0.0", 8000), app, fd_name="http")
+
+Stopping one of them drains it rather than cutting connections off. It stops
+accepting, closes idle keep-alive connections, and gives the connections
+still active up to `grace_period` seconds to finish. Reloading closes idle
+keep-alive connections, and has the rest close after their current request.
+
+`StreamClient` is the client side counterpart, keeping a pool of connections
+to a single address that are checked out for each use.
+
 """
 from __future__ import absolute_import
 
+import collections
+import contextlib
+import errno
+import logging
+import random
+import socket
+
 import gevent
 import gevent.event
+import gevent.lock
+import gevent.local
 import gevent.queue
 import gevent.timeout
 import gevent.pool
+import gevent.select
 import gevent.baseserver
 import gevent.socket
 
@@ -28,12 +54,16 @@ import gevent.server
 import gevent.pywsgi
 
 from ..core import BasicService, Service
-from ..util import defaultproperty, ObjectWrapper
-from ..async import AbstractAsyncManager
+from ..util import (defaultproperty, listen_fds, monotonic, ObjectWrapper,
+                    socket_fromfd)
+from ..async import AbstractAsyncManager, PoolFull
+
+logger = logging.getLogger(__name__)
 
 class AsyncManager(AbstractAsyncManager):
     """Async primitives from gevent"""
     stop_timeout = defaultproperty(int, 1)
+    _context = gevent.local.local()
 
     def __init__(self):
         self._greenlets = gevent.pool.Group()
@@ -67,14 +97,58 @@ class AsyncManager(AbstractAsyncManager):
         return gevent.event.Event(*args, **kwargs)
 
     def lock(self, *args, **kwargs):
-        return gevent.coros.Semaphore(*args, **kwargs)
+        return gevent.lock.Semaphore(*args, **kwargs)
 
     def signal(self, *args, **kwargs):
-        gevent.signal(*args, **kwargs)
+        # gevent.signal is a module in newer versions of gevent
+        handler = getattr(gevent, "signal_handler", None) or gevent.signal
+        handler(*args, **kwargs)
 
     def init(self):
         gevent.reinit()
 
+    def _wait_result(self, result):
+        return gevent.get_hub().threadpool.apply(result.get)
+
+    def _wait_readable(self, fd, timeout=None):
+        return bool(gevent.select.select([fd], [], [], timeout)[0])
+
+    def _interrupt_after(self, seconds, exception):
+        timeout = gevent.Timeout(seconds, exception)
+        timeout.start()
+        return timeout.cancel
+
+    def task_group(self):
+        return TaskGroup(self)
+
+
+class TaskGroup(AsyncManager):
+    """Greenlet group for a service sharing a root `AsyncManager`
+
+    Greenlets are tracked both here and in the root manager's group, so
+    stopping either one stops them.
+    """
+
+    def __init__(self, root):
+        super(TaskGroup, self).__init__()
+        self.root = root
+
+    def spawn(self, func, *args, **kwargs):
+        g = super(TaskGroup, self).spawn(func, *args, **kwargs)
+        self.root._greenlets.add(g)
+        return g
+
+    def spawn_later(self, seconds, func, *args, **kwargs):
+        g = super(TaskGroup, self).spawn_later(seconds, func, *args, **kwargs)
+        self.root._greenlets.add(g)
+        return g
+
+    def init(self):
+        self.root.init()
+
+    def task_group(self):
+        return self.root.task_group()
+
 
 class ServerWrapper(Service):
     """Wrapper for gevent servers that are based on gevent.baseserver.BaseServer
@@ -112,42 +186,517 @@ class ServerWrapper(Service):
         self.wrapped.stop()
 
 class StreamClient(Service):
-    """StreamServer-like TCP client service"""
-
-    def __init__(self, address, handler=None):
+    """StreamServer-like TCP client service with a pool of connections
+
+    Connections are checked out, used, and checked back in, most easily
+    with the `connection` context manager:
+
+        client = StreamClient(("backend", 9000), max_connections=20)
+        with client.connection(timeout=5) as sock:
+            sock.sendall(request)
+
+    At least `min_connections` are kept open, and no more than
+    `max_connections`. Checking out waits up to the timeout for one to be
+    free, raising `PoolFull` if none is. Idle connections are checked
+    every `health_interval` seconds, and closed if the other end has hung
+    up, or if they've been idle for `idle_timeout` and aren't needed to
+    keep `min_connections` open. Failed connects are retried with jittered
+    exponential backoff from `min_backoff` up to `max_backoff` seconds.
+
+    Given a `handler`, or when `handle` is overridden, a connection is
+    checked out and handled when the service starts, as `StreamClient` has
+    always done, and another one is handled whenever that connection drops.
+    """
+    connect_timeout = defaultproperty(float, 5)
+    health_interval = defaultproperty(float, 5)
+    idle_timeout = defaultproperty(float, 60)
+    min_backoff = defaultproperty(float, 0.1)
+    max_backoff = defaultproperty(float, 10)
+
+    def __init__(self, address, handler=None, min_connections=0,
+                 max_connections=10):
         self.address = address
         self.handler = handler
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self._slots = gevent.lock.Semaphore(max_connections)
+        self._idle = collections.deque()
+        self._failures = 0
+        self.open = self.in_use = self.waiting = 0
+        self.connects = self.connect_failures = 0
+        self.checkouts = self.timeouts = self.discarded = 0
+
+    @property
+    def counters(self):
+        """Open, idle and in use connections, checkouts waiting, and totals
+        of connects, failed connects, checkouts, timeouts and discards"""
+        return dict(open=self.open, idle=len(self._idle), in_use=self.in_use,
+                    waiting=self.waiting, connects=self.connects,
+                    connect_failures=self.connect_failures,
+                    checkouts=self.checkouts, timeouts=self.timeouts,
+                    discarded=self.discarded)
 
     def do_start(self):
-        self.spawn(self.connect)
+        self.spawn(self._maintain)
+        if self.handler or type(self).handle != StreamClient.handle:
+            self.spawn(self._handle_forever)
+
+    def do_stop(self):
+        while self._idle:
+            self._close(self._idle.pop()[0])
 
     def connect(self):
-        self.handle(
-            gevent.socket.create_connection(self.address))
+        """Checks out a connection and handles it, closing it afterwards"""
+        sock = self.checkout()
+        try:
+            self.handle(sock)
+        finally:
+            self.checkin(sock, discard=True)
+
+    def _open(self):
+        """Opens a new connection, retrying with backoff until it connects"""
+        while True:
+            try:
+                sock = gevent.socket.create_connection(
+                    self.address, self.connect_timeout)
+            except socket.error:
+                self.connect_failures += 1
+                self._failures += 1
+                backoff = min(self.min_backoff * 2 ** (self._failures - 1),
+                              self.max_backoff)
+                self.async.sleep(backoff * random.uniform(0.5, 1.5))
+                continue
+            self._failures = 0
+            self.connects += 1
+            return sock
+
+    def checkout(self, timeout=None):
+        """Takes a connection from the pool, waiting up to `timeout`"""
+        self.waiting += 1
+        try:
+            acquired = self._slots.acquire(timeout=timeout)
+        finally:
+            self.waiting -= 1
+        if not acquired:
+            self.timeouts += 1
+            raise PoolFull("No connection to {} free within {}s".format(
+                self.address, timeout))
+        try:
+            sock = self._take_idle()
+            if sock is None:
+                self.open += 1
+                try:
+                    with gevent.Timeout(timeout, PoolFull(
+                            "Unable to connect to {} within {}s".format(
+                                self.address, timeout))):
+                        sock = self._open()
+                except:
+                    self.open -= 1
+                    raise
+        except PoolFull:
+            self.timeouts += 1
+            self._slots.release()
+            raise
+        except:
+            self._slots.release()
+            raise
+        self.checkouts += 1
+        self.in_use += 1
+        return sock
+
+    def checkin(self, sock, discard=False):
+        """Returns a connection to the pool, or closes it if `discard`"""
+        self.in_use -= 1
+        if discard:
+            self._close(sock)
+        else:
+            self._idle.append((sock, monotonic()))
+        self._slots.release()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """Checks out a connection for the block, discarding it on errors"""
+        sock = self.checkout(timeout)
+        try:
+            yield sock
+        except:
+            self.checkin(sock, discard=True)
+            raise
+        self.checkin(sock)
+
+    def check(self, sock):
+        """Returns whether an idle connection is still usable"""
+        timeout = sock.gettimeout()
+        sock.settimeout(0)
+        try:
+            return sock.recv(1, socket.MSG_PEEK) != ""
+        except socket.error, e:
+            return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+        finally:
+            sock.settimeout(timeout)
 
     def handle(self, socket):
         if self.handler:
             self.handler(socket)
 
+    def _take_idle(self):
+        while self._idle:
+            sock, _ = self._idle.pop()
+            if self.check(sock):
+                return sock
+            self._close(sock)
+
+    def _close(self, sock):
+        self.open -= 1
+        self.discarded += 1
+        sock.close()
+
+    def _handle_forever(self):
+        while True:
+            try:
+                self.connect()
+            except Exception:
+                logger.exception("Error handling connection to {}".format(
+                    self.address))
+            self.async.sleep(self.min_backoff)
+
+    def _maintain(self):
+        while True:
+            now = monotonic()
+            for entry in list(self._idle):
+                sock, idle_since = entry
+                expired = now - idle_since > self.idle_timeout and \
+                    self.open > self.min_connections
+                if expired or not self.check(sock):
+                    self._idle.remove(entry)
+                    self._close(sock)
+            while self.open < min(self.min_connections, self.max_connections):
+                self.open += 1
+                try:
+                    sock = self._open()
+                except:
+                    self.open -= 1
+                    raise
+                self._idle.appendleft((sock, monotonic()))
+            self.async.sleep(self.health_interval)
+
 class _ServerWrapper(Service, ObjectWrapper):
     server = state = __subject__ = None
     _children = []
-
-    def __init__(self, *args, **kwargs):
-        self.server = self.server(*args, **kwargs)
+    grace_period = 10
+    cut_off = 0
+    _stop_timeout = None
+
+    def __init__(self, listener, *args, **kwargs):
+        self.grace_period = kwargs.pop("grace_period", self.grace_period)
+        fd_name = kwargs.pop("fd_name", None)
+        if fd_name is not None and listen_fds().get(fd_name):
+            listener = listen_fds()[fd_name][0]
+        if isinstance(listener, socket.socket):
+            # servers close their socket when stopped, so they're given a
+            # duplicate to keep sockets from a Binding or activation open
+            listener = socket_fromfd(listener.fileno(),
+                                     listener.family, listener.type)
+            listener.setblocking(0)
+        self.server = self.server(listener, *args, **kwargs)
+        if kwargs.get("spawn", "default") == "default":
+            # connections are tracked in a pool so they can be drained
+            self.server.set_spawn(gevent.pool.Pool())
         ObjectWrapper.__init__(self, self.server)
 
     def do_start(self):
         self.spawn(self.server.start)
 
+    def stop(self, timeout=None):
+        self._stop_timeout = timeout
+        super(_ServerWrapper, self).stop(timeout)
+
     def do_stop(self):
-        self.server.stop()
+        grace_period = self.grace_period
+        if self._stop_timeout is not None:
+            grace_period = min(grace_period, self._stop_timeout)
+        self.drain(grace_period)
+
+    def do_reload(self):
+        self.close_idle()
+
+    @property
+    def connections(self):
+        """Number of connections being handled"""
+        return len(self.server.pool or [])
+
+    def close_idle(self):
+        """Closes idle keep-alive connections, where the server knows them
+
+        Connections that are handling a request are closed after it instead.
+        """
+        close_idle = getattr(self.server, "close_idle", None)
+        if close_idle is not None:
+            close_idle()
+
+    def drain(self, grace_period):
+        """Stops accepting and waits for active connections to finish
+
+        Connections still active after `grace_period` seconds are cut off,
+        and their number is kept in `cut_off`.
+        """
+        self.server.close()
+        self.close_idle()
+        pool = self.server.pool
+        if pool is not None:
+            pool.join(timeout=grace_period)
+            self.cut_off = len(pool)
+            if self.cut_off:
+                logger.warn("Cut off {} connections to {} after {}s.".format(
+                    self.cut_off, self.service_name, grace_period))
+        self.server.stop(timeout=0)
+        return self.cut_off
 
 class StreamServer(_ServerWrapper):
     server = gevent.server.StreamServer
 
+class DrainingWSGIHandler(gevent.pywsgi.WSGIHandler):
+    """WSGI handler that lets its server close it between requests
+
+    Handlers passed to `WSGIServer` as `handler_class` should subclass this
+    for keep-alive connections to be drained.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(DrainingWSGIHandler, self).__init__(*args, **kwargs)
+        self.generation = self.server.generation
+        self.requests = 0
+
+    def read_requestline(self):
+        # only connections that have had a request are idle, new ones are
+        # given the chance to send theirs
+        idle = self.requests > 0
+        if idle and self.generation != self.server.generation:
+            return ""
+        if idle:
+            self.server.idle.add(self.socket)
+        try:
+            return super(DrainingWSGIHandler, self).read_requestline()
+        finally:
+            if idle:
+                self.server.idle.discard(self.socket)
+
+    def handle_one_response(self):
+        self.requests += 1
+        return super(DrainingWSGIHandler, self).handle_one_response()
+
+    def start_response(self, status, headers, exc_info=None):
+        if self.generation != self.server.generation:
+            self.close_connection = True
+            # pywsgi only says so itself for HTTP/1.0
+            if self.request_version != "HTTP/1.0" and not any(
+                    name.lower() == "connection" for name, _ in headers):
+                headers = list(headers) + [("Connection", "close")]
+        return super(DrainingWSGIHandler, self).start_response(
+            status, headers, exc_info)
+
+class _DrainingWSGIServer(gevent.pywsgi.WSGIServer):
+    handler_class = DrainingWSGIHandler
+
+    def __init__(self, *args, **kwargs):
+        super(_DrainingWSGIServer, self).__init__(*args, **kwargs)
+        self.generation = 0
+        self.idle = set()
+
+    def close_idle(self):
+        self.generation += 1
+        for sock in list(self.idle):
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+class AdaptiveLimit(object):
+    """Concurrency limit that adapts to request latency (AIMD)
+
+    The limit grows by about one for every `limit` requests completed
+    without congestion while at least half of it is in use, and is cut by
+    `backoff` when a request shows congestion, meaning it took longer than
+    `latency_target`. Without a target, congestion is taken to be latency
+    over `tolerance` times the lowest latency seen recently. Only requests
+    started after the last cut can cut it again, so a burst of slow
+    requests counts once.
+    """
+
+    def __init__(self, initial=20, min_limit=1, max_limit=1000,
+                 latency_target=None, tolerance=2.0, backoff=0.9):
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.baseline = None
+        self.last_cut = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.congested = 0
+        self.shed = 0
+
+    @property
+    def counters(self):
+        """Current limit, in-flight requests, and totals of completed,
+        congested and shed requests"""
+        return dict(limit=int(self.limit), in_flight=self.in_flight,
+                    completed=self.completed, congested=self.congested,
+                    shed=self.shed)
+
+    def acquire(self):
+        """Takes a slot for a request, or counts it as shed if over limit"""
+        if self.in_flight >= int(self.limit):
+            self.shed += 1
+            return False
+        self.in_flight += 1
+        return True
+
+    def release(self, started):
+        """Frees the slot of a request started at `started`"""
+        now = monotonic()
+        latency = now - started
+        in_use = self.in_flight
+        self.in_flight -= 1
+        self.completed += 1
+        if self.baseline is None or latency < self.baseline:
+            self.baseline = latency
+        else:
+            # drifts up so the baseline can follow a slower service
+            self.baseline *= 1.001
+        target = self.latency_target or self.baseline * self.tolerance
+        if latency > target:
+            self.congested += 1
+            if started >= self.last_cut:
+                self.limit = max(self.limit * self.backoff, self.min_limit)
+                self.last_cut = now
+        elif in_use * 2 >= self.limit:
+            self.limit = min(self.limit + 1.0 / self.limit, self.max_limit)
+
+    def wsgi(self, application, retry_after=1):
+        """Wraps a WSGI application, answering 503 when over the limit"""
+        retry_after = str(retry_after)
+
+        def limited(environ, start_response):
+            if not self.acquire():
+                start_response("503 Service Unavailable", [
+                    ("Retry-After", retry_after),
+                    ("Content-Length", "0"),
+                    ("Connection", "close")])
+                return []
+            started = monotonic()
+            try:
+                result = application(environ, start_response)
+            except:
+                self.release(started)
+                raise
+            return _ReleasingIterable(result, self.release, started)
+        return limited
+
+class _ReleasingIterable(object):
+    def __init__(self, result, release, started):
+        self.result = result
+        self.release = release
+        self.started = started
+
+    def __iter__(self):
+        return iter(self.result)
+
+    def close(self):
+        try:
+            if hasattr(self.result, "close"):
+                self.result.close()
+        finally:
+            self.release(self.started)
+
 class WSGIServer(_ServerWrapper):
-    server = gevent.pywsgi.WSGIServer
+    """WSGI server service, optionally with adaptive load shedding
+
+    Pass `concurrency_limit=True`, or an `AdaptiveLimit` to tune it, to
+    answer requests over the limit right away with 503 and a Retry-After
+    of `retry_after` seconds. The limit's state is in `counters`.
+    """
+    server = _DrainingWSGIServer
+    concurrency_limit = None
+
+    def __init__(self, listener, application=None, *args, **kwargs):
+        limit = kwargs.pop("concurrency_limit", None)
+        retry_after = kwargs.pop("retry_after", 1)
+        if limit is True:
+            limit = AdaptiveLimit()
+        self.concurrency_limit = limit
+        application = application or kwargs.pop("application", None)
+        if limit is not None and application is not None:
+            application = limit.wsgi(application, retry_after)
+        super(WSGIServer, self).__init__(
+            listener, application, *args, **kwargs)
+
+    @property
+    def counters(self):
+        if self.concurrency_limit is None:
+            return {}
+        return self.concurrency_limit.counters
+
+class _Batch(list):
+    buffers = None
+
+class _BatchDatagramServer(gevent.server.DatagramServer):
+    def __init__(self, *args, **kwargs):
+        self.batch_size = kwargs.pop("batch_size", None)
+        self.buffer_size = kwargs.pop("buffer_size", 8192)
+        self._buffers = []
+        super(_BatchDatagramServer, self).__init__(*args, **kwargs)
+
+    def do_read(self):
+        if not self.batch_size:
+            try:
+                return self._socket.recvfrom(self.buffer_size)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+        batch = _Batch()
+        batch.buffers = self._buffers.pop() if self._buffers else []
+        for i in xrange(self.batch_size):
+            if i == len(batch.buffers):
+                batch.buffers.append(bytearray(self.buffer_size))
+            buf = batch.buffers[i]
+            try:
+                size, address = self._socket.recvfrom_into(buf)
+            except socket.error, e:
+                if batch or e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self._buffers.append(batch.buffers)
+                raise
+            batch.append((memoryview(buf)[:size], address))
+        if not batch:
+            self._buffers.append(batch.buffers)
+            return
+        return (batch,)
+
+    def do_close(self, *args):
+        if self.batch_size:
+            self._buffers.append(args[0].buffers)
+
+class DatagramServer(_ServerWrapper):
+    """UDP server, calling its handler with each datagram and its address
+
+    Given a `batch_size`, all pending datagrams are read whenever the socket
+    is readable, and the handler is called with lists of up to `batch_size`
+    of them in one greenlet, rather than one greenlet per datagram. Each
+    datagram in a batch is a `memoryview` into a receive buffer that's reused
+    once the handler returns, so use `tobytes()` on any that need to be kept
+    past then. Datagrams longer than `buffer_size` are truncated.
+
+        def handle(batch):
+            for data, address in batch:
+                ...
+        DatagramServer(("0.0.0.0", 8125), handle, batch_size=64)
+
+    """
+    server = _BatchDatagramServer
 
 class BackdoorServer(_ServerWrapper):
     server = gevent.backdoor.BackdoorServer
@@ -0,0 +1,127 @@
+"""Multiprocessing async module
+
+This module provides `ProcessPool`, a service keeping a warm pool of worker
+processes for CPU-bound work that would otherwise be held back by the GIL.
+Every `AsyncManager` can offload a call to one with `run_in_process`, which
+waits for the result in whatever way suits its driver. The `AsyncManager`
+here is the threading manager with a process pool that's started along with
+it, for services that mostly do CPU-bound work.
+
+Functions run in worker processes and their arguments have to be picklable,
+so use module level functions. Large buffers can be wrapped in
+`SharedBuffer` to pass them through shared memory instead of a pipe.
+
+"""
+from __future__ import absolute_import
+
+import mmap
+import multiprocessing
+import os
+import signal
+import tempfile
+import threading
+
+from .. import Setting
+from ..core import BasicService
+from ..util import defaultproperty
+from .threading import AsyncManager as ThreadingAsyncManager
+
+_shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+def _attach(path, size, transfer):
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    if transfer:
+        os.unlink(path)
+    return buf
+
+class SharedBuffer(object):
+    """Bytes passed between processes through shared memory
+
+    The data is written once to a file in shared memory, and only its path
+    is pickled. The receiving process gets a read-only `mmap` of the data.
+    Close the buffer once it's no longer needed, or create it with
+    `transfer=True` to have it removed when it's received, such as when
+    returning one from a worker process.
+    """
+
+    def __init__(self, data, transfer=False):
+        self.size = len(data)
+        self.transfer = transfer
+        fd, self.path = tempfile.mkstemp(prefix="ginkgo-", dir=_shm_dir)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+
+    def __reduce__(self):
+        return _attach, (self.path, self.size, self.transfer)
+
+    def close(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+def _init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.set_wakeup_fd(-1)
+
+class ProcessPool(BasicService):
+    """Warm pool of worker processes for CPU-bound calls
+
+    The worker processes are forked when the service starts and are stopped
+    with it, waiting up to `stop_timeout` for running calls to finish
+    before terminating them.
+    """
+    stop_timeout = defaultproperty(int, 1)
+
+    processes = Setting("processes", default=None, help="""\
+        Worker processes kept for run_in_process calls. Defaults to the
+        number of CPUs.
+        """)
+
+    def __init__(self):
+        self._pool = None
+
+    def do_start(self):
+        self._pool = multiprocessing.Pool(
+            self.processes or multiprocessing.cpu_count(), _init_worker)
+
+    def do_stop(self):
+        pool, self._pool = self._pool, None
+        pool.close()
+        joiner = threading.Thread(target=pool.join)
+        joiner.daemon = True
+        joiner.start()
+        joiner.join(self.stop_timeout)
+        if joiner.is_alive():
+            pool.terminate()
+
+    def apply(self, func, args=(), kwargs=None):
+        """Queues a call on a worker process, returning an `AsyncResult`"""
+        if self._pool is None:
+            raise RuntimeWarning("Process pool must be started to call this.")
+        return self._pool.apply_async(func, args, kwargs or {})
+
+class AsyncManager(ThreadingAsyncManager):
+    """Async manager for CPU-bound services
+
+    Threads are used for spawned tasks and primitives, as with the threading
+    manager. The process pool is a child from the start, so it's started
+    with this manager instead of on the first `run_in_process` call.
+    """
+    # CPU-bound work goes to the process pool, so the GIL isn't a concern
+    gil_warning = False
+
+    def __init__(self):
+        super(AsyncManager, self).__init__()
+        self.process_pool  # created now so it starts with this manager
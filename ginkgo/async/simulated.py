@@ -0,0 +1,527 @@
+"""Simulated async module
+
+This module provides an `AsyncManager` that runs tasks cooperatively on a
+virtual clock, for testing services without waiting in real time. Sleeps,
+timeouts and `spawn_later` timers all go by the clock, which jumps straight
+to the next timer whenever every task is blocked, so a test of a service
+that sleeps for an hour finishes as soon as the work in between is done.
+
+Managers share the current `Simulation`, returned by `simulation()`. Tasks
+only run while the main code is blocked on one of the manager's primitives,
+or while it runs the simulation itself:
+
+    sim = simulated.reset()
+    service.start()
+    sim.advance(60)         # runs everything due in the next minute
+    sim.run_until_idle()    # runs what's runnable without moving the clock
+
+Tasks runnable at the same time run in the order they became runnable, so a
+test runs the same way every time. A simulation started with a `seed` picks
+among them at random instead, and runs the same way for the same seed, to
+try other interleavings. If the main code blocks on something that no task
+or timer can wake, `Deadlock` is raised instead of hanging.
+
+Only time given to the manager is virtual. `monotonic()`, and so the time a
+`Deadline` has left, is still real time, although deadlines interrupt tasks
+on the virtual clock. Blocking calls that aren't the manager's, like socket
+I/O, block the whole simulation.
+
+"""
+from __future__ import absolute_import
+
+import collections
+import heapq
+import itertools
+import random
+import select
+import traceback
+import weakref
+from Queue import Empty, Full
+
+import greenlet
+
+from ..util import defaultproperty
+from ..async import AbstractAsyncManager
+
+_timed_out = object()
+
+class Deadlock(RuntimeError):
+    """Raised when the main code blocks on something nothing can wake"""
+
+class Timer(object):
+    """Callback scheduled on the virtual clock"""
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class Simulation(object):
+    """Virtual clock and cooperative scheduler for simulated tasks
+
+    Tasks are greenlets under the simulation's own greenlet, which runs
+    ready callbacks in order and then moves the clock to the next timer.
+    """
+
+    def __init__(self, seed=None):
+        self.now = 0.0
+        self.random = None if seed is None else random.Random(seed)
+        self.greenlet = greenlet.greenlet(self._loop)
+        self._ready = collections.deque()
+        self._timers = []
+        self._sequence = itertools.count()
+        self._main = None
+        self._until = None
+        self._blocked = False
+
+    def schedule(self, callback, *args):
+        """Runs `callback` once what's already runnable has run"""
+        self._ready.append((callback, args))
+
+    def call_later(self, seconds, callback, *args):
+        """Runs `callback` after `seconds` on the virtual clock"""
+        timer = Timer(self.now + max(seconds, 0), callback, args)
+        heapq.heappush(self._timers,
+                       (timer.when, next(self._sequence), timer))
+        return timer
+
+    def run(self, until=None):
+        """Runs tasks and timers up to virtual time `until`, moving the clock
+        there, or until there's nothing left to run"""
+        self._enter(until, blocked=False)
+
+    def advance(self, seconds):
+        """Runs everything due in the next `seconds` of virtual time"""
+        self.run(self.now + seconds)
+
+    def run_until_idle(self):
+        """Runs everything runnable without moving the clock"""
+        self.run(self.now)
+
+    def wait(self):
+        """Blocks the current task until it's switched back to"""
+        current = greenlet.getcurrent()
+        if current is self.greenlet:
+            raise RuntimeError("Unable to block in a simulation callback")
+        if current.parent is self.greenlet:
+            return self.greenlet.switch()
+        return self._enter(None, blocked=True)
+
+    def _enter(self, until, blocked):
+        if self._main is not None:
+            raise RuntimeError("Simulation is already being run")
+        self._main = greenlet.getcurrent()
+        self._until = until
+        self._blocked = blocked
+        try:
+            return self.greenlet.switch()
+        finally:
+            self._main = None
+
+    def _next(self):
+        if self._ready:
+            if self.random is None:
+                return self._ready.popleft()
+            index = self.random.randrange(len(self._ready))
+            callback = self._ready[index]
+            del self._ready[index]
+            return callback
+        while self._timers:
+            when, _, timer = self._timers[0]
+            if self._until is not None and when > self._until:
+                break
+            heapq.heappop(self._timers)
+            if not timer.cancelled:
+                self.now = max(self.now, when)
+                return timer.callback, timer.args
+
+    def _loop(self):
+        while True:
+            callback = self._next()
+            if callback is None:
+                self._idle()
+                continue
+            func, args = callback
+            try:
+                func(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def _idle(self):
+        if self._until is not None:
+            self.now = max(self.now, self._until)
+        if self._blocked:
+            self._main.throw(Deadlock("Blocked with no task or timer left "
+                "to wake it at {}s of virtual time".format(self.now)))
+        else:
+            self._main.switch()
+
+_simulation = None
+
+def simulation():
+    """Returns the `Simulation` used by managers created from now on"""
+    global _simulation
+    if _simulation is None:
+        _simulation = Simulation()
+    return _simulation
+
+def reset(seed=None):
+    """Starts a new `Simulation` for managers created from now on"""
+    global _simulation
+    _simulation = Simulation(seed)
+    return _simulation
+
+class Waiter(object):
+    """Blocks one task until it's woken or times out"""
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.greenlet = None
+
+    def switch(self, value=None):
+        g, self.greenlet = self.greenlet, None
+        if g is not None:
+            g.switch(value)
+
+    def get(self, timeout=None):
+        """Blocks until woken, returning what it was woken with, or
+        `_timed_out` after `timeout`"""
+        self.greenlet = greenlet.getcurrent()
+        timer = None
+        if timeout is not None:
+            timer = self.sim.call_later(timeout, self.switch, _timed_out)
+        try:
+            return self.sim.wait()
+        finally:
+            self.greenlet = None
+            if timer is not None:
+                timer.cancel()
+
+class Task(object):
+    """Greenlet run by a `Simulation`"""
+
+    def __init__(self, sim, func, args, kwargs):
+        self.sim = sim
+        self.greenlet = greenlet.greenlet(self._run, parent=sim.greenlet)
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+        self.exception = None
+        self.dead = False
+        self._timer = None
+        self._waiters = []
+        self._links = []
+
+    def start(self):
+        self.sim.schedule(self._switch_in)
+
+    def start_later(self, seconds):
+        self._timer = self.sim.call_later(seconds, self._switch_in)
+
+    def _switch_in(self):
+        self._timer = None
+        if not self.dead:
+            self.greenlet.switch()
+
+    def _run(self):
+        try:
+            self.value = self.func(*self.args, **self.kwargs)
+        except greenlet.GreenletExit:
+            pass
+        except Exception, e:
+            self.exception = e
+            traceback.print_exc()
+        finally:
+            self._finish()
+
+    def _finish(self):
+        self.dead = True
+        for waiter in self._waiters:
+            self.sim.schedule(waiter.switch)
+        for callback in self._links:
+            callback(self)
+
+    def link(self, callback):
+        """Calls `callback` with this task once it's finished"""
+        if self.dead:
+            callback(self)
+        else:
+            self._links.append(callback)
+
+    def ready(self):
+        return self.dead
+
+    def join(self, timeout=None):
+        """Waits up to `timeout` for the task to finish"""
+        if self.dead:
+            return
+        waiter = Waiter(self.sim)
+        self._waiters.append(waiter)
+        try:
+            waiter.get(timeout)
+        finally:
+            self._waiters.remove(waiter)
+
+    def kill(self, exception=greenlet.GreenletExit, block=True, timeout=None):
+        """Raises `exception` in the task, by default waiting for it to end
+
+        A task that hasn't started yet is finished without running.
+        """
+        if self.dead:
+            return
+        if not self.greenlet:
+            if self._timer is not None:
+                self._timer.cancel()
+            self._finish()
+            return
+        if greenlet.getcurrent() is self.greenlet:
+            raise exception
+        self.sim.schedule(self._throw, exception)
+        if block:
+            self.join(timeout)
+
+    def _throw(self, exception):
+        if self.greenlet and not self.dead:
+            self.greenlet.throw(exception)
+
+class Local(object):
+    """Attributes local to the current task"""
+
+    def __init__(self):
+        object.__setattr__(self, "_attrs", weakref.WeakKeyDictionary())
+
+    def __getattr__(self, name):
+        try:
+            return self._attrs[greenlet.getcurrent()][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self._attrs.setdefault(greenlet.getcurrent(), {})[name] = value
+
+class Queue(object):
+    """Queue for simulated tasks, raising the `Queue` module's exceptions"""
+
+    def __init__(self, sim, maxsize=0):
+        self.sim = sim
+        self.maxsize = maxsize
+        self.items = collections.deque()
+        self._getters = collections.deque()
+        self._putters = collections.deque()
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    def full(self):
+        return 0 < self.maxsize <= len(self.items)
+
+    def _block(self, waiters, timeout):
+        waiter = Waiter(self.sim)
+        waiters.append(waiter)
+        try:
+            waiter.get(timeout)
+        finally:
+            if waiter in waiters:
+                waiters.remove(waiter)
+
+    def _wake(self, waiters):
+        if waiters:
+            self.sim.schedule(waiters.popleft().switch)
+
+    def get(self, block=True, timeout=None):
+        expires = None if timeout is None else self.sim.now + timeout
+        while not self.items:
+            if not block or expires is not None and self.sim.now >= expires:
+                raise Empty
+            remaining = None if expires is None else expires - self.sim.now
+            self._block(self._getters, remaining)
+        item = self.items.popleft()
+        self._wake(self._putters)
+        return item
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def put(self, item, block=True, timeout=None):
+        expires = None if timeout is None else self.sim.now + timeout
+        while self.full():
+            if not block or expires is not None and self.sim.now >= expires:
+                raise Full
+            remaining = None if expires is None else expires - self.sim.now
+            self._block(self._putters, remaining)
+        self.items.append(item)
+        self._wake(self._getters)
+
+    def put_nowait(self, item):
+        return self.put(item, False)
+
+class Event(object):
+    """Event for simulated tasks"""
+
+    def __init__(self, sim):
+        self.sim = sim
+        self._flag = False
+        self._waiters = []
+
+    def is_set(self):
+        return self._flag
+    isSet = is_set
+
+    def set(self):
+        self._flag = True
+        for waiter in self._waiters:
+            self.sim.schedule(waiter.switch)
+        del self._waiters[:]
+
+    def clear(self):
+        self._flag = False
+
+    def wait(self, timeout=None):
+        if not self._flag:
+            waiter = Waiter(self.sim)
+            self._waiters.append(waiter)
+            try:
+                waiter.get(timeout)
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        return self._flag
+
+class Semaphore(object):
+    """Semaphore for simulated tasks, used as the manager's lock"""
+
+    def __init__(self, sim, value=1):
+        self.sim = sim
+        self.counter = value
+        self._waiters = collections.deque()
+
+    def acquire(self, blocking=True, timeout=None):
+        expires = None if timeout is None else self.sim.now + timeout
+        while self.counter <= 0:
+            if not blocking or expires is not None and self.sim.now >= expires:
+                return False
+            waiter = Waiter(self.sim)
+            self._waiters.append(waiter)
+            try:
+                waiter.get(None if expires is None else expires - self.sim.now)
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self.counter -= 1
+        return True
+
+    def release(self):
+        self.counter += 1
+        if self._waiters:
+            self.sim.schedule(self._waiters.popleft().switch)
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, type, value, traceback):
+        self.release()
+
+class AsyncManager(AbstractAsyncManager):
+    """Async primitives on a simulated clock
+
+    Stopping waits up to `stop_timeout` of virtual time for tasks to finish
+    and then kills them, as the gevent manager does.
+    """
+    stop_timeout = defaultproperty(int, 1)
+    _context = Local()
+
+    def __init__(self):
+        self.simulation = simulation()
+        self._tasks = set()
+
+    def do_stop(self):
+        current = greenlet.getcurrent()
+        tasks = [t for t in self._tasks if t.greenlet is not current]
+        expires = self.simulation.now + self.stop_timeout
+        for task in tasks:
+            task.join(max(expires - self.simulation.now, 0))
+        for task in tasks:
+            task.kill(block=True, timeout=1)
+
+    def _task(self, func, args, kwargs):
+        task = Task(self.simulation, func, args, kwargs)
+        self._tasks.add(task)
+        task.link(self._tasks.discard)
+        return task
+
+    def spawn(self, func, *args, **kwargs):
+        """Spawn a task under this service"""
+        task = self._task(func, args, kwargs)
+        task.start()
+        return task
+
+    def spawn_later(self, seconds, func, *args, **kwargs):
+        """Spawn a task after `seconds` of virtual time under this service"""
+        task = self._task(func, args, kwargs)
+        task.start_later(seconds)
+        return task
+
+    def sleep(self, seconds):
+        waiter = Waiter(self.simulation)
+        if seconds > 0:
+            waiter.get(seconds)
+        else:
+            self.simulation.schedule(waiter.switch)
+            waiter.get()
+
+    def queue(self, *args, **kwargs):
+        return Queue(self.simulation, *args, **kwargs)
+
+    def event(self, *args, **kwargs):
+        return Event(self.simulation, *args, **kwargs)
+
+    def lock(self, *args, **kwargs):
+        return Semaphore(self.simulation, *args, **kwargs)
+
+    def _wait_readable(self, fd, timeout=None):
+        # real file descriptors don't follow the virtual clock, so this
+        # only checks once `timeout` of virtual time has passed
+        self.sleep(timeout or 0)
+        return bool(select.select([fd], [], [], 0)[0])
+
+    def _interrupt_after(self, seconds, exception):
+        timer = self.simulation.call_later(
+            seconds, self._interrupt, greenlet.getcurrent(), exception)
+        return timer.cancel
+
+    def _interrupt(self, target, exception):
+        if target and target is not self.simulation.greenlet:
+            target.throw(exception)
+
+    def task_group(self):
+        return TaskGroup(self)
+
+
+class TaskGroup(AsyncManager):
+    """Task group for a service sharing a root `AsyncManager`
+
+    Tasks are tracked both here and in the root manager, so stopping either
+    one stops them.
+    """
+
+    def __init__(self, root):
+        super(TaskGroup, self).__init__()
+        self.simulation = root.simulation
+        self.root = root
+
+    def _task(self, func, args, kwargs):
+        task = super(TaskGroup, self)._task(func, args, kwargs)
+        self.root._tasks.add(task)
+        task.link(self.root._tasks.discard)
+        return task
+
+    def task_group(self):
+        return self.root.task_group()
@@ -1,48 +1,584 @@
 from __future__ import absolute_import
 
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import select
+import signal
+import sys
 import threading
 import Queue
 import time
 
-from ..util import defaultproperty
+from ..util import defaultproperty, monotonic
 from ..async import AbstractAsyncManager
+from .. import Setting
 
-def _spin_wait(fn, timeout):
-    """ Spin-wait blocking only 1 second at a time so we don't miss signals """
-    elapsed = 0
-    while True:
-        if fn(timeout=1):
-            return True
-        elapsed += 1
-        if timeout is not None and elapsed >= timeout:
-            return False
+class _Waker(object):
+    """Self-pipe a thread blocks on in `select` until another thread wakes it
+
+    Waiting in `select` instead of on a lock means the wait has an exact
+    timeout and, on the main thread, returns as soon as a signal arrives so
+    its handler can run. The main thread's pipe is also registered with
+    `signal.set_wakeup_fd`, so signals delivered to other threads still wake
+    it. Only the main thread gets one, so threads don't each hold two fds.
+    """
+    _r = _w = None
+
+    def __init__(self):
+        self._r, self._w = os.pipe()
+        for fd in (self._r, self._w):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        if isinstance(threading.current_thread(), threading._MainThread):
+            try:
+                previous = signal.set_wakeup_fd(self._w)
+                if previous != -1:
+                    signal.set_wakeup_fd(previous)
+            except ValueError:
+                pass
+
+    def __del__(self, close=os.close):
+        for fd in (self._r, self._w):
+            if fd is None:
+                continue
+            try:
+                close(fd)
+            except OSError:
+                pass
+
+    def clear(self):
+        try:
+            while os.read(self._r, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def wake(self):
+        try:
+            os.write(self._w, "x")
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def wait(self, timeout=None):
+        """Blocks until woken, interrupted by a signal or timed out"""
+        try:
+            select.select([self._r], [], [], timeout)
+        except select.error, e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+class _LockWaker(object):
+    """`_Waker` for threads other than main, which don't handle signals"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self.clear = self._event.clear
+        self.wake = self._event.set
+
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+
+_wakers = threading.local()
+
+def _waker():
+    """Returns the current thread's waker, cleared of stale wakeups"""
+    waker = getattr(_wakers, "waker", None)
+    if waker is None:
+        if isinstance(threading.current_thread(), threading._MainThread):
+            waker = _Waker()
+        else:
+            waker = _LockWaker()
+        _wakers.waker = waker
+    waker.clear()
+    return waker
+
+
+class Condition(object):
+    """Condition variable whose waiters block on their thread's waker"""
+
+    def __init__(self, lock=None):
+        self._lock = lock or threading.Lock()
+        self._waiters = collections.deque()
+        self.acquire = self._lock.acquire
+        self.release = self._lock.release
+
+    def __enter__(self):
+        return self._lock.__enter__()
+
+    def __exit__(self, *args):
+        return self._lock.__exit__(*args)
+
+    def wait(self, timeout=None):
+        """Waits for a notify, which may also return early. Hold the lock."""
+        waker = _waker()
+        self._waiters.append(waker)
+        self._lock.release()
+        try:
+            waker.wait(timeout)
+        finally:
+            self._lock.acquire()
+            try:
+                self._waiters.remove(waker)
+            except ValueError:
+                pass
+
+    def notify(self, n=1):
+        for _ in xrange(min(n, len(self._waiters))):
+            self._waiters.popleft().wake()
+
+    def notify_all(self):
+        self.notify(len(self._waiters))
+
+    notifyAll = notify_all
+
+
+class Event(object):
+    """Event whose waiters wake as soon as it's set or a signal arrives"""
+
+    def __init__(self):
+        self._flag = False
+        # reentrant so a signal handler can set an event the main thread is
+        # in the middle of waiting on
+        self._cond = Condition(threading.RLock())
+
+    def is_set(self):
+        return self._flag
+
+    isSet = is_set
+
+    def set(self):
+        with self._cond:
+            self._flag = True
+            self._cond.notify_all()
 
+    def clear(self):
+        with self._cond:
+            self._flag = False
 
-class Event(threading._Event):
     def wait(self, timeout=None):
-        return _spin_wait(super(Event, self).wait, timeout)
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._cond:
+            while not self._flag:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        break
+                self._cond.wait(remaining)
+            return self._flag
+
+
+class WakeupQueue(Queue.Queue):
+    """`Queue.Queue` whose blocking calls wait on `Condition` objects"""
+
+    def __init__(self, maxsize=0):
+        Queue.Queue.__init__(self, maxsize)
+        self.not_empty = Condition(self.mutex)
+        self.not_full = Condition(self.mutex)
+        self.all_tasks_done = Condition(self.mutex)
 
 
 class Thread(threading.Thread):
+    """Thread whose join returns as soon as it finishes or a signal arrives"""
+
+    def __init__(self, *args, **kwargs):
+        super(Thread, self).__init__(*args, **kwargs)
+        self._finished = Event()
+
+    def run(self):
+        try:
+            super(Thread, self).run()
+        finally:
+            self._finished.set()
+
     def join(self, timeout=None):
-        return _spin_wait(super(Thread, self).join, timeout)
+        if not self._finished.wait(timeout):
+            return False
+        super(Thread, self).join()
+        return True
+
+
+_local = threading.local()
 
+class Task(object):
+    """Handle for a function run by a `WorkerPool`
+
+    Behaves like a finished or running `Thread` as far as `join` and
+    `is_alive` are concerned. A task still queued when its pool is closed
+    is cancelled, and counts as finished.
+    """
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+        self.exception = None
+        self.cancelled = False
+        self._done = Event()
+        self._lock = threading.Lock()
+        self._links = []
+
+    def run(self):
+        try:
+            self.value = self.func(*self.args, **self.kwargs)
+        except Exception, e:
+            self.exception = e
+            sys.excepthook(*sys.exc_info())
+        finally:
+            self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            links, self._links = self._links, []
+        for callback in links:
+            callback(self)
+
+    def link(self, callback):
+        """Calls `callback` with this task once it has finished"""
+        with self._lock:
+            if not self._done.is_set():
+                self._links.append(callback)
+                return
+        callback(self)
 
-class Timer(threading._Timer):
     def join(self, timeout=None):
-        return _spin_wait(super(Timer, self).join, timeout)
+        return self._done.wait(timeout)
+
+    def is_alive(self):
+        return not self._done.is_set()
+
+
+class ScheduledTask(Task):
+    """Handle for a function scheduled with `spawn_later`
+
+    It can be cancelled until the scheduler hands it to a thread or worker.
+    A cancelled task counts as finished.
+    """
+
+    def __init__(self, func, args, kwargs):
+        super(ScheduledTask, self).__init__(func, args, kwargs)
+        self._fired = False
+        self._scheduler = self._entry = None
+
+    def cancel(self):
+        """Cancels the task if it hasn't started yet, returning success"""
+        with self._lock:
+            if self._fired or self.cancelled:
+                return False
+            self.cancelled = True
+        if self._entry is not None:
+            self._scheduler.cancel(self._entry)
+        self._finish()
+        return True
+
+    def _fire(self):
+        with self._lock:
+            if self.cancelled:
+                return False
+            self._fired = True
+            return True
+
+
+class Scheduler(object):
+    """Runs timed callbacks from a single thread
+
+    Deadlines are kept in a heap, so scheduling is O(log n). Cancelling marks
+    the entry in O(1) and the heap is compacted once most of it is cancelled.
+    Callbacks run on the scheduler thread, so they should only hand work off.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._cond = Condition()
+        self._counter = itertools.count()
+        self._cancelled = 0
+        self._thread = None
+        self._closed = False
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def schedule(self, seconds, callback, *args):
+        """Calls `callback` after `seconds` and returns a cancellable entry"""
+        entry = [monotonic() + seconds, next(self._counter), callback, args]
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Scheduler is closed")
+            heapq.heappush(self._heap, entry)
+            if self._thread is None:
+                self._thread = Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            elif self._heap[0] is entry:
+                self._cond.notify()
+        return entry
+
+    def cancel(self, entry):
+        with self._cond:
+            if entry[2] is None:
+                return
+            entry[2] = entry[3] = None
+            self._cancelled += 1
+            if self._cancelled > 64 and self._cancelled * 2 > len(self._heap):
+                self._heap = [e for e in self._heap if e[2] is not None]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def close(self, timeout=None):
+        """Stops the scheduler thread, dropping any pending callbacks"""
+        with self._cond:
+            self._closed = True
+            self._heap = []
+            self._cancelled = 0
+            self._cond.notify()
+            thread = self._thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout)
+
+    def _run(self):
+        while True:
+            due = []
+            with self._cond:
+                while not self._closed and not due:
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    now = monotonic()
+                    while self._heap and self._heap[0][0] <= now:
+                        entry = heapq.heappop(self._heap)
+                        if entry[2] is None:
+                            self._cancelled -= 1
+                        else:
+                            due.append((entry[2], entry[3]))
+                            entry[2] = None
+                    if not due and self._heap:
+                        self._cond.wait(self._heap[0][0] - now)
+                if self._closed:
+                    return
+            for callback, args in due:
+                try:
+                    callback(*args)
+                except Exception:
+                    sys.excepthook(*sys.exc_info())
+
+
+class WorkerPool(object):
+    """Bounded pool of reusable worker threads
+
+    Workers are started as tasks are submitted, up to `max_workers`, and
+    workers beyond `min_workers` exit after `idle_timeout` seconds without
+    work. Submitted tasks wait in a queue of at most `queue_size` tasks (0
+    is unbounded), and `submit` blocks while the queue is full.
+    """
+
+    def __init__(self, min_workers=0, max_workers=None, idle_timeout=60,
+                 queue_size=0):
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.idle_timeout = idle_timeout
+        self.active = 0
+        self.completed = 0
+        self._unfinished = 0
+        self._queue = WakeupQueue(queue_size)
+        self._lock = threading.Lock()
+        self._workers = set()
+        self._closed = False
+        with self._lock:
+            for _ in xrange(min_workers):
+                self._add_worker()
+
+    @property
+    def queued(self):
+        return self._queue.qsize()
+
+    @property
+    def workers(self):
+        return len(self._workers)
+
+    def submit(self, func, *args, **kwargs):
+        """Queues a function to run on a worker and returns its `Task`"""
+        return self.submit_task(Task(func, args, kwargs))
+
+    def submit_task(self, task, block=True):
+        """Queues a `Task` to run on a worker
+
+        Without `block`, raises `Queue.Full` instead of waiting for room.
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Worker pool is closed")
+            self._unfinished += 1
+            workers = len(self._workers)
+            if self._unfinished > workers and (self.max_workers is None
+                                               or workers < self.max_workers):
+                self._add_worker()
+        try:
+            self._queue.put(task, block)
+        except Queue.Full:
+            with self._lock:
+                self._unfinished -= 1
+            raise
+        return task
+
+    def close(self, timeout=None):
+        """Stops workers once they finish the tasks they're running
+
+        Tasks still queued are cancelled.
+        """
+        with self._lock:
+            self._closed = True
+            workers = list(self._workers)
+        self._cancel_queued()
+        for _ in workers:
+            try:
+                self._queue.put_nowait(None)
+            except Queue.Full:
+                break
+        for worker in workers:
+            if worker is not threading.current_thread():
+                worker.join(timeout)
+        # in case a submit was racing with closing
+        self._cancel_queued()
+
+    def _cancel_queued(self):
+        while True:
+            try:
+                task = self._queue.get_nowait()
+            except Queue.Empty:
+                return
+            if task is not None:
+                self._cancel(task)
+
+    def _cancel(self, task):
+        task.cancelled = True
+        with self._lock:
+            self._unfinished -= 1
+        task._finish()
+
+    def _add_worker(self):
+        worker = Thread(target=self._work)
+        worker.daemon = True
+        self._workers.add(worker)
+        worker.start()
+
+    def _work(self):
+        worker = threading.current_thread()
+        while True:
+            with self._lock:
+                idle_timeout = None
+                if len(self._workers) > self.min_workers:
+                    idle_timeout = self.idle_timeout
+            try:
+                task = self._queue.get(timeout=idle_timeout)
+            except Queue.Empty:
+                with self._lock:
+                    # a task submitted since the get timed out may be
+                    # counting on this worker, so only retire when there
+                    # are more workers than tasks
+                    workers = len(self._workers)
+                    if workers > self.min_workers and \
+                            self._unfinished < workers:
+                        self._workers.discard(worker)
+                        return
+                continue
+            if task is None or self._closed:
+                if task is not None:
+                    self._cancel(task)
+                with self._lock:
+                    self._workers.discard(worker)
+                return
+            with self._lock:
+                self.active += 1
+            _local.task = task
+            try:
+                task.run()
+            finally:
+                _local.task = None
+                with self._lock:
+                    self.active -= 1
+                    self.completed += 1
+                    self._unfinished -= 1
 
 
 class AsyncManager(AbstractAsyncManager):
-    """Async manager for threads"""
+    """Async manager for threads
+
+    By default every spawn runs in a new thread. Setting
+    `threading.max_workers` runs spawned functions on a `WorkerPool` instead.
+    Threads can't be interrupted, so timeouts only set the current deadline.
+    """
     stop_timeout = defaultproperty(int, 1)
+    overflow_retry = defaultproperty(float, 0.01)
+    _context = threading.local()
+
+    min_workers = Setting("threading.min_workers", default=0, help="""\
+        Worker threads kept alive by the threading manager's pool
+        """)
+    max_workers = Setting("threading.max_workers", default=None, help="""\
+        Enables a pool of at most this many worker threads for the
+        threading manager instead of starting a thread per spawn
+        """)
+    idle_timeout = Setting("threading.idle_timeout", default=60, help="""\
+        Seconds an idle pool worker above min_workers waits before exiting
+        """)
+    queue_size = Setting("threading.queue_size", default=0, help="""\
+        Maximum number of spawned tasks waiting for a pool worker. Spawning
+        blocks while the queue is full. 0 is unbounded.
+        """)
+
+    gil_warning = True
 
     def __init__(self):
-        # _lock protects the _threads structure
-        print ("The ginkgo.async.threading manager should not be used in "
-               "production environments due to the known limitations of the GIL")
+        # _lock protects the _tasks structure
+        if self.gil_warning:
+            print ("The ginkgo.async.threading manager should not be used in "
+                   "production environments due to the known limitations of "
+                   "the GIL")
         self._lock = threading.Lock()
-        self._threads = []
+        self._tasks = set()
+        self._pool = None
+        self._scheduler = None
+        self._completed = 0
+        # due tasks waiting for room in the pool's queue
+        self._overflow = collections.deque()
+        self._drain_scheduled = False
+
+    @property
+    def scheduler(self):
+        """The `Scheduler` running this manager's `spawn_later` timers"""
+        if self._scheduler is None:
+            with self._lock:
+                if self._scheduler is None:
+                    self._scheduler = Scheduler()
+        return self._scheduler
+
+    @property
+    def pool(self):
+        """The `WorkerPool` used when `max_workers` is set, else None"""
+        if self._pool is None and self.max_workers is not None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = WorkerPool(self.min_workers,
+                        self.max_workers, self.idle_timeout, self.queue_size)
+        return self._pool
+
+    @property
+    def counters(self):
+        """Live counts of active, queued and completed tasks"""
+        pool = self.pool
+        if pool is None:
+            return dict(active=len(self._tasks), queued=0,
+                        completed=self._completed, workers=len(self._tasks))
+        return dict(active=pool.active, queued=pool.queued,
+                    completed=pool.completed, workers=pool.workers)
 
     def do_stop(self):
         """
@@ -54,7 +590,7 @@ class AsyncManager(AbstractAsyncManager):
                   they will not be killed since there is no safe way to do this.
         """
         with self._lock:
-            reentrant_stop = threading.current_thread() in self._threads
+            reentrant_stop = getattr(_local, "task", None) in self._tasks
 
         if reentrant_stop:
             t = Thread(target=self.do_stop)
@@ -63,35 +599,184 @@ class AsyncManager(AbstractAsyncManager):
             return t.join()
 
         with self._lock:
-            for t in self._threads:
-                t.join(self.stop_timeout)
+            tasks = list(self._tasks)
+        for t in tasks:
+            if isinstance(t, ScheduledTask):
+                t.cancel()
+        self._cancel_overflow()
+        for t in tasks:
+            t.join(self.stop_timeout)
+        with self._lock:
+            pool, self._pool = self._pool, None
+            scheduler, self._scheduler = self._scheduler, None
+        if scheduler is not None:
+            scheduler.close(self.stop_timeout)
+        # in case the scheduler overflowed a task while stopping
+        self._cancel_overflow()
+        if pool is not None:
+            pool.close(self.stop_timeout)
 
     def spawn(self, func, *args, **kwargs):
-        """Spawn a greenlet under this service"""
-        t = Thread(target=func, args=args, kwargs=kwargs)
-        with self._lock:
-            self._threads.append(t)
+        """Spawn a thread, or a task on the worker pool, under this service"""
+        pool = self.pool
+        if pool is not None:
+            task = pool.submit(func, *args, **kwargs)
+            self._track(task)
+            task.link(self._untrack)
+            return task
+        t = Thread(target=self._run_tracked, args=(func, args, kwargs))
+        self._track(t)
         t.daemon=True
         t.start()
         return t
 
     def spawn_later(self, seconds, func, *args, **kwargs):
-        """Spawn a greenlet in the future under this service"""
-        t = Timer(group=self, target=func, args=args, kwargs=kwargs)
+        """Spawn a thread, or pool task, in the future under this service
+
+        Timers are kept by a single `Scheduler` thread, which hands due tasks
+        to the worker pool or a new thread. The returned `ScheduledTask` can
+        be cancelled until then. The scheduler never blocks on a full pool
+        queue; tasks that don't fit wait in order and are retried every
+        `overflow_retry` seconds.
+        """
+        task = ScheduledTask(func, args, kwargs)
+        self._track(task)
+        task.link(self._untrack)
+        task._scheduler = self.scheduler
+        task._entry = task._scheduler.schedule(seconds, self._fire, task)
+        return task
+
+    def _fire(self, task):
+        if not task._fire():
+            return
+        pool = self.pool
+        if pool is not None:
+            with self._lock:
+                self._overflow.append(task)
+            self._drain_overflow()
+        else:
+            t = Thread(target=self._run_task, args=(task,))
+            t.daemon=True
+            t.start()
+
+    def _drain_overflow(self):
+        """Hands overflowed tasks to the pool, on the scheduler thread"""
+        while True:
+            with self._lock:
+                if not self._overflow:
+                    return
+                task = self._overflow.popleft()
+            try:
+                self.pool.submit_task(task, block=False)
+            except Queue.Full:
+                with self._lock:
+                    self._overflow.appendleft(task)
+                    if self._drain_scheduled:
+                        return
+                    self._drain_scheduled = True
+                try:
+                    self.scheduler.schedule(self.overflow_retry,
+                                            self._retry_overflow)
+                except RuntimeError:
+                    # the scheduler was closed by a stop
+                    self._cancel_overflow()
+                return
+
+    def _retry_overflow(self):
         with self._lock:
-            self._threads.append(t)
-        t.daemon=True
-        t.start()
-        return t
+            self._drain_scheduled = False
+        self._drain_overflow()
+
+    def _cancel_overflow(self):
+        with self._lock:
+            tasks, self._overflow = self._overflow, collections.deque()
+            self._drain_scheduled = False
+        for task in tasks:
+            task.cancelled = True
+            task._finish()
+
+    def _run_task(self, task):
+        _local.task = task
+        try:
+            task.run()
+        finally:
+            _local.task = None
+
+    def _run_tracked(self, func, args, kwargs):
+        _local.task = task = threading.current_thread()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.task = None
+            self._untrack(task)
+
+    def _track(self, task):
+        with self._lock:
+            self._tasks.add(task)
+
+    def _untrack(self, task):
+        with self._lock:
+            if task in self._tasks:
+                self._tasks.discard(task)
+                self._completed += 1
 
     def sleep(self, seconds):
         return time.sleep(seconds)
 
     def queue(self, *args, **kwargs):
-        return Queue.Queue(*args, **kwargs)
+        return WakeupQueue(*args, **kwargs)
 
     def event(self, *args, **kwargs):
         return Event(*args, **kwargs)
 
     def lock(self, *args, **kwargs):
         return threading.Lock(*args, **kwargs)
+
+    def signal(self, signalnum, handler, *args, **kwargs):
+        """Calls `handler` with `args` on the main thread when signalled
+
+        Like gevent's, handlers aren't passed the signal number and frame.
+        Waits on the main thread return as soon as the signal arrives, so
+        the handler runs immediately.
+        """
+        return signal.signal(signalnum,
+                             lambda signum, frame: handler(*args, **kwargs))
+
+    def task_group(self):
+        return TaskGroup(self)
+
+
+class TaskGroup(AsyncManager):
+    """Thread group for a service sharing a root `AsyncManager`
+
+    Tasks run on the root manager's worker pool, if it has one, and are
+    tracked both here and in the root manager, so stopping either one joins
+    them.
+    """
+    gil_warning = False
+
+    def __init__(self, root):
+        super(TaskGroup, self).__init__()
+        self.root = root
+
+    @property
+    def pool(self):
+        return self.root.pool
+
+    @property
+    def scheduler(self):
+        return self.root.scheduler
+
+    def _track(self, task):
+        super(TaskGroup, self)._track(task)
+        self.root._track(task)
+
+    def _untrack(self, task):
+        super(TaskGroup, self)._untrack(task)
+        self.root._untrack(task)
+
+    def init(self):
+        self.root.init()
+
+    def task_group(self):
+        return self.root.task_group()
@@ -20,12 +20,58 @@ the only API you need to use Ginkgo config.
 
 """
 import collections
+import contextlib
+import logging
+import os
 import os.path
 import re
 import runpy
+import socket
+import sys
+import threading
 
 import util
 
+logger = logging.getLogger(__name__)
+
+def _normalize_path(path):
+    return path.lower().lstrip(".")
+
+def _differs(old, new):
+    if old is new:
+        return False
+    try:
+        return bool(old != new)
+    except Exception:
+        return True
+
+class Snapshot(collections.Mapping):
+    """Immutable view of every setting at one point in time
+
+    A `Config` publishes a new snapshot whenever its settings change, so
+    a snapshot taken with `Config.snapshot()` gives consistent values for
+    several settings even while the configuration is being reloaded.
+    """
+    def __init__(self, settings, groups):
+        self._settings = settings
+        # names directly under each group path, for Group lookups
+        self._groups = groups
+
+    def get(self, path, default=None):
+        return self._settings.get(_normalize_path(path), default)
+
+    def __getitem__(self, path):
+        return self._settings[_normalize_path(path)]
+
+    def __contains__(self, path):
+        return _normalize_path(path) in self._settings
+
+    def __iter__(self):
+        return iter(self._settings)
+
+    def __len__(self):
+        return len(self._settings)
+
 class Config(util.GlobalContext):
     """Represents a collection of settings
 
@@ -37,27 +83,173 @@ class Config(util.GlobalContext):
     `Config.singleton_attr` to a tuple of (object, attribute_name). Then any
     `Config` instance will be a context manager that will temporarily set that
     singleton to that instance.
+
+    Settings are kept in an immutable `Snapshot`. Changes are made to a copy
+    that's checked and then published by replacing the snapshot, so readers
+    never need a lock and never see a partly loaded configuration. Like the
+    rest of the settings, the snapshot is shared by every instance.
+
+    Callbacks registered with `subscribe` are called with just the settings
+    that changed whenever a new snapshot is published, instead of having to
+    poll every setting on reload.
+
+    Each publish copies the settings, so code setting many values should
+    do it in a `batch` to publish them together.
     """
-    _settings = {}
+    _snapshot = Snapshot({}, {})
+    _write_lock = threading.Lock()
+    _batch = threading.local()
+    _subscriptions = {}
     _descriptors = []
     _forced_settings = set()
     _last_file = None
+    _bound_sockets = {}
+    _binding_slot = 0
 
     def _normalize_path(self, path):
-        return path.lower().lstrip(".")
+        return _normalize_path(path)
+
+    @property
+    def _settings(self):
+        return self._snapshot._settings
+
+    def snapshot(self):
+        """returns the current settings as an immutable `Snapshot`"""
+        return self._snapshot
 
     def get(self, path, default=None):
         """gets the current value of a setting"""
-        return self._settings.get(self._normalize_path(path), default)
+        return self._snapshot._settings.get(self._normalize_path(path),
+                                            default)
 
     def set(self, path, value, force=False):
         """sets the value of a setting"""
         path = self._normalize_path(path)
-        if force or path not in self._forced_settings:
-            self._settings[self._normalize_path(path)] = value
+        staged = getattr(self._batch, "staged", None)
+        if staged is not None:
+            if force or not staged.get(path, (None, False))[1]:
+                staged[path] = (value, force)
+            return
+        with self._write_lock:
+            if not force and path in self._forced_settings:
+                return
+            deliveries = self._publish({path: value})[1]
             if force:
                 self._forced_settings.add(path)
+        self._notify(deliveries)
 
+    @contextlib.contextmanager
+    def batch(self):
+        """context manager publishing the settings set in its block at once
+
+        Values set in the block aren't visible until it ends. They're then
+        published as one snapshot, with one notification per subscriber,
+        so setting many values costs one copy of the settings instead of
+        one each. Nothing is published if the block raises. Batches can be
+        nested, and only the outermost one publishes.
+        """
+        if getattr(self._batch, "staged", None) is not None:
+            yield
+            return
+        self._batch.staged = staged = {}
+        try:
+            yield
+        finally:
+            self._batch.staged = None
+        with self._write_lock:
+            values = dict((path, value)
+                          for path, (value, force) in staged.iteritems()
+                          if force or path not in self._forced_settings)
+            deliveries = self._publish(values)[1]
+            self._forced_settings.update(
+                path for path, (_, force) in staged.iteritems() if force)
+        self._notify(deliveries)
+
+    def _publish(self, values):
+        """publishes a snapshot with `values` applied to the current one
+
+        Returns the snapshot and the subscription callbacks to call, each
+        with the changes it subscribed to.
+        """
+        current = self._snapshot._settings
+        changes = {}
+        added = collections.defaultdict(set)
+        for path, value in values.iteritems():
+            old = current.get(path)
+            if path not in current:
+                parts = path.split(".")
+                for depth, name in enumerate(parts):
+                    added[".".join(parts[:depth])].add(name)
+            elif not _differs(old, value):
+                continue
+            changes[path] = (old, value)
+        if not changes:
+            return self._snapshot, []
+        settings = dict(current)
+        settings.update((path, new) for path, (_, new) in changes.iteritems())
+        groups = self._snapshot._groups
+        if added:
+            groups = dict(groups)
+            for group_path, names in added.iteritems():
+                groups[group_path] = groups.get(
+                    group_path, frozenset()).union(names)
+        snapshot = Snapshot(settings, groups)
+        self._check(snapshot)
+        Config._snapshot = snapshot
+        return snapshot, self._match(changes)
+
+    def _match(self, changes):
+        matched = collections.OrderedDict()
+        for path, change in sorted(changes.iteritems()):
+            parts = path.split(".")
+            keys = [(path, False)] + [(".".join(parts[:depth]), True)
+                                      for depth in xrange(len(parts) + 1)]
+            for key in keys:
+                for callback in self._subscriptions.get(key, ()):
+                    matched.setdefault((key, id(callback)),
+                                       (callback, {}))[1][path] = change
+        return matched.values()
+
+    def _notify(self, deliveries):
+        for callback, changes in deliveries:
+            try:
+                callback(changes)
+            except Exception:
+                logger.exception("Error in config subscriber {}".format(
+                    callback))
+
+    def subscribe(self, path, callback, prefix=False):
+        """calls `callback` whenever the setting at `path` changes
+
+        With `prefix`, changes to any setting under the group at `path` are
+        included too, and an empty path covers every setting. The callback
+        is called once per change to the settings, with a dictionary of the
+        paths it subscribed to that changed, each mapped to a tuple of the
+        old and new values. The old value is None for new settings.
+        Returns a function that cancels the subscription.
+        """
+        key = (self._normalize_path(path), prefix)
+        with self._write_lock:
+            callbacks = self._subscriptions.get(key, ())
+            self._subscriptions[key] = callbacks + (callback,)
+
+        def unsubscribe():
+            with self._write_lock:
+                callbacks = list(self._subscriptions.get(key, ()))
+                if callback in callbacks:
+                    callbacks.remove(callback)
+                    self._subscriptions[key] = tuple(callbacks)
+        return unsubscribe
+
+    def _check(self, snapshot):
+        """raises RuntimeError if a setting's descriptor rejects its value"""
+        for descriptor in self._descriptors:
+            if descriptor._key in snapshot._settings:
+                try:
+                    descriptor.check(snapshot._settings[descriptor._key])
+                except Exception, e:
+                    raise RuntimeError("Config error: {}: {}".format(
+                        descriptor.path, e))
 
     def group(self, path=''):
         """returns a Group object for the given path if exists"""
@@ -70,6 +262,55 @@ class Config(util.GlobalContext):
         self._descriptors.append(descriptor)
         return descriptor
 
+    def binding(self, *args, **kwargs):
+        """returns a _Binding descriptor attached to this configuration"""
+        descriptor = _Binding(self, *args, **kwargs)
+        self._descriptors.append(descriptor)
+        return descriptor
+
+    def bind(self, descriptor, count=1):
+        """binds the listening sockets of a binding, returning the one to use
+
+        Bindings with `reuse_port` get `count` sockets on the same address,
+        one for each worker process, and `_binding_slot` picks the one used
+        by this process. Others always have a single shared socket.
+        """
+        address = descriptor.value
+        key = (descriptor.path, repr(address))
+        sockets = self._bound_sockets.setdefault(key, [])
+        if not descriptor.reuse_port:
+            count = 1
+        while len(sockets) < count:
+            sockets.append(descriptor.create_socket(address))
+        return sockets[self._binding_slot % len(sockets)]
+
+    def bound_fds(self):
+        """returns the file descriptors of bound sockets for `adopt_fds`"""
+        return [[path, address, [[s.fileno(), s.family, s.type]
+                                 for s in sockets]]
+                for (path, address), sockets in self._bound_sockets.items()]
+
+    def adopt_fds(self, bindings):
+        """uses sockets bound by another process, as listed by `bound_fds`
+
+        Bindings use these sockets instead of binding new ones, as long as
+        their address hasn't changed.
+        """
+        for path, address, fds in bindings:
+            sockets = self._bound_sockets.setdefault((path, address), [])
+            for entry in fds:
+                # entries from older versions have no type, so it's probed
+                fd, family = entry[:2]
+                type = entry[2] if len(entry) > 2 else None
+                sockets.append(util.socket_fromfd(fd, family, type))
+                os.close(fd)
+
+    def bind_all(self, count=1):
+        """binds the listening sockets of every known binding"""
+        for descriptor in self._descriptors:
+            if isinstance(descriptor, _Binding):
+                self.bind(descriptor, count)
+
     def load_module(self, module_path):
         """loads a module as configuration given a module path"""
         try:
@@ -84,8 +325,9 @@ class Config(util.GlobalContext):
             config_dict = runpy.run_path(file_path)
         except Exception, e:
             raise RuntimeError("Config error: {}".format(e))
+        snapshot = self.load(config_dict)
         self._last_file = file_path
-        return self.load(config_dict)
+        return snapshot
 
     def reload_file(self):
         """reloads the last loaded configuration from load_file"""
@@ -93,7 +335,12 @@ class Config(util.GlobalContext):
             return self.load_file(self._last_file)
 
     def load(self, config_dict):
-        """loads a dictionary into settings"""
+        """loads a dictionary into settings, returning the new `Snapshot`
+
+        Every setting is applied at once. If any fails its check, a
+        RuntimeError is raised and the settings are left as they were.
+        """
+        changes = {}
         def _load(d, prefix=''):
             """
             Recursively loads configuration from a dictionary, putting
@@ -105,9 +352,14 @@ class Config(util.GlobalContext):
                 if type(value).__name__ == 'classobj':
                     _load(value.__dict__, path)
                 else:
-                    self.set(path, value)
-        _load(config_dict)
-        return self._settings
+                    path = self._normalize_path(path)
+                    if path not in self._forced_settings:
+                        changes[path] = value
+        with self._write_lock:
+            _load(config_dict)
+            snapshot, deliveries = self._publish(changes)
+        self._notify(deliveries)
+        return snapshot
 
     def print_help(self, only_default=False):
         print "config settings:"
@@ -143,40 +395,33 @@ class Group(collections.Mapping):
 
     def __getattr__(self, name):
         path = self._config._normalize_path(".".join((self._name, name)))
+        snapshot = self._config._snapshot
         try:
-            return self._config._settings[path]
+            return snapshot._settings[path]
         except KeyError:
-            group_path = path + "."
-            keys = self._config._settings.keys()
-            if any(1 for k in keys if k.startswith(group_path)):
+            if path in snapshot._groups:
                 return Group(self._config, path)
             return None
 
     def __repr__(self):
         return 'Group[{}:{}]'.format(self._name, self._dict())
 
+    def _names(self):
+        return self._config._snapshot._groups.get(self._name, ())
+
     def _dict(self):
-        d = dict()
-        group_path = self._name + "."
-        for key in self._config._settings.keys():
-            if not self._name or key.startswith(group_path):
-                if self._name:
-                    key = key.split(group_path, 1)[-1]
-                name = key.split('.', 1)[0]
-                if name not in d:
-                    d[name] = getattr(self, name)
-        return d
+        return dict((name, getattr(self, name)) for name in self._names())
 
     # Mapping protocol
 
     def __contains__(self, item):
-        return item in self._dict()
+        return item in self._names()
 
     def __iter__(self):
-        return self._dict().__iter__()
+        return iter(self._names())
 
     def __len__(self):
-        return self._dict().__len__()
+        return len(self._names())
 
     def __getitem__(self, key):
         return getattr(self, key)
@@ -191,7 +436,9 @@ class _Setting(object):
     This is a descriptor for your component classes to define what settings
     your application uses and provides a way to access that setting. By
     accessing with a descriptor, if the configuration changes you
-    will always have the current value. Example:
+    will always have the current value. The value is cached until the
+    configuration next changes, so reading a setting in a hot loop costs
+    little more than reading an attribute. Example:
 
         class MyService(Service):
             foo = config.setting('foo', default='bar',
@@ -204,6 +451,8 @@ class _Setting(object):
 
     def __init__(self, config, path, default=None, monitored=False, help=''):
         self._last_value = self._init
+        self._cache = (None, None)
+        self._key = config._normalize_path(path)
         self.config = config
         self.path = path
         self.default = default
@@ -211,19 +460,43 @@ class _Setting(object):
         self.help = self.__doc__ = re.sub(r'\n\s+', '\n', help.strip())
 
     def __get__(self, instance, type):
+        snapshot, value = self._cache
+        if snapshot is not self.config._snapshot:
+            value = self.value
         if self.monitored:
-            return SettingProxy(self.value, self)
+            return SettingProxy(value, self)
         else:
-            return self.value
+            return value
 
     @property
     def value(self):
-        return self.config.get(self.path, self.default)
+        snapshot, value = self._cache
+        if snapshot is not self.config._snapshot:
+            snapshot = self.config._snapshot
+            value = snapshot._settings.get(self._key, self.default)
+            self._cache = (snapshot, value)
+        return value
+
+    def check(self, value):
+        """Raises an exception if `value` can't be used for this setting
+
+        It's called before settings are changed, and a failed check leaves
+        the settings as they were.
+        """
+        pass
+
+    def subscribe(self, callback):
+        """Calls `callback` with the old and new values when this changes,
+        returning a function that cancels it"""
+        def changed(changes):
+            callback(*changes[self._key])
+        return self.config.subscribe(self.path, changed)
 
     @property
     def changed(self):
         """ True if the value has changed since the last time accessing
-            this property. False on first access.
+            this property. False on first access. Use `subscribe` to be
+            told about changes instead.
         """
         old, self._last_value = self._last_value, self.value
         return self.value != old and old is not self._init
@@ -251,3 +524,95 @@ class SettingProxy(util.ObjectWrapper):
         return self.__subject__
 
 
+
+
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT",
+                       15 if sys.platform.startswith("linux") else None)
+
+def parse_address(address):
+    """returns the socket family and address for a binding value
+
+    Accepts a port number, a "host:port" string where the host is optional,
+    a (host, port) tuple, or a "unix:/path/to/socket" string.
+    """
+    if isinstance(address, basestring):
+        if address.startswith("unix:"):
+            return socket.AF_UNIX, address[len("unix:"):]
+        host, _, port = address.rpartition(":")
+        address = (host.strip("[]"), port)
+    elif isinstance(address, (int, long)):
+        address = ("", address)
+    try:
+        host, port = address
+        port = int(port)
+    except (TypeError, ValueError):
+        raise RuntimeError("Invalid binding address: {}".format(address))
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    return family, (host or "0.0.0.0", port)
+
+
+class _Binding(_Setting):
+    """Setting descriptor for a listening socket
+
+    Do not use this object directly, instead use `Config.binding()`.
+
+    The setting value is an address to listen on, and accessing the
+    descriptor gives you a socket already bound and listening on it. The
+    runner's `Process` binds every binding before switching user or group,
+    so privileged ports can be used, and before forking workers, so they
+    all accept on the same socket. With `reuse_port`, each worker gets its
+    own socket on the address instead, letting the kernel balance
+    connections between them. With `datagram`, the socket is a bound UDP
+    socket, for a `DatagramServer`. Example:
+
+        class MyService(Service):
+            bind = config.binding('bind', default=':80', reuse_port=True,
+                    help="Address to serve HTTP on")
+
+            def __init__(self):
+                self.add_service(WSGIServer(self.bind, self.handle))
+
+    Sockets are kept open for the life of the process, so a server can be
+    stopped and started again without unbinding. If the address changes on
+    reload, the new address is bound the next time the setting is accessed.
+    """
+    def __init__(self, config, path, default=None, reuse_port=False,
+                 backlog=1024, datagram=False, help=''):
+        super(_Binding, self).__init__(config, path, default, help=help)
+        self.reuse_port = reuse_port
+        self.backlog = backlog
+        self.datagram = datagram
+
+    def __get__(self, instance, type):
+        return self.config.bind(self)
+
+    def check(self, address):
+        parse_address(address)
+
+    def create_socket(self, address):
+        """creates a socket listening on the address"""
+        family, address = parse_address(address)
+        sock = socket.socket(family, socket.SOCK_DGRAM if self.datagram
+                             else socket.SOCK_STREAM)
+        try:
+            if family == socket.AF_UNIX:
+                if os.path.exists(address):
+                    os.unlink(address)
+            else:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self.reuse_port:
+                if SO_REUSEPORT is None:
+                    raise RuntimeError(
+                        "SO_REUSEPORT is not supported on this platform")
+                sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+            sock.bind(address)
+            if not self.datagram:
+                sock.listen(self.backlog)
+        except socket.error, e:
+            sock.close()
+            raise RuntimeError("Unable to bind {} to {}: {}".format(
+                self.path, address, e))
+        except:
+            sock.close()
+            raise
+        return sock
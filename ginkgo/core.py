@@ -10,14 +10,17 @@ core service interface.
 `AsyncManager` from a driver in the `async` module. It's assumed the common
 case is to create async applications, but there are cases when you need a
 `Service` with no async. For example, `AsyncManager` classes inherit from
-`BasicService`, otherwise there would be a circular dependency.
+`BasicService`, otherwise there would be a circular dependency. With
+`async_shared` set, services instead get a lightweight task group under one
+root `AsyncManager` per driver.
 
 """
 import functools
-import runpy
 
 from .util import AbstractStateMachine
 from .util import defaultproperty
+from .util import monotonic
+from .config import Config, _Setting, _differs
 from . import Setting
 
 def require_ready(func):
@@ -33,6 +36,144 @@ def require_ready(func):
         return func(self, *args, **kwargs)
     return wrapped
 
+def dependency_order(services):
+    """Orders services so each comes after the services it `requires`
+
+    Only requirements within `services` are considered. Raises RuntimeError
+    if the requirements form a cycle.
+    """
+    ordered = []
+    visiting = set()
+    visited = set()
+    members = set(id(s) for s in services)
+
+    def visit(service):
+        if id(service) in visited:
+            return
+        if id(service) in visiting:
+            raise RuntimeError(
+                "Circular service requirement involving {}".format(
+                    service.service_name))
+        visiting.add(id(service))
+        for dependency in service.requires:
+            if id(dependency) in members:
+                visit(dependency)
+        visiting.discard(id(service))
+        visited.add(id(service))
+        ordered.append(service)
+
+    for service in services:
+        visit(service)
+    return ordered
+
+def dependency_levels(services):
+    """Groups services into levels that only require services in earlier ones
+
+    Services in the same level don't require each other and can be started
+    or stopped at the same time.
+    """
+    levels = []
+    level_of = {}
+    for service in dependency_order(services):
+        level = 1 + max([level_of[id(d)] for d in service.requires
+                         if id(d) in level_of] or [-1])
+        level_of[id(service)] = level
+        if level == len(levels):
+            levels.append([])
+        levels[level].append(service)
+    return levels
+
+_phases = {
+    "start": ("starting", "ready", ["pre_start", "do_start", "post_start"]),
+    "stop": ("stopping", "stopped", ["pre_stop", "do_stop", "post_stop"]),
+}
+
+def _service_children(service):
+    return [c for c in service._children
+            if c is not getattr(service, "async", None)]
+
+def _walk_services(service, depth=0):
+    yield depth, service
+    for child in _service_children(service):
+        for item in _walk_services(child, depth + 1):
+            yield item
+
+def critical_path(service, phase="start"):
+    """Returns the chain of services a start or stop of `service` waited on
+
+    The result is a list of (depth, service) tuples. Among each service's
+    children, the path follows back from the child that finished last
+    through the siblings that finished before it began. That's the previous
+    sibling when children are handled one at a time, and the last required
+    sibling to finish when they're handled concurrently.
+    """
+    begin, end, _ = _phases[phase]
+    path = []
+
+    def walk(service, depth):
+        path.append((depth, service))
+        children = [c for c in _service_children(service)
+                    if c.state.duration(begin, end) is not None]
+        chain = []
+        waited = children
+        while waited:
+            node = max(waited, key=lambda c: c.state.entered[end])
+            chain.insert(0, node)
+            began = node.state.entered[begin]
+            waited = [c for c in children if c.state.entered[end] <= began
+                      and not any(c is n for n in chain)]
+        for child in chain:
+            walk(child, depth + 1)
+
+    walk(service, 0)
+    return path
+
+def timing_report(service, limit=10):
+    """Returns a report of lifecycle timings for a service tree
+
+    For both startup and shutdown it lists the services that spent the
+    most time in their own hooks and the critical path through the tree.
+    """
+    def seconds(value):
+        return "   -    " if value is None else "%7.3fs" % value
+
+    lines = []
+    for phase, title in (("start", "startup"), ("stop", "shutdown")):
+        begin, end, hooks = _phases[phase]
+        timed = []
+        for _, s in _walk_services(service):
+            durations = [(h, s.state.hook_durations[h]) for h in hooks
+                         if h in s.state.hook_durations]
+            if s.state.duration(begin, end) is not None:
+                timed.append((sum(d for _, d in durations), s, durations))
+        lines.append("{}: {}".format(title,
+            seconds(service.state.duration(begin, end)).strip()))
+        if not timed:
+            continue
+        lines.append("  slowest:")
+        for own, s, durations in sorted(timed, key=lambda t: -t[0])[:limit]:
+            lines.append("    {} {}  {}".format(seconds(own), s.service_name,
+                " ".join("%s=%.3fs" % d for d in durations)))
+        lines.append("  critical path:")
+        for depth, s in critical_path(service, phase):
+            lines.append("    {} {}{}".format(
+                seconds(s.state.duration(begin, end)), "  " * depth,
+                s.service_name))
+    return "\n".join(lines)
+
+_setting_descriptors = {}
+
+def setting_descriptors(cls):
+    """Returns the `Setting` descriptors defined on a class or its bases"""
+    try:
+        return _setting_descriptors[cls]
+    except KeyError:
+        found = dict((name, value) for klass in reversed(cls.__mro__)
+                     for name, value in vars(klass).items()
+                     if isinstance(value, _Setting))
+        _setting_descriptors[cls] = found.values()
+        return _setting_descriptors[cls]
+
 def autospawn(func):
     """ Decorator that will spawn the call in a local greenlet """
     @functools.wraps(func)
@@ -40,6 +181,29 @@ def autospawn(func):
         self.spawn(func, self, *args, **kwargs)
     return wrapped
 
+class StartError(RuntimeError):
+    """Raised when child services fail to start concurrently
+
+    `failures` is a list of (service, exception) tuples, one per child that
+    failed to start.
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        super(StartError, self).__init__("Failed to start: {}".format(
+            ", ".join("{} ({})".format(s.service_name, e)
+                      for s, e in failures)))
+
+def _abandon_stop(service):
+    """Marks a service whose stop task was killed stopped, with its children
+
+    Nothing else would ever finish it. A stop task that's still running,
+    as under drivers that can't kill tasks, finishes it itself instead.
+    """
+    for child in service._children:
+        _abandon_stop(child)
+    if service.state.current == "stopping":
+        service.state("stopped")
+
 class ServiceStateMachine(AbstractStateMachine):
     """     +------+
             | init |
@@ -79,8 +243,14 @@ class BasicService(object):
     _statemachine_class = ServiceStateMachine
     _children = defaultproperty(list)
 
+    requires = defaultproperty(list)
     start_timeout = defaultproperty(int, 2)
     start_before = defaultproperty(bool, False)
+    start_concurrently = defaultproperty(bool, False)
+    stop_concurrently = defaultproperty(bool, False)
+    reload_if_changed = defaultproperty(bool, False)
+    stop_deadline = None
+    _reloaded_settings = None
 
     def pre_init(self):
         pass
@@ -99,15 +269,20 @@ class BasicService(object):
     def ready(self):
         return self.state.current == 'ready'
 
-    def add_service(self, service):
+    def add_service(self, service, requires=None):
         """Add a child service to this service
 
         The service added will be started when this service starts, before
         its :meth:`_start` method is called. It will also be stopped when this
         service stops, before its :meth:`_stop` method is called.
 
+        Sibling services passed as `requires` will be ready before the
+        service is started when children are started concurrently.
+
         """
         self._children.append(service)
+        if requires:
+            service.requires.extend(requires)
 
     def remove_service(self, service):
         """Remove a child service from this service"""
@@ -116,13 +291,12 @@ class BasicService(object):
     def start(self, block_until_ready=True):
         """Starts children and then this service. By default it blocks until ready."""
         self.state("start")
+        self._reloaded_settings = Config._snapshot
         if self.start_before:
-            self.do_start()
-        for child in self._children:
-            if child.state.current not in ["ready", "starting"]:
-                child.start(block_until_ready)
+            self.state.measure("do_start", self.do_start)
+        self._start_children(block_until_ready)
         if not self.start_before:
-            ready = not self.do_start()
+            ready = not self.state.measure("do_start", self.do_start)
             if not ready and block_until_ready is True:
                 self.state.wait("ready", self.start_timeout)
             elif ready:
@@ -130,6 +304,11 @@ class BasicService(object):
         else:
             self.state("ready")
 
+    def _start_children(self, block_until_ready):
+        for child in self._children:
+            if child.state.current not in ["ready", "starting"]:
+                child.start(block_until_ready)
+
     def pre_start(self):
         pass
 
@@ -145,18 +324,27 @@ class BasicService(object):
     def post_start(self):
         pass
 
-    def stop(self):
-        """Stop child services in reverse order and then this service"""
+    def stop(self, timeout=None):
+        """Stop child services in reverse order and then this service
+
+        `timeout` is the time budget for stopping this service and its
+        children when they are stopped concurrently, which defaults to
+        `stop_deadline`.
+
+        """
         if self.state.current in ["init", "stopped"]:
             return
         ready_before_stop = self.ready
         self.state("stop")
-        for child in reversed(self._children):
-            child.stop()
+        self._stop_children(timeout)
         if ready_before_stop:
-            self.do_stop()
+            self.state.measure("do_stop", self.do_stop)
         self.state("stopped")
 
+    def _stop_children(self, timeout):
+        for child in reversed(self._children):
+            child.stop()
+
     def pre_stop(self):
         pass
 
@@ -168,16 +356,36 @@ class BasicService(object):
         return
 
     def reload(self):
+        """Reloads children and this service
+
+        With `reload_if_changed` set, this service's `do_reload` is only
+        called if one of its settings changed since it started or was last
+        reloaded. Its children are reloaded either way.
+
+        """
         def _reload_children():
             for child in self._children:
                 child.reload()
 
+        def _reload():
+            if not self.reload_if_changed or self._settings_changed():
+                self.state.measure("do_reload", self.do_reload)
+
         if self.start_before:
-            self.do_reload()
+            _reload()
             _reload_children()
         else:
             _reload_children()
-            self.do_reload()
+            _reload()
+
+    def _settings_changed(self):
+        previous, current = self._reloaded_settings, Config._snapshot
+        self._reloaded_settings = current
+        if previous is None:
+            return True
+        return any(_differs(previous.get(d.path, d.default),
+                            current.get(d.path, d.default))
+                   for d in setting_descriptors(type(self)))
 
     def do_reload(self):
         """Empty implementation of service reload. Implement me!"""
@@ -204,18 +412,30 @@ class BasicService(object):
 
 class Service(BasicService):
     async_available = ["ginkgo.async." + m for m in ("gevent", "threading",
-                                                     "eventlet")]
+                                                     "eventlet",
+                                                     "multiprocessing",
+                                                     "simulated")]
     async = Setting("async", default="ginkgo.async.threading", help="""\
         The async reactor to use. Available choices:
             ginkgo.async.gevent
             ginkgo.async.threading
             ginkgo.async.eventlet
+            ginkgo.async.multiprocessing
+            ginkgo.async.simulated
+        """)
+    async_shared = Setting("async_shared", default=False, help="""\
+        Share one root AsyncManager per async module across all services,
+        giving each service a lightweight task group instead of its own
+        manager.
         """)
 
     def pre_init(self):
+        from .async import load_driver, shared_manager
         try:
-            mod = runpy.run_module(self.async)
-            self.async = mod['AsyncManager']()
+            if self.async_shared:
+                self.async = shared_manager(self.async).task_group()
+            else:
+                self.async = load_driver(self.async)()
             self.add_service(self.async)
         except (NotImplementedError, ImportError) as e:
             if self.async not in self.async_available:
@@ -232,10 +452,129 @@ class Service(BasicService):
                 "Unable to load async manager from {}.\n{}".format(self.async,
                                                                   helptext))
 
-    def spawn(self, *args, **kwargs):
-        return self.async.spawn(*args, **kwargs)
+    def _start_children(self, block_until_ready):
+        """Starts children, concurrently if `start_concurrently` is set
 
-    def spawn_later(self, *args, **kwargs):
-        return self.async.spawn_later(*args, **kwargs)
+        Each child is started in its own task as soon as the siblings it
+        requires are ready, so startup takes as long as the slowest chain of
+        requirements. If any child fails, the children that were started are
+        stopped again in reverse order and a `StartError` is raised.
+        """
+        if not self.start_concurrently:
+            return super(Service, self)._start_children(block_until_ready)
+        if self.async.state.current not in ["ready", "starting"]:
+            self.async.start(block_until_ready)
+        children = dependency_order([c for c in self._children
+            if c is not self.async
+            and c.state.current not in ["ready", "starting"]])
+        done = dict((id(c), self.async.event()) for c in children)
+        failed = set()
+        failures = []
+        started = []
+
+        def start_child(child):
+            try:
+                for dependency in child.requires:
+                    if id(dependency) in done:
+                        done[id(dependency)].wait()
+                        if id(dependency) in failed:
+                            raise RuntimeError("Required service {} failed "
+                                "to start".format(dependency.service_name))
+                started.append(child)
+                child.start(block_until_ready)
+            except Exception, e:
+                failed.add(id(child))
+                failures.append((child, e))
+            finally:
+                done[id(child)].set()
+
+        for child in children:
+            self.spawn(start_child, child)
+        for child in children:
+            done[id(child)].wait()
+        if failures:
+            for child in reversed(started):
+                child.stop()
+            raise StartError(failures)
+
+    def _stop_children(self, timeout):
+        """Stops children, concurrently if `stop_concurrently` is set
+
+        Children are stopped a level at a time in reverse dependency order,
+        with every child in a level stopping at the same time. The deadline
+        from `timeout` or `stop_deadline` is split evenly between the levels
+        remaining and this service itself, and each child is given its
+        level's share as its own budget. Children that don't stop within
+        their share are cut short and reported in `stop_report`. If their
+        stop task was killed they are still marked stopped, along with any
+        of their children left stopping, so the tree can be started again.
+        Drivers that can't kill tasks leave them stopping until their stop
+        finishes late.
+        """
+        if not self.stop_concurrently:
+            return super(Service, self)._stop_children(timeout)
+        if timeout is None:
+            timeout = self.stop_deadline
+        deadline = None if timeout is None else monotonic() + timeout
+        levels = dependency_levels([c for c in self._children
+                                    if c is not self.async])
+        report = []
+        ended = set()
+
+        def stop_child(child, share, done):
+            try:
+                child.stop(share)
+            finally:
+                # also reached when the stop task is killed
+                ended.add(id(child))
+                done.set()
+
+        for remaining, level in enumerate(reversed(levels)):
+            share = None
+            if deadline is not None:
+                share = max(deadline - monotonic(), 0) / (
+                    len(levels) - remaining + 1)
+            started = monotonic()
+            stopping = []
+            for child in level:
+                done = self.async.event()
+                self.spawn(stop_child, child, share, done)
+                stopping.append((child, done))
+            for child, done in stopping:
+                if share is None:
+                    done.wait()
+                else:
+                    done.wait(max(started + share - monotonic(), 0))
+                if child.state.current == "stopped":
+                    report.append((child, share, monotonic() - started))
+                    report.extend(getattr(child, "stop_report", []))
+                else:
+                    report.append((child, share, None))
+        stop_timeout = self.async.stop_timeout
+        if deadline is not None:
+            self.async.stop_timeout = max(deadline - monotonic(), 0)
+        try:
+            self.async.stop()
+        finally:
+            self.async.stop_timeout = stop_timeout
+        for child, _, elapsed in report:
+            if elapsed is None and id(child) in ended:
+                _abandon_stop(child)
+        self.stop_report = report
+
+    @property
+    def stop_overruns(self):
+        """Services that didn't stop within their share of the deadline"""
+        return [service for service, share, elapsed
+                in getattr(self, "stop_report", []) if elapsed is None]
+
+    def spawn(self, func, *args, **kwargs):
+        """Spawns `func`, inheriting the current task's deadline if any"""
+        return self.async.spawn(
+            self.async.inherit_deadline(func), *args, **kwargs)
+
+    def spawn_later(self, seconds, func, *args, **kwargs):
+        return self.async.spawn_later(seconds,
+            self.async.inherit_deadline(func), *args, **kwargs)
 
 
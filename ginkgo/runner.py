@@ -19,14 +19,19 @@ your application service and calls `serve_forever()` on it.
 
 """
 import argparse
+import fcntl
+import json
 import logging
 import pwd
 import grp
+import hashlib
 import os
 import os.path
 import runpy
 import signal
+import socket
 import sys
+import traceback
 
 import ginkgo.core
 import ginkgo.logger
@@ -34,6 +39,12 @@ import ginkgo.util
 
 STOP_SIGNAL = signal.SIGTERM
 RELOAD_SIGNAL = signal.SIGHUP
+TIMINGS_SIGNAL = signal.SIGUSR1
+UPGRADE_SIGNAL = signal.SIGUSR2
+
+LISTEN_FDS_ENV = "GINKGO_LISTEN_FDS"
+UPGRADE_PID_ENV = "GINKGO_UPGRADE_PID"
+UPGRADE_FD_ENV = "GINKGO_UPGRADE_FD"
 
 sys.path.insert(0, os.getcwd())
 
@@ -84,7 +95,7 @@ def run_ginkgoctl():
         configuration file path to use (/path/to/config.py)
         """.strip())
     parser.add_argument("action",
-        choices="start stop restart reload status log logtail".split())
+        choices="start stop restart reload upgrade status timings log logtail".split())
     args = parser.parse_args()
     if args.pid and args.target:
         parser.error("You cannot specify both a target and a pid")
@@ -194,10 +205,20 @@ class ControlInterface(object):
             print "Reloading process {}...".format(pid)
             os.kill(pid, RELOAD_SIGNAL)
 
+    def upgrade(self, pid):
+        if self._validate(pid):
+            print "Upgrading process {}...".format(pid)
+            os.kill(pid, UPGRADE_SIGNAL)
+
     def status(self, pid):
         if self._validate(pid):
             print "Process is running as {}.".format(pid)
 
+    def timings(self, pid):
+        if self._validate(pid):
+            print "Logging lifecycle timings of process {}...".format(pid)
+            os.kill(pid, TIMINGS_SIGNAL)
+
     def _validate(self, pid):
         try:
             os.kill(pid, 0)
@@ -232,10 +253,29 @@ class Process(ginkgo.core.Service, ginkgo.util.GlobalContext):
     umask = ginkgo.Setting("umask", default=None, help="""
         Change file mode creation mask before running
         """)
+    workers = ginkgo.Setting("workers", default=None, help="""
+        Number of worker processes to fork, each running its own instance
+        of the service. The service runs in this process if not set.
+        """)
+    upgrade_timeout = ginkgo.Setting("upgrade_timeout", default=60, help="""
+        Seconds to wait for the new process to be ready when upgrading,
+        before giving up on it and keeping this one running
+        """)
+    watch_config = ginkgo.Setting("watch_config", default=False, help="""
+        Reload when the config file changes, as well as on the reload signal
+        """)
+    watch_debounce = ginkgo.Setting("watch_debounce", default=0.5, help="""
+        Seconds the config file has to go without changing before a
+        watched change is reloaded, so a burst of writes reloads once
+        """)
 
     def __init__(self, app_factory, config=None):
         self.app_factory = app_factory
         self.app = None
+        self.worker_number = None
+        self.upgrading = None
+        self.start_dir = os.getcwd()
+        self._upgrade_fd = None
 
         self.config = config or ginkgo.settings
         self.logger = ginkgo.logger.Logger(self)
@@ -261,6 +301,18 @@ class Process(ginkgo.core.Service, ginkgo.util.GlobalContext):
         else:
             return self.app.service_name
 
+    @property
+    def inherited_fds(self):
+        """File descriptors of sockets inherited from an upgraded process"""
+        bindings = json.loads(os.environ.get(LISTEN_FDS_ENV, "[]"))
+        return [entry[0] for _, _, fds in bindings for entry in fds]
+
+    @property
+    def upgrade_fd(self):
+        """Socket to the process being upgraded from, if there is one"""
+        fd = os.environ.get(UPGRADE_FD_ENV)
+        return None if fd is None else int(fd)
+
     def do_start(self):
         if self.umask is not None:
             os.umask(self.umask)
@@ -268,14 +320,68 @@ class Process(ginkgo.core.Service, ginkgo.util.GlobalContext):
         if self.rundir is not None:
             os.chdir(self.rundir)
 
-        self.app = self.app_factory()
-        self.add_service(self.app)
+        inherited = os.environ.pop(LISTEN_FDS_ENV, None)
+        if inherited:
+            self.config.adopt_fds(json.loads(inherited))
+
+        if self.upgrade_fd is not None:
+            self._upgrade_fd = int(os.environ.pop(UPGRADE_FD_ENV))
+            try:
+                # the old process only knows the forked pid, which has
+                # already exited when the new process daemonizes
+                os.write(self._upgrade_fd, "pid {}\n".format(self.pid))
+            except OSError, e:
+                raise RuntimeError("Upgrade was cancelled: {}".format(e))
+
+        # bound now while privileges can still be dropped after, and so
+        # workers inherit them
+        self.config.bind_all(int(self.workers or 1))
+
+        if self.workers:
+            self.add_service(WorkerSupervisor(self, int(self.workers)))
+        else:
+            self.app = self.app_factory()
+            self.add_service(self.app)
+
+        if self.watch_config and self.config._last_file:
+            self.add_service(ConfigWatcher(self, self.config._last_file,
+                                           float(self.watch_debounce)))
 
         self.async.init()
-        self.async.signal(RELOAD_SIGNAL, self.reload)
-        self.async.signal(STOP_SIGNAL, self.stop)
+        self.async.signal(RELOAD_SIGNAL, self.handle_reload)
+        self.async.signal(STOP_SIGNAL, self.handle_stop)
+        self.async.signal(TIMINGS_SIGNAL, self.log_timings)
+        self.async.signal(UPGRADE_SIGNAL, self.handle_upgrade)
 
     def post_start(self):
+        old_pid = os.environ.pop(UPGRADE_PID_ENV, None)
+        if self._upgrade_fd is not None and not self._confirm_upgrade():
+            logger.error("Upgrade from process {} was cancelled, stopping."
+                         .format(old_pid))
+            os.kill(os.getpid(), STOP_SIGNAL)
+            return
+        if old_pid is not None:
+            logger.info("Upgraded from process {}.".format(old_pid))
+        self.drop_privileges()
+
+    def _confirm_upgrade(self):
+        """Tells the old process this one is ready, and waits for its answer
+
+        The old process stops itself if it accepts, and it doesn't if it
+        has given up on this one, in which case False is returned.
+        """
+        fd, self._upgrade_fd = self._upgrade_fd, None
+        try:
+            os.write(fd, "ready\n")
+            if not self.async._wait_readable(fd, self.upgrade_timeout):
+                return False
+            return os.read(fd, 64).startswith("ok")
+        except OSError:
+            return False
+        finally:
+            os.close(fd)
+
+    def drop_privileges(self):
         if self.group is not None:
             grp_record = grp.getgrnam(self.group)
             self.gid = grp_record.gr_gid
@@ -290,6 +396,7 @@ class Process(ginkgo.core.Service, ginkgo.util.GlobalContext):
 
     def do_stop(self):
         logger.info("Stopping.")
+        self.log_timings()
         self.logger.shutdown()
 
     def do_reload(self):
@@ -299,6 +406,139 @@ class Process(ginkgo.core.Service, ginkgo.util.GlobalContext):
         except RuntimeError, e:
             logger.warn(e)
 
+    def run_worker(self, number):
+        """Runs the service in a freshly forked worker process
+
+        Called in the worker by `WorkerSupervisor`, this drops privileges
+        and serves the service until the worker is told to stop. Signal
+        handlers are inherited from the master, and act on the worker's
+        service once `worker_number` is set.
+        """
+        self.pid = os.getpid()
+        self.worker_number = number
+        self.config._binding_slot = number
+        self.async.init()
+        self.drop_privileges()
+        self.app = self.app_factory()
+        self.app.serve_forever()
+
+    def handle_stop(self):
+        if self.worker_number is None:
+            self.stop()
+        elif self.app is not None and \
+                self.app.state.current in ["starting", "ready"]:
+            # a signal sent to the whole process group reaches workers
+            # twice, once directly and once forwarded by the master
+            self.app.stop()
+
+    def handle_reload(self):
+        if self.worker_number is None:
+            self.reload()
+        elif self.app is not None:
+            self.do_reload()
+            self.app.reload()
+
+    def handle_upgrade(self):
+        if self.worker_number is None:
+            self.upgrade()
+
+    def upgrade(self):
+        """Starts a new process to take over from this one
+
+        The new process is started with the same command line, and inherits
+        the listening sockets of every binding, so connections are accepted
+        throughout. It reports its pid and then that it's ready over a
+        socket pair, and this process accepts and stops itself. If it isn't
+        ready within `upgrade_timeout`, or exits first, the upgrade is
+        cancelled. It's killed, and this process carries on as before.
+        """
+        if self.upgrading is not None:
+            logger.warn("Already upgrading to process {}.".format(
+                self.upgrading))
+            return
+        ours, theirs = socket.socketpair()
+        inherited = [theirs.fileno()]
+        bindings = self.config.bound_fds()
+        for _, _, fds in bindings:
+            inherited.extend(entry[0] for entry in fds)
+        for fd in inherited:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+            fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+        environ = dict(os.environ)
+        environ[LISTEN_FDS_ENV] = json.dumps(bindings)
+        environ[UPGRADE_PID_ENV] = str(os.getpid())
+        environ[UPGRADE_FD_ENV] = str(theirs.fileno())
+        pid = os.fork()
+        if not pid:
+            try:
+                ours.close()
+                os.chdir(self.start_dir)
+                os.execve(sys.executable, [sys.executable] + sys.argv, environ)
+            finally:
+                os._exit(1)
+        theirs.close()
+        self.upgrading = pid
+        logger.info("Upgrading to process {}.".format(pid))
+        self.async.spawn(self._await_upgrade, pid, ours)
+
+    def _await_upgrade(self, pid, sock):
+        """Waits for the new process to be ready, and accepts or cancels it"""
+        fd = sock.fileno()
+        deadline = ginkgo.util.monotonic() + self.upgrade_timeout
+        new_pid, buffered, ready = pid, "", False
+        try:
+            while not ready:
+                remaining = deadline - ginkgo.util.monotonic()
+                if remaining <= 0 or \
+                        not self.async._wait_readable(fd, remaining):
+                    reason = "not ready after {}s".format(
+                        self.upgrade_timeout)
+                    break
+                data = os.read(fd, 1024)
+                if not data:
+                    reason = "exited before it was ready"
+                    break
+                lines = (buffered + data).split("\n")
+                buffered = lines.pop()
+                for line in lines:
+                    if line.startswith("pid "):
+                        new_pid = int(line[4:])
+                    ready = ready or line == "ready"
+            if ready:
+                os.write(fd, "ok\n")
+        except OSError, e:
+            ready, reason = False, str(e)
+        finally:
+            sock.close()
+            self._reap(pid)
+        if ready:
+            logger.info("Upgraded to process {}, stopping.".format(new_pid))
+            os.kill(os.getpid(), STOP_SIGNAL)
+        else:
+            self.upgrade_cancelled(new_pid, reason)
+
+    def upgrade_cancelled(self, pid, reason):
+        """Kills a new process that didn't take over from this one"""
+        logger.error("Process {} {}, upgrade cancelled.".format(pid, reason))
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self._reap(pid, 0)
+        self.upgrading = None
+
+    def _reap(self, pid, options=os.WNOHANG):
+        # the new process is only a child of this one when not daemonized
+        try:
+            os.waitpid(pid, options)
+        except OSError:
+            pass
+
+    def log_timings(self, *args):
+        """Logs startup and shutdown timings of the service tree"""
+        logger.info("Lifecycle timings:\n{}".format(
+            ginkgo.core.timing_report(self)))
+
     def trigger_hook(self, name, *args, **kwargs):
         """ Experimental """
         hook = self.config.get(name)
@@ -318,6 +558,261 @@ class Process(ginkgo.core.Service, ginkgo.util.GlobalContext):
         self.__class__._pop_context()
 
 
+class Worker(object):
+    """Record of a forked worker process kept by `WorkerSupervisor`"""
+
+    def __init__(self, number):
+        self.number = number
+        self.pid = None
+        self.started = None
+        self.restart_at = None
+        self.failures = 0
+
+    def __repr__(self):
+        return "<Worker {} pid={}>".format(self.number, self.pid)
+
+class WorkerSupervisor(ginkgo.core.Service):
+    """Forks and supervises worker processes running the service
+
+    Everything set up by the master before this service starts, such as
+    loaded configuration and modules, is shared with workers as they fork.
+    Workers that exit while the supervisor is running are restarted after
+    a backoff that doubles with each failure in a row, up to `max_backoff`.
+    A worker that ran for longer than `max_backoff` before exiting starts
+    over with the shortest backoff. Restarts are forked by the supervising
+    task itself rather than from timers, so there's one place workers are
+    forked from once started.
+
+    Reloading the supervisor sends the reload signal on to every worker.
+    Stopping it sends the stop signal, and kills any workers still running
+    after `stop_timeout`.
+    """
+    stop_timeout = ginkgo.util.defaultproperty(int, 10)
+    check_interval = ginkgo.util.defaultproperty(float, 0.5)
+    min_backoff = ginkgo.util.defaultproperty(float, 0.1)
+    max_backoff = ginkgo.util.defaultproperty(float, 30)
+
+    def __init__(self, process, count):
+        self.process = process
+        self.master_pid = os.getpid()
+        self.workers = [Worker(n) for n in xrange(count)]
+
+    def do_start(self):
+        self.master_pid = os.getpid()
+        for worker in self.workers:
+            self.fork(worker)
+        self.spawn(self._supervise)
+
+    def do_reload(self):
+        self._signal_workers(RELOAD_SIGNAL)
+
+    def do_stop(self):
+        self._signal_workers(STOP_SIGNAL)
+        deadline = ginkgo.util.monotonic() + self.stop_timeout
+        while self.running and ginkgo.util.monotonic() < deadline:
+            self.async.sleep(0.05)
+            self.reap()
+        for worker in self.running:
+            logger.warn("Killing worker {} ({}) after {}s.".format(
+                worker.number, worker.pid, self.stop_timeout))
+            self._signal_workers(signal.SIGKILL, [worker])
+            os.waitpid(worker.pid, 0)
+            worker.pid = None
+
+    @property
+    def running(self):
+        return [w for w in self.workers if w.pid is not None]
+
+    def fork(self, worker):
+        """Forks a worker process, which runs the service until stopped"""
+        if os.getpid() != self.master_pid or \
+                self.state.current not in ["starting", "ready"]:
+            # restarts scheduled before a fork are inherited by workers
+            return
+        pid = os.fork()
+        if pid:
+            worker.pid = pid
+            worker.started = ginkgo.util.monotonic()
+            logger.info("Started worker {} as {}.".format(worker.number, pid))
+            return
+        code = 0
+        try:
+            self.process.run_worker(worker.number)
+        except:
+            traceback.print_exc()
+            code = 1
+        finally:
+            os._exit(code)
+
+    def reap(self):
+        """Collects exited workers, scheduling restarts if still running"""
+        for worker in self.running:
+            try:
+                pid, status = os.waitpid(worker.pid, os.WNOHANG)
+            except OSError:
+                pid, status = worker.pid, 0
+            if not pid:
+                continue
+            worker.pid = None
+            if self.state.current not in ["starting", "ready"]:
+                continue
+            uptime = ginkgo.util.monotonic() - worker.started
+            if uptime > self.max_backoff:
+                worker.failures = 0
+            backoff = min(self.min_backoff * 2 ** worker.failures,
+                          self.max_backoff)
+            worker.failures += 1
+            logger.warn("Worker {} ({}) exited with status {}, "
+                        "restarting in {:.1f}s.".format(
+                            worker.number, pid, status, backoff))
+            worker.restart_at = ginkgo.util.monotonic() + backoff
+
+    def restart_due(self):
+        """Forks workers whose restart backoff has passed"""
+        now = ginkgo.util.monotonic()
+        for worker in self.workers:
+            if worker.pid is None and worker.restart_at is not None and \
+                    worker.restart_at <= now:
+                worker.restart_at = None
+                self.fork(worker)
+
+    def _supervise(self):
+        # forked workers inherit this task, but only the master runs it
+        while os.getpid() == self.master_pid and \
+                self.state.current in ["starting", "ready"]:
+            self.reap()
+            self.restart_due()
+            self.async.sleep(self.check_interval)
+
+    def _signal_workers(self, signum, workers=None):
+        for worker in workers or self.running:
+            try:
+                os.kill(worker.pid, signum)
+            except OSError:
+                pass
+
+class ConfigWatcher(ginkgo.core.Service):
+    """Reloads the process when its config file changes
+
+    The file is watched with inotify where it's available, and otherwise
+    by checking its modification time, size and inode every
+    `poll_interval`. A burst of changes, such as a tool rewriting the file
+    several times, is coalesced into one reload once the file has been
+    quiet for `debounce` seconds, or at most `max_delay` after the first
+    change. The reload is skipped if the content hash hasn't changed.
+
+    Reloads go through the process as the reload signal does. Each is
+    logged with its latency from the first change, which is also kept in
+    `counters`.
+    """
+    poll_interval = ginkgo.util.defaultproperty(float, 1)
+    max_delay = ginkgo.util.defaultproperty(float, 5)
+
+    def __init__(self, process, path, debounce=0.5):
+        self.process = process
+        self.path = path
+        self.debounce = debounce
+        self.pid = os.getpid()
+        self._inotify = None
+        self._stat = None
+        self._digest = None
+        self._counters = dict(events=0, reloads=0, skipped=0,
+                              last_latency=None, max_latency=None)
+
+    @property
+    def counters(self):
+        """Counts of changes seen, reloads and skipped reloads, and latency
+
+        Latencies are in seconds from the first change of a burst to the
+        end of its reload.
+        """
+        return dict(self._counters, inotify=self._inotify is not None)
+
+    def do_start(self):
+        self.pid = os.getpid()
+        try:
+            self._inotify = ginkgo.util.Inotify(self.path)
+        except OSError, e:
+            logger.info("Polling {} for changes, inotify not usable: {}"
+                        .format(self.path, e))
+        self._stat = self._signature()
+        self._digest = self._hash()
+        self.spawn(self._watch)
+
+    def do_stop(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+
+    def _watch(self):
+        # forked workers inherit this task, but only the master runs it
+        while os.getpid() == self.pid and \
+                self.state.current in ["starting", "ready"]:
+            if not self._changed(self.poll_interval):
+                continue
+            first = ginkgo.util.monotonic()
+            while ginkgo.util.monotonic() - first < self.max_delay and \
+                    self._changed(self.debounce):
+                pass
+            if os.getpid() == self.pid:
+                self._reload(first)
+
+    def _changed(self, timeout):
+        """Waits up to `timeout` for the file to change"""
+        inotify = self._inotify
+        if inotify is None:
+            self.async.sleep(timeout)
+            stat, self._stat = self._stat, self._signature()
+            changed = stat != self._stat
+        else:
+            deadline = ginkgo.util.monotonic() + timeout
+            changed = False
+            while not changed:
+                remaining = deadline - ginkgo.util.monotonic()
+                if remaining <= 0 or inotify.fd < 0 or \
+                        not self.async._wait_readable(inotify.fd, remaining):
+                    break
+                if os.getpid() != self.pid or inotify.fd < 0:
+                    break
+                changed = inotify.read() > 0
+        self._counters["events"] += changed
+        return changed
+
+    def _reload(self, first):
+        digest = self._hash()
+        if digest is None:
+            logger.warn("Config file {} is missing, not reloading."
+                        .format(self.path))
+            return
+        if digest == self._digest:
+            self._counters["skipped"] += 1
+            logger.debug("Config file {} changed but its content didn't, "
+                         "not reloading.".format(self.path))
+            return
+        self._digest = digest
+        self.process.handle_reload()
+        latency = ginkgo.util.monotonic() - first
+        counters = self._counters
+        counters["reloads"] += 1
+        counters["last_latency"] = latency
+        counters["max_latency"] = max(latency, counters["max_latency"])
+        logger.info("Reloaded config file {} {:.3f}s after it changed."
+                    .format(self.path, latency))
+
+    def _signature(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_mtime, st.st_size, st.st_ino)
+
+    def _hash(self):
+        try:
+            with open(self.path, "rb") as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        except IOError:
+            return None
+
 class DaemonProcess(Process):
     pidfile = ginkgo.Setting("pidfile", default=None, help="""
         Path to pidfile to use when daemonizing
@@ -334,8 +829,10 @@ class DaemonProcess(Process):
 
     def do_start(self):
         ginkgo.util.prevent_core_dump()
-        ginkgo.util.daemonize(
-            preserve_fds=self.logger.file_descriptors)
+        preserve_fds = self.logger.file_descriptors + self.inherited_fds
+        if self.upgrade_fd is not None:
+            preserve_fds.append(self.upgrade_fd)
+        ginkgo.util.daemonize(preserve_fds=preserve_fds)
         self.logger.capture_stdio()
         self.pid = os.getpid()
         self.pidfile.create(self.pid)
@@ -345,3 +842,24 @@ class DaemonProcess(Process):
         super(DaemonProcess, self).do_stop()
         self.pidfile.unlink()
 
+    def upgrade(self):
+        if self.upgrading is not None:
+            return super(DaemonProcess, self).upgrade()
+        # moved aside so the new process can create the pidfile, and
+        # unlinked from there when this process stops
+        fname = self.pidfile.fname
+        self.pidfile.rename(fname + ".oldpid")
+        try:
+            super(DaemonProcess, self).upgrade()
+        except:
+            self.pidfile.rename(fname)
+            raise
+
+    def upgrade_cancelled(self, pid, reason):
+        super(DaemonProcess, self).upgrade_cancelled(pid, reason)
+        if self.pidfile.fname.endswith(".oldpid"):
+            try:
+                self.pidfile.rename(self.pidfile.fname[:-len(".oldpid")])
+            except RuntimeError, e:
+                logger.warn(e)
+
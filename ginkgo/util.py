@@ -7,7 +7,11 @@ Ginkgo modules very dense in readable domain specific code.
 import resource
 import os
 import errno
+import socket
+import struct
+import sys
 import tempfile
+import time
 
 
 class defaultproperty(object):
@@ -35,6 +39,36 @@ class defaultproperty(object):
                     return newval
 
 
+def _monotonic_clock():
+    """Returns a monotonic clock function, falling back to `time.time`"""
+    if hasattr(time, "monotonic"):
+        return time.monotonic
+    if sys.platform.startswith("linux"):
+        try:
+            import ctypes
+            import ctypes.util
+
+            class timespec(ctypes.Structure):
+                _fields_ = [("tv_sec", ctypes.c_long),
+                            ("tv_nsec", ctypes.c_long)]
+
+            librt = ctypes.CDLL(ctypes.util.find_library("rt") or "librt.so.1")
+            clock_gettime = librt.clock_gettime
+            clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+            CLOCK_MONOTONIC = 1
+
+            def monotonic():
+                t = timespec()
+                clock_gettime(CLOCK_MONOTONIC, ctypes.pointer(t))
+                return t.tv_sec + t.tv_nsec * 1e-9
+            monotonic()
+            return monotonic
+        except (OSError, AttributeError):
+            pass
+    return time.time
+
+monotonic = _monotonic_clock()
+
 def daemonize(preserve_fds=None):
     """\
     Standard daemonization of a process.
@@ -76,6 +110,116 @@ def daemonize(preserve_fds=None):
     os.dup2(0, 1)
     os.dup2(0, 2)
 
+SD_LISTEN_FDS_START = 3
+SO_DOMAIN = getattr(socket, "SO_DOMAIN", 39)
+
+_listen_fds = None
+
+def listen_fds():
+    """\
+    Sockets passed in by socket activation, as a dict of lists by name.
+    Implements the receiving end of the systemd LISTEN_FDS protocol. The
+    variables are removed from the environment so child processes don't
+    take them for their own, and the result is kept for later calls.
+    http://www.freedesktop.org/software/systemd/man/sd_listen_fds.html
+    """
+    global _listen_fds
+    if _listen_fds is None:
+        _listen_fds = {}
+        if os.environ.get("LISTEN_PID") == str(os.getpid()):
+            count = int(os.environ.get("LISTEN_FDS") or 0)
+            names = os.environ.get("LISTEN_FDNAMES", "").split(":")
+            for i in xrange(count):
+                name = names[i] if i < len(names) and names[i] else "unknown"
+                fd = SD_LISTEN_FDS_START + i
+                _listen_fds.setdefault(name, []).append(socket_fromfd(fd))
+                os.close(fd)
+        for name in ("LISTEN_PID", "LISTEN_FDS", "LISTEN_FDNAMES"):
+            os.environ.pop(name, None)
+    return _listen_fds
+
+def socket_fromfd(fd, family=None, type=None):
+    """\
+    Creates a socket object from a duplicate of the file descriptor,
+    looking up its family and type if they're not given. Unlike
+    `socket.fromfd`, this gives a full `socket.socket` object.
+    """
+    if family is None or type is None:
+        probe = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        family = probe.getsockopt(socket.SOL_SOCKET, SO_DOMAIN)
+        type = probe.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE)
+        probe.close()
+    return socket.socket(family, type, _sock=socket.fromfd(fd, family, type))
+
+class Inotify(object):
+    """\
+    Linux inotify watch on a single file, read without blocking.
+    The file's directory is watched rather than the file itself, so the
+    watch survives editors and tools that replace the file by renaming a
+    new one over it. Raises OSError where inotify isn't available.
+    """
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_NONBLOCK = 0x800
+    IN_CLOEXEC = 0x80000
+
+    mask = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+            IN_MOVED_TO | IN_CREATE | IN_DELETE)
+
+    _event = struct.Struct("iIII")
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.directory, self.name = os.path.split(self.path)
+        try:
+            import ctypes
+            import ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (ImportError, OSError, AttributeError), e:
+            raise OSError(errno.ENOSYS, "inotify unavailable: {}".format(e))
+        self.fd = init(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        if add_watch(self.fd, self.directory, self.mask) < 0:
+            err = ctypes.get_errno()
+            self.close()
+            raise OSError(err, os.strerror(err), self.directory)
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        """Returns the number of pending events for the watched file"""
+        count = 0
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError, e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return count
+                raise
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = self._event.unpack_from(data, offset)
+                offset += self._event.size
+                name = data[offset:offset + length].rstrip("\0")
+                offset += length
+                # on overflow events were dropped, so assume it changed
+                count += name == self.name or bool(mask & self.IN_Q_OVERFLOW)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
 def prevent_core_dump():
     """ Prevent this process from generating a core dump.
 
@@ -109,6 +253,8 @@ class AbstractStateMachine(object):
         self._state = self.initial_state
         self._subject = subject
         self._waitables = {}
+        self.entered = {self._state: monotonic()}
+        self.hook_durations = {}
         if hasattr(self._subject, 'async'):
             self.event_class = self._subject.async.event
         for state in self.allow_wait:
@@ -118,6 +264,22 @@ class AbstractStateMachine(object):
     def current(self):
         return self._state
 
+    def duration(self, from_state, to_state):
+        """Seconds between the last time entering two states, if in order"""
+        try:
+            elapsed = self.entered[to_state] - self.entered[from_state]
+        except KeyError:
+            return None
+        return elapsed if elapsed >= 0 else None
+
+    def measure(self, name, func, *args, **kwargs):
+        """Calls `func`, recording how long it took under hook `name`"""
+        started = monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.hook_durations[name] = monotonic() - started
+
     def wait(self, state, timeout=None):
         if state in self._waitables:
             self._waitables[state].wait(timeout)
@@ -143,11 +305,12 @@ class AbstractStateMachine(object):
 
     def _callback(self, name):
         if name is not None and hasattr(self._subject, name):
-            getattr(self._subject, name)()
+            self.measure(name, getattr(self._subject, name))
 
     def _transition(self, new_state):
         for state in self._waitables:
             self._waitables[state].clear()
+        self.entered[new_state] = monotonic()
         self._state = new_state
         if new_state in self._waitables:
             self._waitables[new_state].set()
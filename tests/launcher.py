@@ -0,0 +1,62 @@
+"""Socket activation launcher for trying out LISTEN_FDS locally
+
+Binds a listening socket for each name=address given, then runs the command
+with them passed in the way systemd does. The launcher holds the sockets, so
+with --restart the command is run again whenever it exits without any
+connections being refused in between:
+
+    python tests/launcher.py http=127.0.0.1:8000 -- ginkgo app.conf.py
+
+"""
+import os
+import socket
+import sys
+
+from ginkgo.config import parse_address
+from ginkgo.util import SD_LISTEN_FDS_START
+
+def bind(address, backlog=128):
+    family, address = parse_address(address)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+def launch(sockets, argv):
+    """Runs argv with (name, socket) pairs passed in, returning its pid"""
+    pid = os.fork()
+    if pid:
+        return pid
+    try:
+        # moved out of the way first, in case they overlap their targets
+        fds = [os.dup(sock.fileno()) for _, sock in sockets]
+        for i, fd in enumerate(fds):
+            os.dup2(fd, SD_LISTEN_FDS_START + i)
+            os.close(fd)
+        os.environ.update(
+            LISTEN_PID=str(os.getpid()),
+            LISTEN_FDS=str(len(sockets)),
+            LISTEN_FDNAMES=":".join(name for name, _ in sockets))
+        os.execvp(argv[0], argv)
+    finally:
+        os._exit(127)
+
+def main(args):
+    restart = "--restart" in args
+    args = [a for a in args if a != "--restart"]
+    if "--" not in args:
+        print __doc__
+        return 2
+    split = args.index("--")
+    sockets = []
+    for spec in args[:split]:
+        name, address = spec.split("=", 1)
+        sockets.append((name, bind(address)))
+    while True:
+        _, status = os.waitpid(launch(sockets, args[split+1:]), 0)
+        if not restart:
+            return os.WEXITSTATUS(status)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,825 @@
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+import unittest
+
+from nose.plugins.skip import SkipTest
+
+import ginkgo
+from ginkgo import async
+from ginkgo.core import Service
+
+def checksum(data):
+    return len(data), sum(bytearray(data[:1024])), os.getpid()
+
+class GeventTestCase(unittest.TestCase):
+    """Runs services created by its tests with the gevent driver"""
+
+    def setUp(self):
+        self.async = ginkgo.settings.get("async", "ginkgo.async.threading")
+        ginkgo.settings.set("async", "ginkgo.async.gevent")
+
+    def tearDown(self):
+        ginkgo.settings.set("async", self.async)
+
+class DriverRegistryTest(unittest.TestCase):
+    def test_driver_is_imported_once(self):
+        first = async.load_driver("ginkgo.async.gevent")
+        second = async.load_driver("ginkgo.async.gevent")
+        assert first is second
+        assert isinstance(Service().async, async.load_driver(
+            ginkgo.settings.get("async", "ginkgo.async.threading")))
+
+    def test_drivers_provide_primitives(self):
+        drivers = ["gevent", "threading"]
+        try:
+            import eventlet
+            drivers.append("eventlet")
+        except ImportError:
+            pass
+        for driver in drivers:
+            manager = async.load_driver("ginkgo.async." + driver)()
+            with manager.lock():
+                pass
+            queue = manager.queue()
+            queue.put(1)
+            assert queue.get() == 1
+            event = manager.event()
+            event.set()
+            event.wait(1)
+
+    def test_unknown_driver_fails_to_load(self):
+        class BadService(Service):
+            async = "ginkgo.async.nonexistent"
+        self.assertRaises(RuntimeError, BadService)
+
+class SharedManagerTest(unittest.TestCase):
+    def setUp(self):
+        ginkgo.settings.set("async_shared", True)
+
+    def tearDown(self):
+        ginkgo.settings.set("async_shared", False)
+
+    def test_services_share_root_manager(self):
+        class GeventService(Service):
+            async = "ginkgo.async.gevent"
+        a, b = GeventService(), GeventService()
+        root = async.shared_manager("ginkgo.async.gevent")
+        assert a.async is not b.async
+        assert a.async.root is root and b.async.root is root
+        assert a.async in a._children
+
+    def test_stopping_service_stops_its_tasks(self):
+        class GeventService(Service):
+            async = "ginkgo.async.gevent"
+            def do_start(self):
+                self.task = self.spawn(self.async.sleep, 10)
+        a, b = GeventService(), GeventService()
+        a.start()
+        b.start()
+        a.stop()
+        assert a.task.dead
+        assert not b.task.dead
+        b.stop()
+        assert b.task.dead
+
+    def test_root_runs_while_task_groups_do(self):
+        class ThreadedService(Service):
+            async = "ginkgo.async.threading"
+            def do_start(self):
+                self.spawn_later(60, lambda: None)
+        root = async.shared_manager("ginkgo.async.threading")
+        a, b = ThreadedService(), ThreadedService()
+        a.start()
+        b.start()
+        assert root.ready
+        scheduler = root.scheduler
+        a.stop()
+        assert root.ready
+        b.stop()
+        assert root.state.current == "stopped"
+        assert not scheduler._thread.is_alive()
+        a.start()
+        assert root.ready
+        a.stop()
+
+    def test_groups_leave_manager_they_didnt_start_running(self):
+        from ginkgo.async.threading import AsyncManager
+        root = AsyncManager()
+        root.start()
+        group = root.task_group()
+        group.start()
+        group.stop()
+        assert root.ready
+        root.stop()
+
+    def test_eventlet_group_timers_stop_with_root(self):
+        try:
+            import eventlet
+        except ImportError:
+            raise SkipTest("eventlet is not installed")
+        root = async.load_driver("ginkgo.async.eventlet")()
+        fired = []
+        root.start()
+        group = root.task_group()
+        group.start()
+        group.spawn_later(0.01, fired.append, 1)
+        group.spawn_later(0.05, fired.append, 2)
+        root.sleep(0.03)
+        assert fired == [1]
+        root.stop()
+        root.sleep(0.05)
+        assert fired == [1]
+        assert not root._timers and not group._timers
+
+class ThreadingManagerTest(unittest.TestCase):
+    def setUp(self):
+        from ginkgo.async import threading
+        self.threading = threading
+
+    def test_finished_threads_are_untracked(self):
+        manager = self.threading.AsyncManager()
+        threads = [manager.spawn(lambda: None) for _ in range(20)]
+        for t in threads:
+            t.join()
+        assert len(manager._tasks) == 0
+        assert manager.counters["completed"] == 20
+
+    def test_pool_reuses_bounded_workers(self):
+        manager = self.threading.AsyncManager()
+        manager.max_workers = 2
+        release = manager.event()
+        tasks = [manager.spawn(release.wait) for _ in range(5)]
+        time.sleep(0.1)
+        assert manager.pool.workers == 2
+        assert manager.counters["active"] == 2
+        assert manager.counters["queued"] == 3
+        release.set()
+        for t in tasks:
+            assert t.join(1)
+        assert manager.counters["completed"] == 5
+        assert len(manager._tasks) == 0
+        pool = manager.pool
+        manager.start()
+        manager.stop()
+        assert pool.workers == 0
+
+    def test_pool_reaps_idle_workers(self):
+        pool = self.threading.WorkerPool(min_workers=1, max_workers=4,
+                                         idle_timeout=0.2)
+        tasks = [pool.submit(time.sleep, 0.05) for _ in range(4)]
+        for t in tasks:
+            t.join()
+        assert pool.workers == 4
+        time.sleep(0.5)
+        assert pool.workers == 1
+        pool.close(1)
+        assert pool.workers == 0
+
+    def test_idle_worker_stays_for_task_submitted_as_it_retires(self):
+        import Queue
+        pool = self.threading.WorkerPool(max_workers=1, idle_timeout=0.01)
+        get = pool._queue.get
+        raced = []
+        def get_racing_submit(timeout=None):
+            if not raced:
+                raced.append(pool.submit(lambda: None))
+                raise Queue.Empty
+            return get(timeout=timeout)
+        pool._queue.get = get_racing_submit
+        first = pool.submit(lambda: None)
+        assert first.join(1) and raced[0].join(1)
+        pool.close(1)
+
+    def test_pool_close_cancels_queued_tasks(self):
+        pool = self.threading.WorkerPool(max_workers=1)
+        release = threading.Event()
+        running = pool.submit(release.wait)
+        queued = [pool.submit(time.sleep, 0) for _ in range(3)]
+        time.sleep(0.05)
+        closer = threading.Thread(target=pool.close)
+        closer.start()
+        time.sleep(0.05)
+        release.set()
+        closer.join(1)
+        assert running.join(1) and not running.cancelled
+        for task in queued:
+            assert task.join(1) and task.cancelled
+        assert pool._unfinished == 0
+
+    def test_spawn_later_uses_one_scheduler_thread(self):
+        manager = self.threading.AsyncManager()
+        fired = []
+        threads = threading.active_count()
+        manager.spawn_later(0.05, fired.append, 1)
+        pending = [manager.spawn_later(60, fired.append, 2)
+                   for _ in range(100)]
+        assert threading.active_count() == threads + 1
+        assert pending[0].cancel()
+        assert not pending[0].is_alive()
+        assert len(manager.scheduler) == 100
+        time.sleep(0.2)
+        assert fired == [1]
+        scheduler = manager.scheduler
+        manager.start()
+        manager.stop()
+        assert len(manager._tasks) == 0
+        assert not scheduler._thread.is_alive()
+
+    def test_full_pool_queue_doesnt_block_scheduler(self):
+        manager = self.threading.AsyncManager()
+        manager.max_workers = 1
+        manager.queue_size = 1
+        release = threading.Event()
+        fired = []
+        manager.spawn(release.wait)
+        tasks = [manager.spawn_later(0, fired.append, n) for n in range(3)]
+        timer = threading.Event()
+        manager.scheduler.schedule(0.05, timer.set)
+        try:
+            assert timer.wait(1)
+        finally:
+            release.set()
+        for task in tasks:
+            assert task.join(1)
+        assert fired == [0, 1, 2]
+        manager.start()
+        manager.stop()
+
+    def test_waits_wake_immediately(self):
+        manager = self.threading.AsyncManager()
+        event = manager.event()
+        manager.spawn_later(0.01, event.set)
+        started = time.time()
+        assert event.wait(5)
+        assert time.time() - started < 0.5
+        assert not manager.event().wait(0.01)
+
+    def test_waiting_threads_open_no_fds(self):
+        event = self.threading.Event()
+        fds = len(os.listdir("/proc/self/fd"))
+        threads = [threading.Thread(target=event.wait) for _ in range(50)]
+        for t in threads:
+            t.start()
+        try:
+            time.sleep(0.1)
+            assert len(os.listdir("/proc/self/fd")) == fds
+        finally:
+            event.set()
+        for t in threads:
+            t.join(1)
+            assert not t.is_alive()
+
+    def test_signal_wakes_blocked_main_thread(self):
+        manager = self.threading.AsyncManager()
+        event = manager.event()
+        manager.signal(signal.SIGUSR2, event.set)
+        try:
+            manager.spawn_later(0.01, os.kill, os.getpid(), signal.SIGUSR2)
+            started = time.time()
+            event.wait()
+            assert time.time() - started < 0.5
+        finally:
+            signal.signal(signal.SIGUSR2, signal.SIG_DFL)
+
+class SpawnPoolTest(unittest.TestCase):
+    def check_admission(self, manager):
+        pool = manager.spawn_pool("fanout", 2)
+        assert manager.spawn_pool("fanout") is pool
+        release = manager.event()
+        pool.spawn(release.wait)
+        pool.spawn(release.wait)
+        self.assertRaises(async.PoolFull, pool.spawn_nowait, release.wait)
+        self.assertRaises(async.PoolFull, pool.spawn_timeout, 0.05,
+                          release.wait)
+        assert pool.counters["in_flight"] == 2
+        assert pool.counters["rejected"] == 2
+        release.set()
+        pool.spawn_timeout(1, release.wait)
+        manager.sleep(0.05)
+        assert pool.counters["completed"] == 3
+        assert pool.counters["in_flight"] == 0
+        assert pool.counters["max_wait"] > 0
+
+    def test_gevent_pool(self):
+        self.check_admission(async.load_driver("ginkgo.async.gevent")())
+
+    def test_threading_pool(self):
+        self.check_admission(async.load_driver("ginkgo.async.threading")())
+
+    def test_tasks_inherit_deadline(self):
+        manager = async.load_driver("ginkgo.async.gevent")()
+        pool = manager.spawn_pool("deadlines", 1)
+        with manager.timeout(5) as deadline:
+            task = pool.spawn(lambda: manager.deadline)
+        assert task.get() is deadline
+
+    def test_killed_task_releases_slot(self):
+        manager = async.load_driver("ginkgo.async.gevent")()
+        pool = manager.spawn_pool("killed", 1)
+        pool.spawn(manager.sleep, 1).kill()
+        manager.sleep(0)
+        assert pool.counters["in_flight"] == 0
+        pool.spawn_nowait(lambda: None).join()
+        assert pool.counters["completed"] == 2
+
+    def test_pool_needs_size(self):
+        manager = async.load_driver("ginkgo.async.gevent")()
+        self.assertRaises(RuntimeError, manager.spawn_pool, "unsized")
+
+class DeadlineTest(unittest.TestCase):
+    def test_gevent_timeout_interrupts(self):
+        manager = async.load_driver("ginkgo.async.gevent")()
+        try:
+            with manager.timeout(0.05) as deadline:
+                manager.sleep(1)
+        except async.DeadlineExceeded, e:
+            assert e.deadline is deadline
+        else:
+            assert False, "DeadlineExceeded not raised"
+        assert manager.deadline is None
+
+    def test_nested_timeouts_keep_earliest_deadline(self):
+        manager = async.load_driver("ginkgo.async.threading")()
+        with manager.timeout(0.5) as outer:
+            with manager.timeout(10) as inner:
+                assert inner is outer
+                assert manager.deadline.remaining() <= 0.5
+            with manager.timeout(0.01) as inner:
+                assert inner is not outer
+                time.sleep(0.02)
+                assert inner.expired
+                self.assertRaises(async.DeadlineExceeded, inner.check)
+            assert manager.deadline is outer
+        assert manager.deadline is None
+
+    def test_spawned_tasks_inherit_deadline(self):
+        class GeventService(Service):
+            async = "ginkgo.async.gevent"
+        service = GeventService()
+        seen = []
+        def task():
+            seen.append(service.async.deadline)
+        with service.async.timeout(1) as deadline:
+            service.spawn(task).join()
+        service.spawn(task).join()
+        assert seen == [deadline, None]
+
+class ProcessPoolTest(unittest.TestCase):
+    def check_offload(self, manager):
+        from ginkgo.async.multiprocessing import SharedBuffer
+        manager.start()
+        try:
+            data = "x" * (2 << 20)
+            with SharedBuffer(data) as buf:
+                size, total, pid = manager.run_in_process(checksum, buf)
+            assert size == len(data)
+            assert total == ord("x") * 1024
+            assert pid != os.getpid()
+        finally:
+            pool = manager.process_pool
+            manager.stop()
+        assert pool.state.current == "stopped"
+        assert pool._pool is None
+
+    def test_gevent_offload(self):
+        self.check_offload(async.load_driver("ginkgo.async.gevent")())
+
+    def test_multiprocessing_manager_starts_warm_pool(self):
+        manager = async.load_driver("ginkgo.async.multiprocessing")()
+        manager.start()
+        assert manager.process_pool.ready
+        manager.stop()
+        self.check_offload(manager)
+
+    def test_task_group_pool_stops_with_last_group(self):
+        class GeventService(Service):
+            async = "ginkgo.async.gevent"
+        ginkgo.settings.set("async_shared", True)
+        try:
+            a, b = GeventService(), GeventService()
+        finally:
+            ginkgo.settings.set("async_shared", False)
+        a.start()
+        b.start()
+        assert a.async.run_in_process(checksum, "x")[2] != os.getpid()
+        pool = b.async.process_pool
+        assert pool is a.async.process_pool
+        a.stop()
+        assert pool.ready
+        b.stop()
+        assert pool.state.current == "stopped"
+        assert pool._pool is None
+
+class ServerBindingTest(GeventTestCase):
+    def test_stream_server_on_binding(self):
+        from ginkgo.async.gevent import StreamServer
+        import gevent.socket
+        ginkgo.settings.set("echo_bind", "127.0.0.1:0")
+        class EchoService(Service):
+            bind = ginkgo.Binding("echo_bind")
+            def __init__(self):
+                self.add_service(StreamServer(self.bind, self.echo))
+            def echo(self, sock, address):
+                sock.sendall(sock.recv(64))
+        service = EchoService()
+        address = service.bind.getsockname()
+        for _ in range(2):
+            service.start()
+            client = gevent.socket.create_connection(address)
+            client.sendall("ping")
+            assert client.recv(64) == "ping"
+            client.close()
+            service.stop()
+            assert service.bind.getsockname() == address
+            service = EchoService()
+
+class SocketActivationTest(unittest.TestCase):
+    def test_listen_fds_ignored_for_other_pid(self):
+        from ginkgo import util
+        os.environ.update(LISTEN_PID="1", LISTEN_FDS="1", LISTEN_FDNAMES="x")
+        saved, util._listen_fds = util._listen_fds, None
+        try:
+            assert util.listen_fds() == {}
+            assert "LISTEN_FDS" not in os.environ
+        finally:
+            util._listen_fds = saved
+
+    def test_server_adopts_activated_socket(self):
+        import launcher
+        sock = launcher.bind("127.0.0.1:0")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        pid = launcher.launch([("other", launcher.bind("127.0.0.1:0")),
+                               ("echo", sock)], [sys.executable, "-c", """
+import sys; sys.path.insert(0, %r)
+import ginkgo
+ginkgo.settings.set("async", "ginkgo.async.gevent")
+from ginkgo.async.gevent import StreamServer
+def echo(sock, address):
+    sock.sendall(sock.recv(64))
+StreamServer(("127.0.0.1", 1), echo, fd_name="echo").serve_forever()
+""" % root])
+        try:
+            client = socket.create_connection(sock.getsockname(), 5)
+            client.sendall("ping")
+            assert client.recv(64) == "ping"
+        finally:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+
+class ServerDrainTest(GeventTestCase):
+    def request(self, address, path, keep_alive=False):
+        import gevent.socket
+        client = gevent.socket.create_connection(address)
+        client.sendall("GET {} HTTP/1.1\r\nHost: test\r\n{}\r\n".format(
+            path, "" if keep_alive else "Connection: close\r\n"))
+        return client
+
+    def server(self, grace_period):
+        from ginkgo.async.gevent import WSGIServer
+        import gevent
+        def app(environ, start_response):
+            gevent.sleep(float(environ["PATH_INFO"][1:]))
+            start_response("200 OK", [("Content-Length", "2")])
+            return ["ok"]
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(16)
+        server = WSGIServer(listener, app, log=None,
+                            grace_period=grace_period)
+        server.start()
+        return server
+
+    def test_active_requests_finish_and_idle_are_closed(self):
+        import gevent
+        server = self.server(grace_period=2)
+        idle = self.request(server.address, "/0", keep_alive=True)
+        assert idle.recv(1024).endswith("ok")
+        active = self.request(server.address, "/0.3")
+        gevent.sleep(0.1)
+        started = time.time()
+        server.stop()
+        assert time.time() - started < 1
+        assert server.cut_off == 0
+        assert active.recv(1024).endswith("ok")
+        assert idle.recv(1024) == ""
+
+    def test_requests_over_grace_period_are_cut_off(self):
+        import gevent
+        server = self.server(grace_period=0.2)
+        self.request(server.address, "/5")
+        gevent.sleep(0.1)
+        started = time.time()
+        server.stop()
+        assert time.time() - started < 1.5
+        assert server.cut_off == 1
+
+    def test_reload_closes_keep_alive_after_request(self):
+        server = self.server(grace_period=1)
+        client = self.request(server.address, "/0.2", keep_alive=True)
+        import gevent
+        gevent.sleep(0.1)
+        server.reload()
+        response = client.recv(1024)
+        assert "Connection: close" in response
+        assert response.endswith("ok")
+        assert client.recv(1024) == ""
+        assert server.connections == 0
+        server.stop()
+
+class AdaptiveLimitTest(GeventTestCase):
+    def test_limit_grows_when_busy_and_fast(self):
+        from ginkgo.async.gevent import AdaptiveLimit
+        from ginkgo.util import monotonic
+        limit = AdaptiveLimit(initial=4, latency_target=1)
+        for _ in range(40):
+            for _ in range(4):
+                assert limit.acquire()
+            for _ in range(4):
+                limit.release(monotonic())
+        assert limit.counters["limit"] > 4
+        assert limit.counters["congested"] == 0
+
+    def test_limit_cut_once_per_burst_of_slow_requests(self):
+        from ginkgo.async.gevent import AdaptiveLimit
+        from ginkgo.util import monotonic
+        limit = AdaptiveLimit(initial=10, latency_target=0.5, backoff=0.5)
+        started = monotonic() - 1
+        for _ in range(5):
+            limit.acquire()
+        for _ in range(5):
+            limit.release(started)
+        assert limit.counters["limit"] == 5
+        assert limit.counters["congested"] == 5
+
+    def test_requests_over_limit_are_shed(self):
+        from ginkgo.async.gevent import AdaptiveLimit, WSGIServer
+        import gevent, gevent.socket
+        def app(environ, start_response):
+            gevent.sleep(0.2)
+            start_response("200 OK", [("Content-Length", "2")])
+            return ["ok"]
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(16)
+        server = WSGIServer(listener, app, log=None, retry_after=3,
+                            concurrency_limit=AdaptiveLimit(initial=2))
+        server.start()
+        clients = []
+        for _ in range(3):
+            client = gevent.socket.create_connection(listener.getsockname())
+            client.sendall("GET / HTTP/1.1\r\nHost: test\r\n\r\n")
+            clients.append(client)
+            gevent.sleep(0.01)
+        responses = [c.recv(1024) for c in clients]
+        server.stop()
+        assert [r.split(" ", 2)[1] for r in responses] == ["200", "200", "503"]
+        assert "Retry-After: 3" in responses[2]
+        assert server.counters["shed"] == 1
+        assert server.counters["completed"] == 2
+
+class StreamClientTest(GeventTestCase):
+    def echo_server(self):
+        from ginkgo.async.gevent import StreamServer
+        def echo(sock, address):
+            server.clients.append(sock)
+            while True:
+                data = sock.recv(64)
+                if not data:
+                    break
+                sock.sendall(data)
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(16)
+        server = StreamServer(listener, echo, grace_period=0.1)
+        server.clients = []
+        server.start()
+        return server
+
+    def test_connections_are_reused(self):
+        from ginkgo.async.gevent import StreamClient
+        server = self.echo_server()
+        client = StreamClient(server.address, max_connections=2)
+        client.start()
+        for _ in range(3):
+            with client.connection() as sock:
+                sock.sendall("ping")
+                assert sock.recv(64) == "ping"
+        assert client.counters["connects"] == 1
+        assert client.counters["idle"] == 1
+        assert client.counters["checkouts"] == 3
+        client.stop()
+        server.stop()
+
+    def test_checkout_times_out_when_pool_is_full(self):
+        from ginkgo.async import PoolFull
+        from ginkgo.async.gevent import StreamClient
+        server = self.echo_server()
+        client = StreamClient(server.address, max_connections=1)
+        client.start()
+        sock = client.checkout()
+        self.assertRaises(PoolFull, client.checkout, 0.1)
+        assert client.counters["timeouts"] == 1
+        client.checkin(sock)
+        client.checkin(client.checkout(0.1))
+        client.stop()
+        server.stop()
+
+    def test_dead_connections_are_replaced(self):
+        from ginkgo.async.gevent import StreamClient
+        import gevent
+        server = self.echo_server()
+        client = StreamClient(server.address, min_connections=2,
+                              max_connections=4)
+        client.health_interval = 0.05
+        client.start()
+        gevent.sleep(0.1)
+        assert client.counters["idle"] == 2
+        for sock in server.clients:
+            sock.close()
+        server.stop()
+        server = self.echo_server()
+        client.address = server.address
+        gevent.sleep(0.2)
+        assert client.counters["discarded"] == 2
+        assert client.counters["open"] == 2
+        with client.connection() as sock:
+            sock.sendall("ping")
+            assert sock.recv(64) == "ping"
+        client.stop()
+        server.stop()
+
+    def test_overridden_handle_runs_and_reconnects(self):
+        from ginkgo.async.gevent import StreamClient
+        import gevent
+        server = self.echo_server()
+        received = []
+        class Client(StreamClient):
+            def handle(self, sock):
+                sock.sendall("hi")
+                received.append(sock.recv(64))
+        client = Client(server.address)
+        client.min_backoff = 0.01
+        client.start()
+        gevent.sleep(0.1)
+        assert received[:2] == ["hi", "hi"]
+        assert client.counters["open"] <= 1
+        client.stop()
+        server.stop()
+
+    def test_connect_retries_with_backoff(self):
+        from ginkgo.async.gevent import StreamClient
+        import gevent
+        listener = socket.socket()
+        listener.bind(("127.0.0.1", 0))
+        address = listener.getsockname()
+        listener.close()
+        client = StreamClient(address)
+        client.min_backoff = 0.01
+        client.start()
+        greenlet = gevent.spawn(client.checkout)
+        gevent.sleep(0.1)
+        failures = client.counters["connect_failures"]
+        assert 2 <= failures < 10
+        greenlet.kill()
+        client.stop()
+
+class DatagramServerTest(GeventTestCase):
+    def test_datagram_server_on_binding(self):
+        from ginkgo.async.gevent import DatagramServer
+        import gevent.socket
+        ginkgo.settings.set("udp_bind", "127.0.0.1:0")
+        class EchoService(Service):
+            bind = ginkgo.Binding("udp_bind", datagram=True)
+            def __init__(self):
+                self.server = DatagramServer(self.bind, self.echo)
+                self.add_service(self.server)
+            def echo(self, data, address):
+                self.server.sendto(data, address)
+        service = EchoService()
+        service.start()
+        client = gevent.socket.socket(type=socket.SOCK_DGRAM)
+        client.sendto("ping", service.bind.getsockname())
+        assert client.recvfrom(64)[0] == "ping"
+        service.stop()
+
+    def test_batches_reuse_buffers(self):
+        from ginkgo.async.gevent import DatagramServer
+        import gevent, gevent.socket
+        batches = []
+        def handle(batch):
+            batches.append([data.tobytes() for data, _ in batch])
+        listener = socket.socket(type=socket.SOCK_DGRAM)
+        listener.bind(("127.0.0.1", 0))
+        server = DatagramServer(listener, handle, batch_size=4,
+                                buffer_size=16)
+        client = gevent.socket.socket(type=socket.SOCK_DGRAM)
+        for i in range(10):
+            client.sendto(str(i) * (i + 1), listener.getsockname())
+        server.start()
+        gevent.sleep(0.1)
+        assert [len(b) for b in batches] == [4, 4, 2]
+        assert sum(batches, []) == [str(i) * (i + 1) for i in range(10)]
+        buffers = set(id(b) for b in sum(server._buffers, []))
+        client.sendto("x" * 32, listener.getsockname())
+        gevent.sleep(0.1)
+        assert batches[-1] == ["x" * 16]
+        assert set(id(b) for b in sum(server._buffers, [])) == buffers
+        server.stop()
+
+class SimulatedManagerTest(unittest.TestCase):
+    def setUp(self):
+        from ginkgo.async import simulated
+        self.sim = simulated.reset()
+        self.async = simulated.AsyncManager()
+
+    def test_sleep_uses_virtual_time(self):
+        started = time.time()
+        self.async.sleep(3600)
+        assert self.sim.now == 3600
+        assert time.time() - started < 1
+
+    def test_timers_fire_in_order_as_time_advances(self):
+        fired = []
+        for delay in (30, 10, 20):
+            self.async.spawn_later(delay, fired.append, delay)
+        self.sim.advance(15)
+        assert fired == [10] and self.sim.now == 15
+        self.sim.run()
+        assert fired == [10, 20, 30] and self.sim.now == 30
+
+    def test_run_until_idle_keeps_the_clock(self):
+        log = []
+        def worker():
+            log.append("ran")
+            self.async.sleep(5)
+            log.append("slept")
+        self.async.spawn(worker)
+        self.sim.run_until_idle()
+        assert log == ["ran"] and self.sim.now == 0
+
+    def test_primitives_time_out_virtually(self):
+        import Queue
+        queue = self.async.queue(1)
+        queue.put(1)
+        self.assertRaises(Queue.Full, queue.put, 2, timeout=10)
+        assert queue.get() == 1
+        self.assertRaises(Queue.Empty, queue.get, timeout=10)
+        assert not self.async.event().wait(10)
+        lock = self.async.lock()
+        lock.acquire()
+        assert not lock.acquire(timeout=10)
+        assert self.sim.now == 40
+
+    def test_deadline_interrupts_on_virtual_clock(self):
+        from ginkgo.async import DeadlineExceeded
+        def slow():
+            with self.async.timeout(30):
+                self.async.sleep(60)
+        self.assertRaises(DeadlineExceeded, slow)
+        self.assertAlmostEqual(self.sim.now, 30, places=2)
+
+    def test_blocking_forever_raises_deadlock(self):
+        from ginkgo.async.simulated import Deadlock
+        self.assertRaises(Deadlock, self.async.event().wait)
+
+    def interleaving(self, seed):
+        from ginkgo.async import simulated
+        sim = simulated.reset(seed)
+        async = simulated.AsyncManager()
+        order = []
+        def worker(name):
+            for step in range(3):
+                order.append((name, step))
+                async.sleep(0)
+        for name in "abcd":
+            async.spawn(worker, name)
+        sim.run()
+        return order
+
+    def test_interleavings_replay_by_seed(self):
+        assert self.interleaving(None) == self.interleaving(None)
+        assert self.interleaving(7) == self.interleaving(7)
+        orders = set(tuple(self.interleaving(seed)) for seed in range(5))
+        assert len(orders) > 1
+
+    def test_service_loop_runs_without_waiting(self):
+        class Ticker(Service):
+            async = "ginkgo.async.simulated"
+            def __init__(self):
+                self.ticks = 0
+            def do_start(self):
+                self.spawn(self.loop)
+            def loop(self):
+                while True:
+                    self.ticks += 1
+                    self.async.sleep(60)
+        ticker = Ticker()
+        ticker.start()
+        self.sim.advance(3600)
+        assert ticker.ticks == 61
+        ticker.stop()
+        assert ticker.async._tasks == set()
@@ -1,3 +1,6 @@
+import os
+import socket
+
 from ginkgo import config
 
 def test_config():
@@ -35,3 +38,163 @@ def test_config():
     assert g.bar.__class__ == config.Group
     assert g.bar.boo == "bar"
     assert g.bar.tree == None
+
+def test_parse_address():
+    assert config.parse_address(8000) == (socket.AF_INET, ("0.0.0.0", 8000))
+    assert config.parse_address(":80") == (socket.AF_INET, ("0.0.0.0", 80))
+    assert config.parse_address("[::1]:80") == (socket.AF_INET6, ("::1", 80))
+    assert config.parse_address(("localhost", "80")) == (
+        socket.AF_INET, ("localhost", 80))
+    assert config.parse_address("unix:/tmp/s") == (socket.AF_UNIX, "/tmp/s")
+
+def test_binding():
+    c = config.Config()
+    c.set("bind", "127.0.0.1:0")
+
+    class MyClass(object):
+        bind = c.binding("bind", backlog=16, help="This is bind.")
+
+    o = MyClass()
+    sock = o.bind
+    assert sock.getsockname()[0] == "127.0.0.1"
+    assert o.bind is sock
+
+def test_reuse_port_binding():
+    probe = socket.socket()
+    probe.bind(("127.0.0.1", 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    c = config.Config()
+    c.set("shared", "127.0.0.1:{}".format(port))
+    shared = c.binding("shared", reuse_port=True)
+    c.bind_all(3)
+    sockets = c._bound_sockets[("shared", repr(c.get("shared")))]
+    assert len(sockets) == 3
+    assert all(s.getsockname()[1] == port for s in sockets)
+    c._binding_slot = 1
+    assert c.bind(shared) is sockets[1]
+
+def _readopt(c, path):
+    key = (path, repr(c.get(path)))
+    bindings = [[p, address, [[os.dup(e[0])] + e[1:] for e in fds]]
+                for p, address, fds in c.bound_fds()
+                if (p, address) == key]
+    del c._bound_sockets[key]
+    c.adopt_fds(bindings)
+
+def test_adopt_fds():
+    c = config.Config()
+    c.set("adopted", "127.0.0.1:0")
+    adopted = c.binding("adopted")
+    sock = c.bind(adopted)
+    _readopt(c, "adopted")
+    assert c.bind(adopted) is not sock
+    assert c.bind(adopted).getsockname() == sock.getsockname()
+
+def test_adopt_datagram_fds():
+    c = config.Config()
+    c.set("adopted_udp", "127.0.0.1:0")
+    adopted = c.binding("adopted_udp", datagram=True)
+    sock = c.bind(adopted)
+    _readopt(c, "adopted_udp")
+    assert c.bind(adopted).type == socket.SOCK_DGRAM
+    assert c.bind(adopted).getsockname() == sock.getsockname()
+
+def test_setting_cache_sees_changes():
+    c = config.Config()
+    c.set("Cached.Value", 1)
+
+    class MyClass(object):
+        value = c.setting(".cached.value", default=0)
+        missing = c.setting("cached.missing", default="default")
+
+    o = MyClass()
+    assert o.value == 1
+    assert o.missing == "default"
+    c.set("cached.value", 2)
+    assert o.value == 2
+    c.load({"cached": 3, "cached.missing": "loaded"})
+    assert o.missing == "loaded"
+    c.set("cached.value", 4, force=True)
+    c.set("cached.value", 5)
+    assert o.value == 4
+
+def test_group_index():
+    c = config.Config()
+    c.load({"index.a.x": 1, "index.a.y": 2, "index.b": 3})
+    g = c.group("index")
+    assert sorted(g) == ["a", "b"]
+    assert len(g.a) == 2
+    assert "x" in g.a and "z" not in g.a
+    assert dict(g.a) == {"x": 1, "y": 2}
+    assert g.a.z is None
+    c.set("index.a.z", 4)
+    assert g.a.z == 4 and len(g.a) == 3
+
+def test_load_publishes_snapshot_atomically():
+    c = config.Config()
+    c.load({"snap.host": "a", "snap.port": 1})
+
+    class MyClass(object):
+        bind = c.binding("snap.bind", default="127.0.0.1:0")
+
+    before = c.snapshot()
+    try:
+        c.load({"snap.host": "b", "snap.port": 2, "snap.bind": "nowhere"})
+    except RuntimeError, e:
+        assert "snap.bind" in str(e)
+    else:
+        assert False, "invalid binding was loaded"
+    assert c.snapshot() is before
+    assert (c.get("snap.host"), c.get("snap.port")) == ("a", 1)
+    after = c.load({"snap.host": "b", "snap.port": 2})
+    assert c.snapshot() is after
+    assert (before["snap.host"], before["snap.port"]) == ("a", 1)
+    assert (after["snap.host"], after["snap.port"]) == ("b", 2)
+
+def test_subscriptions():
+    c = config.Config()
+    c.load({"sub.db.host": "a", "sub.db.port": 1, "sub.other": 1})
+    exact, prefixed, values = [], [], []
+
+    class MyClass(object):
+        port = c.setting("sub.db.port")
+
+    cancel = c.subscribe("sub.db.host", exact.append)
+    c.subscribe("Sub.DB", prefixed.append, prefix=True)
+    MyClass.__dict__["port"].subscribe(lambda old, new: values.append(new))
+    c.load({"sub.db.host": "a", "sub.db.port": 2, "sub.other": 2})
+    assert exact == []
+    assert prefixed == [{"sub.db.port": (1, 2)}]
+    assert values == [2]
+    c.set("sub.db.host", "b")
+    assert exact == [{"sub.db.host": ("a", "b")}]
+    assert prefixed[-1] == {"sub.db.host": ("a", "b")}
+    cancel()
+    c.set("sub.db.host", "c")
+    assert len(exact) == 1 and len(prefixed) == 3
+
+def test_batch_publishes_once():
+    c = config.Config()
+    changes = []
+    c.subscribe("batch", changes.append, prefix=True)
+    before = c.snapshot()
+    with c.batch():
+        for i in range(100):
+            c.set("batch.k%d" % i, i)
+        with c.batch():
+            c.set("batch.forced", 1, force=True)
+        c.set("batch.forced", 2)
+        assert c.get("batch.k0") is None
+    assert c.snapshot() is not before
+    assert len(changes) == 1 and len(changes[0]) == 101
+    assert c.get("batch.k99") == 99 and c.get("batch.forced") == 1
+    assert len(c.group("batch")) == 101
+    try:
+        with c.batch():
+            c.set("batch.k0", "discarded")
+            raise ValueError()
+    except ValueError:
+        pass
+    assert c.get("batch.k0") == 0
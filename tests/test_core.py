@@ -0,0 +1,208 @@
+import time
+import unittest
+
+from ginkgo.core import Service, StartError, dependency_order
+from ginkgo.core import critical_path, timing_report
+
+class GeventService(Service):
+    async = "ginkgo.async.gevent"
+
+class SlowService(GeventService):
+    def __init__(self, name, delay=0.2, fail=False, log=None):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.log = log if log is not None else []
+
+    def do_start(self):
+        self.async.sleep(self.delay)
+        if self.fail:
+            raise ValueError(self.name)
+        self.log.append(("start", self.name))
+
+    def do_stop(self):
+        self.log.append(("stop", self.name))
+
+class ConcurrentStartTest(unittest.TestCase):
+    def test_dependency_order(self):
+        a, b, c = SlowService("a"), SlowService("b"), SlowService("c")
+        a.requires.append(c)
+        assert dependency_order([a, b, c]) == [c, a, b]
+        c.requires.append(a)
+        self.assertRaises(RuntimeError, dependency_order, [a, b, c])
+
+    def test_independent_children_start_together(self):
+        parent = GeventService()
+        parent.start_concurrently = True
+        for name in "abcde":
+            parent.add_service(SlowService(name))
+        started = time.time()
+        parent.start()
+        assert time.time() - started < 0.5
+        assert all(c.ready for c in parent._children)
+        parent.stop()
+
+    def test_required_children_start_first(self):
+        log = []
+        parent = GeventService()
+        parent.start_concurrently = True
+        db = SlowService("db", log=log)
+        cache = SlowService("cache", delay=0.1, log=log)
+        web = SlowService("web", delay=0, log=log)
+        parent.add_service(web, requires=[db, cache])
+        parent.add_service(cache)
+        parent.add_service(db)
+        parent.start()
+        assert log == [("start", "cache"), ("start", "db"), ("start", "web")]
+        parent.stop()
+
+    def test_failed_child_rolls_back_started_children(self):
+        log = []
+        parent = GeventService()
+        parent.start_concurrently = True
+        db = SlowService("db", delay=0.1, log=log)
+        broken = SlowService("broken", fail=True, log=log)
+        web = SlowService("web", delay=0, log=log)
+        parent.add_service(db)
+        parent.add_service(broken)
+        parent.add_service(web, requires=[broken])
+        try:
+            parent.start()
+        except StartError, e:
+            names = sorted(s.name for s, _ in e.failures)
+            assert names == ["broken", "web"]
+        else:
+            assert False, "StartError not raised"
+        assert ("start", "web") not in log
+        assert not db.ready and not broken.ready
+
+class StoppingService(GeventService):
+    def __init__(self, name, delay=0.2, log=None):
+        self.name = name
+        self.delay = delay
+        self.log = log if log is not None else []
+
+    def do_stop(self):
+        self.async.sleep(self.delay)
+        self.log.append(self.name)
+
+class ConcurrentStopTest(unittest.TestCase):
+    def test_independent_children_stop_together(self):
+        parent = GeventService()
+        parent.stop_concurrently = True
+        for name in "abcde":
+            parent.add_service(StoppingService(name))
+        parent.start()
+        started = time.time()
+        parent.stop()
+        assert time.time() - started < 0.5
+        assert all(c.state.current == "stopped" for c in parent._children)
+        assert parent.stop_overruns == []
+
+    def test_children_stop_in_reverse_dependency_order(self):
+        log = []
+        parent = GeventService()
+        parent.stop_concurrently = True
+        db = StoppingService("db", delay=0, log=log)
+        web = StoppingService("web", delay=0.1, log=log)
+        parent.add_service(db)
+        parent.add_service(web, requires=[db])
+        parent.start()
+        parent.stop()
+        assert log == ["web", "db"]
+
+    def test_deadline_reports_overruns(self):
+        parent = GeventService()
+        parent.stop_concurrently = True
+        parent.stop_deadline = 0.4
+        fast = StoppingService("fast", delay=0)
+        slow = StoppingService("slow", delay=5)
+        parent.add_service(fast)
+        parent.add_service(slow)
+        parent.start()
+        started = time.time()
+        parent.stop()
+        assert time.time() - started < 2
+        assert parent.stop_overruns == [slow]
+
+    def test_restarts_after_overrun(self):
+        parent = GeventService()
+        parent.stop_concurrently = True
+        parent.stop_deadline = 0.4
+        slow = StoppingService("slow", delay=5)
+        parent.add_service(slow)
+        parent.start()
+        parent.stop()
+        assert parent.stop_overruns == [slow]
+        assert slow.state.current == "stopped"
+        parent.start()
+        assert slow.ready
+        slow.delay = 0
+        parent.stop()
+        assert parent.stop_overruns == []
+
+    def test_unkillable_overrun_finishes_its_own_stop(self):
+        class ThreadedService(Service):
+            async = "ginkgo.async.threading"
+        class ThreadedStoppingService(StoppingService):
+            async = "ginkgo.async.threading"
+        parent = ThreadedService()
+        parent.stop_concurrently = True
+        parent.stop_deadline = 0.2
+        slow = ThreadedStoppingService("slow", delay=0.5)
+        parent.add_service(slow)
+        parent.start()
+        parent.stop()
+        assert parent.stop_overruns == [slow]
+        assert slow.state.current == "stopping"
+        time.sleep(0.6)
+        assert slow.state.current == "stopped"
+        assert slow.log == ["slow"]
+
+class LifecycleTimingTest(unittest.TestCase):
+    def test_hooks_and_transitions_are_timed(self):
+        service = SlowService("a", delay=0.1)
+        service.start()
+        service.stop()
+        assert service.state.duration("starting", "ready") >= 0.1
+        assert service.state.duration("stopping", "stopped") >= 0
+        assert service.state.hook_durations["do_start"] >= 0.1
+        assert "post_stop" in service.state.hook_durations
+
+    def test_critical_path_follows_requirements(self):
+        parent = GeventService()
+        parent.start_concurrently = True
+        a = SlowService("a", delay=0.1)
+        b = SlowService("b", delay=0.15)
+        c = SlowService("c", delay=0.1)
+        parent.add_service(a)
+        parent.add_service(b)
+        parent.add_service(c, requires=[a])
+        parent.start()
+        path = critical_path(parent, "start")
+        assert [s for _, s in path] == [parent, a, c]
+        assert "critical path" in timing_report(parent)
+        parent.stop()
+
+class ReloadIfChangedTest(unittest.TestCase):
+    def test_reload_skipped_when_settings_unchanged(self):
+        import ginkgo
+        class Reloading(GeventService):
+            reload_if_changed = True
+            greeting = ginkgo.Setting("reload_test.greeting", default="hi")
+            def __init__(self):
+                self.reloads = 0
+            def do_reload(self):
+                self.reloads += 1
+        parent = GeventService()
+        child = Reloading()
+        parent.add_service(child)
+        parent.start()
+        ginkgo.settings.set("reload_test.unrelated", 1)
+        parent.reload()
+        assert child.reloads == 0
+        ginkgo.settings.set("reload_test.greeting", "hello")
+        parent.reload()
+        parent.reload()
+        assert child.reloads == 1
+        parent.stop()
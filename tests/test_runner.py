@@ -0,0 +1,265 @@
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import ginkgo.util
+from ginkgo.runner import ConfigWatcher, UPGRADE_SIGNAL, WorkerSupervisor
+
+class FakeProcess(object):
+    def __init__(self, lifetime, ignore_stop=False):
+        self.lifetime = lifetime
+        self.ignore_stop = ignore_stop
+
+    def run_worker(self, number):
+        if self.ignore_stop:
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        time.sleep(self.lifetime)
+
+class GeventSupervisor(WorkerSupervisor):
+    async = "ginkgo.async.gevent"
+    start_delay = 0
+
+    def do_start(self):
+        super(GeventSupervisor, self).do_start()
+        self.async.sleep(self.start_delay)
+
+def supervisor(process, count=2):
+    supervisor = GeventSupervisor(process, count)
+    supervisor.check_interval = 0.02
+    supervisor.min_backoff = 0.05
+    return supervisor
+
+class WorkerSupervisorTest(unittest.TestCase):
+    def test_forks_workers(self):
+        workers = supervisor(FakeProcess(30))
+        workers.start()
+        pids = [w.pid for w in workers.workers]
+        assert None not in pids
+        assert os.getpid() not in pids
+        workers.stop()
+        assert workers.running == []
+
+    def test_restarts_exited_workers_with_backoff(self):
+        workers = supervisor(FakeProcess(0.01), count=1)
+        workers.start()
+        first = workers.workers[0].pid
+        workers.async.sleep(0.5)
+        worker = workers.workers[0]
+        assert worker.failures >= 2
+        assert worker.pid != first
+        workers.stop()
+
+    def test_restarts_workers_exiting_while_starting(self):
+        workers = supervisor(FakeProcess(0.01), count=1)
+        workers.start_delay = 0.3
+        workers.start()
+        assert workers.workers[0].failures >= 1
+        workers.stop()
+
+    def test_stop_kills_workers_after_timeout(self):
+        workers = supervisor(FakeProcess(30, ignore_stop=True), count=1)
+        workers.stop_timeout = 0.2
+        workers.start()
+        time.sleep(0.1)
+        started = time.time()
+        workers.stop()
+        assert 0.2 <= time.time() - started < 1
+        assert workers.running == []
+
+class ReloadingProcess(object):
+    def __init__(self):
+        self.reloads = 0
+
+    def handle_reload(self):
+        self.reloads += 1
+
+class GeventWatcher(ConfigWatcher):
+    async = "ginkgo.async.gevent"
+
+class ConfigWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "app.conf.py")
+        self.write("delay = 1\n")
+        self.process = ReloadingProcess()
+        self.watcher = GeventWatcher(self.process, self.path, debounce=0.1)
+        self.watcher.poll_interval = 0.05
+
+    def tearDown(self):
+        if self.watcher.state.current in ["starting", "ready"]:
+            self.watcher.stop()
+        shutil.rmtree(self.dir)
+
+    def write(self, content, replace=False):
+        path = self.path + ".tmp" if replace else self.path
+        with open(path, "w") as f:
+            f.write(content)
+        if replace:
+            os.rename(path, self.path)
+
+    def test_coalesces_burst_of_changes(self):
+        self.watcher.start()
+        assert self.watcher.counters["inotify"]
+        started = ginkgo.util.monotonic()
+        for n in xrange(5):
+            self.write("delay = {}\n".format(n + 2), replace=n % 2)
+            self.watcher.async.sleep(0.02)
+        self.watcher.async.sleep(0.3)
+        counters = self.watcher.counters
+        assert self.process.reloads == 1
+        assert counters["reloads"] == 1
+        assert counters["events"] >= 5
+        assert 0.1 <= counters["last_latency"] < \
+            ginkgo.util.monotonic() - started
+
+    def test_skips_unchanged_content(self):
+        self.watcher.start()
+        self.write("delay = 1\n", replace=True)
+        self.watcher.async.sleep(0.3)
+        assert self.process.reloads == 0
+        assert self.watcher.counters["skipped"] == 1
+
+    def test_polls_without_inotify(self):
+        def unavailable(path):
+            raise OSError("inotify unavailable")
+        inotify, ginkgo.util.Inotify = ginkgo.util.Inotify, unavailable
+        try:
+            self.watcher.start()
+        finally:
+            ginkgo.util.Inotify = inotify
+        assert not self.watcher.counters["inotify"]
+        self.watcher.async.sleep(0.05)
+        self.write("delay = 100\n")
+        self.watcher.async.sleep(0.4)
+        assert self.process.reloads == 1
+
+APP_SCRIPT = """
+import os, sys
+sys.path.insert(0, {root!r})
+import ginkgo
+from ginkgo.runner import Process
+
+ginkgo.settings.load({settings!r})
+workdir = os.path.dirname(os.path.abspath(__file__))
+
+def mark(name):
+    open(os.path.join(workdir, "{{}}.{{}}".format(name, os.getpid())), "w")
+
+class App(ginkgo.Service):
+    def do_start(self):
+        mark("started")
+        if os.path.exists(os.path.join(workdir, "slow")):
+            self.async.sleep(3)
+        mark("ready")
+        self.spawn(self.idle)
+
+    def idle(self):
+        while True:
+            self.async.sleep(1)
+
+Process(App).serve_forever()
+"""
+
+class ProcessScriptTest(unittest.TestCase):
+    """Runs a `Process` in a subprocess, which marks files as it starts"""
+    settings = {}
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        script = os.path.join(self.dir, "app.py")
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        settings = dict(self.settings, async="ginkgo.async.gevent")
+        with open(script, "w") as f:
+            f.write(APP_SCRIPT.format(root=root, settings=settings))
+        with open(os.path.join(self.dir, "output"), "w") as output:
+            self.process = subprocess.Popen([sys.executable, script],
+                stdout=output, stderr=subprocess.STDOUT)
+        self.pids = set()
+
+    def tearDown(self):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+        self.process.wait()
+        shutil.rmtree(self.dir)
+
+    def marked(self, name):
+        return set(int(f.split(".")[1]) for f in os.listdir(self.dir)
+                   if f.startswith(name + "."))
+
+    def wait_for(self, name, timeout=5):
+        """Waits for a process other than the ones seen so far to mark name"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            pids = self.marked(name) - self.pids
+            if pids:
+                pid = pids.pop()
+                self.pids.add(pid)
+                return pid
+            time.sleep(0.05)
+
+    def alive(self, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def wait_exit(self, timeout=5):
+        deadline = time.time() + timeout
+        while self.process.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        return self.process.returncode
+
+class UpgradeTest(ProcessScriptTest):
+    settings = dict(upgrade_timeout=1)
+
+    def setUp(self):
+        super(UpgradeTest, self).setUp()
+        assert self.wait_for("ready") == self.process.pid
+
+    def test_new_process_takes_over(self):
+        os.kill(self.process.pid, UPGRADE_SIGNAL)
+        new_pid = self.wait_for("ready")
+        assert new_pid is not None
+        assert self.wait_exit() is not None
+        assert self.alive(new_pid)
+
+    def test_cancelled_upgrade_kills_new_process(self):
+        open(os.path.join(self.dir, "slow"), "w")
+        os.kill(self.process.pid, UPGRADE_SIGNAL)
+        new_pid = self.wait_for("started")
+        assert new_pid is not None
+        self.pids.discard(new_pid)
+        time.sleep(1.5)
+        assert not self.alive(new_pid)
+        time.sleep(2)
+        assert self.process.poll() is None
+        assert new_pid not in self.marked("ready")
+
+        # upgrading again once cancelled starts a new process
+        os.remove(os.path.join(self.dir, "slow"))
+        os.kill(self.process.pid, UPGRADE_SIGNAL)
+        assert self.wait_for("ready") is not None
+
+class WorkersTest(ProcessScriptTest):
+    settings = dict(workers=2)
+
+    def test_restarts_killed_worker(self):
+        workers = [self.wait_for("ready"), self.wait_for("ready")]
+        assert None not in workers
+        assert self.process.pid not in workers
+        os.kill(workers[0], signal.SIGKILL)
+        replacement = self.wait_for("ready")
+        assert replacement is not None
+        assert replacement not in workers
+        os.kill(self.process.pid, signal.SIGTERM)
+        assert self.wait_exit(15) is not None
+        assert not self.alive(workers[1]) and not self.alive(replacement)